@@ -0,0 +1,275 @@
+import argparse
+import json
+import os
+import pickle
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Tuple,
+)
+
+import numpy as np
+import pandas as pd
+from sklearn.linear_model import LinearRegression
+from sqlalchemy import text
+
+# Offline by default: sql_connector reads the database URL on import, without it engines connect to SQL Server
+os.environ.setdefault('APARTMENT_DB_URL', 'sqlite://')
+
+from fixture_data import (
+    make_apartments,
+    make_listing_html,
+    make_report_rows,
+)
+from fixture_server import FIXTURES_PATH
+from make_excel import (
+    get_top_n_per_day,
+    make_excel,
+    make_excel_streaming,
+)
+from parsers import PARSERS
+from predictor import (
+    QUERY_APARTMENTS,
+    predict_main,
+)
+from processor import (
+    ENCODER,
+    convert_to_dummies,
+    filter_df_main,
+    filter_df_room_1,
+    filter_df_rooms,
+    handle_dataframe,
+)
+from reference import (
+    filter_df_main_masks,
+    filter_df_room_1_masks,
+    get_top_n_per_day_apply,
+    handle_dataframe_apply,
+)
+from rescore import FixedModelRegistry
+from sql_connector import (
+    bulk_insert,
+    get_sqlite_engine,
+)
+
+BASE_PATH = Path(__file__).parent.parent
+RESULTS_PATH = BASE_PATH.joinpath('benchmarks')
+SIZES = [10_000, 100_000, 1_000_000]
+
+MODEL_FEATURES = ['Year_Building', 'Floor', 'Floors_In_Building', 'Square_Total'] + ENCODER.features
+
+
+def load_listing_pages(pages: int, fixtures_path: Path = FIXTURES_PATH) -> List[Tuple[str, str]]:
+    # Saved ru09 listings when there are any, synthetic pages otherwise
+    paths = sorted(fixtures_path.glob('*subaction%3Ddetail*.html'))[:pages]
+    if paths:
+        return [(path.read_text(encoding='utf-8'), path.name) for path in paths]
+    apartments = make_apartments(pages).replace({np.nan: None}).to_dict('records')
+    return [(make_listing_html(i), f'https://www.tomsk.ru09.ru/realty?subaction=detail&id={i["Id"]}')
+            for i in apartments]
+
+
+def save_dummy_models(data: pd.DataFrame, path: Path) -> pd.DataFrame:
+    # One linear model per Rooms_Number pickled to path, returned in the form of the Models table
+    models_info = []
+    for rooms_number, segment in data.groupby('Rooms_Number'):
+        model = LinearRegression().fit(ENCODER.transform(segment, MODEL_FEATURES), segment['Price'])
+        model_path = path.joinpath(f'rooms_{rooms_number}.pkl')
+        with open(model_path, 'wb') as file:
+            pickle.dump(model, file)
+        models_info.append({'Rooms_Number': rooms_number,
+                            'Model_path': str(model_path),
+                            'Model_features': '; '.join(MODEL_FEATURES)})
+    return pd.DataFrame(models_info)
+
+
+def measure(function: Callable, *args) -> Tuple[float, Any]:
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def measure_peak_memory(function: Callable, *args) -> int:
+    # tracemalloc slows allocations down, so time is measured by a separate run
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_stage(name: str, rows: int, function: Callable, make_args: Callable[[], tuple]) -> Dict[str, float]:
+    # Arguments are built outside of the measurement, every run gets its own copy
+    elapsed, _ = measure(function, *make_args())
+    peak_memory = measure_peak_memory(function, *make_args())
+    result = {'rows': rows,
+              'seconds': round(elapsed, 4),
+              'rows_per_second': round(rows / elapsed, 1),
+              'peak_memory_mb': round(peak_memory / 2 ** 20, 1)}
+    print(f'{name:<24} {rows:>9} rows {elapsed:>9.2f} s {result["rows_per_second"]:>12.0f} rows/s '
+          f'{result["peak_memory_mb"]:>9.1f} MB')
+    return result
+
+
+def run_parse_stages(pages: int) -> Dict[str, Dict[str, float]]:
+    listings = load_listing_pages(pages)
+    results = {}
+    for name, parse in PARSERS.items():
+        results[f'parse_apartment_{name}'] = run_stage(f'parse_apartment_{name}', len(listings),
+                                                       lambda: [parse(*i) for i in listings], tuple)
+    return results
+
+
+def run_size_stages(rows: int, report_rows: int, directory: Path) -> Dict[str, Dict[str, float]]:
+    raw = make_apartments(rows)
+    handled = handle_dataframe(raw.copy())
+    filtered = filter_df_rooms(filter_df_main(handled.copy()))
+    registry = FixedModelRegistry(save_dummy_models(filtered, directory))
+    registry.max_models = len(registry.model_info)
+    engine = get_sqlite_engine(str(directory.joinpath(f'apartments_{rows}.db')))
+    apartments = raw.reset_index(drop=True)
+    apartments['Url_Link'] = 'https://www.tomsk.ru09.ru/realty?subaction=detail&id=' + apartments['Id'].astype(str)
+    report = make_report_rows(min(rows, report_rows))
+
+    results = {
+        'handle_dataframe': run_stage('handle_dataframe', rows, handle_dataframe, lambda: (raw.copy(),)),
+        'filter_df_main_rooms': run_stage('filter_df_main_rooms', len(handled),
+                                          lambda x: filter_df_rooms(filter_df_main(x)),
+                                          lambda: (handled.copy(),)),
+        'convert_to_dummies': run_stage('convert_to_dummies', len(filtered), convert_to_dummies,
+                                        lambda: (filtered.copy(),)),
+        'predict_main': run_stage('predict_main', len(filtered), predict_main, lambda: (filtered, registry)),
+    }
+
+    def make_insert_args() -> tuple:
+        # The table is emptied before the timed and the traced run, so both insert every row
+        with engine.begin() as connection:
+            connection.execute(text('DELETE FROM Apartments'))
+        return apartments,
+
+    results['bulk_insert_sqlite'] = run_stage('bulk_insert_sqlite', rows,
+                                              lambda x: bulk_insert(x, 'Apartments', engine, key_columns=['Id']),
+                                              make_insert_args)
+    results['read_sql_sqlite'] = run_stage('read_sql_sqlite', rows,
+                                           lambda: pd.read_sql_query(QUERY_APARTMENTS, engine), tuple)
+    results['make_excel_streaming'] = run_stage(
+        'make_excel_streaming', len(report), make_excel_streaming,
+        lambda: (report, directory.joinpath('report.xlsx')))
+    engine.dispose()
+    return results
+
+
+def benchmark_handle_dataframe(rows: int) -> None:
+    df = make_apartments(rows)
+    apply_time, expected = measure(handle_dataframe_apply, df.copy())
+    vectorized_time, result = measure(handle_dataframe, df.copy())
+    pd.testing.assert_frame_equal(result, expected)
+    print(f'handle_dataframe, {rows} rows: apply {apply_time:.2f} s, vectorized {vectorized_time:.2f} s, '
+          f'speedup x{apply_time / vectorized_time:.1f}')
+
+
+def benchmark_filters(rows: int) -> None:
+    df = handle_dataframe(make_apartments(rows))
+    df = df[df['Rooms_Number'] == 1]
+    masks_time, expected = measure(lambda x: filter_df_room_1_masks(filter_df_main_masks(x)), df.copy())
+    rules_time, result = measure(lambda x: filter_df_room_1(filter_df_main(x)), df.copy())
+    pd.testing.assert_frame_equal(result.drop(columns='Not_Used_Description'),
+                                  expected.drop(columns='Not_Used_Description'))
+    print(f'filter_df_main + filter_df_room_1, {len(df)} rows: masks {masks_time:.2f} s, '
+          f'rules {rules_time:.2f} s, speedup x{masks_time / rules_time:.1f}')
+
+
+def benchmark_top_n_per_day(rows: int) -> None:
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame({
+        'Date_Add': pd.Timestamp('2019-01-01') + pd.to_timedelta(rng.integers(0, 3 * 365, rows), unit='D'),
+        'Error': -rng.uniform(0, 1500, rows),
+        'Apartment_Key': np.arange(rows),
+    })
+    apply_time, expected = measure(get_top_n_per_day_apply, data)
+    vectorized_time, result = measure(get_top_n_per_day, data)
+    assert sorted(expected['Apartment_Key']) == sorted(result['Apartment_Key'])
+    print(f'top 10 per day, {rows} rows: apply {apply_time:.2f} s, vectorized {vectorized_time:.2f} s, '
+          f'speedup x{apply_time / vectorized_time:.1f}')
+
+
+def benchmark_make_excel(rows: int) -> None:
+    data_out = make_report_rows(rows)
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory, 'report.xlsx')
+        workbook_time, _ = measure(make_excel, data_out, path)
+        streaming_time, _ = measure(make_excel_streaming, data_out, path)
+        workbook_memory = measure_peak_memory(make_excel, data_out, path)
+        streaming_memory = measure_peak_memory(make_excel_streaming, data_out, path)
+    print(f'make_excel, {rows} rows: workbook {workbook_time:.2f} s / {workbook_memory / 2 ** 20:.0f} MB, '
+          f'streaming {streaming_time:.2f} s / {streaming_memory / 2 ** 20:.0f} MB')
+
+
+def run_suite(sizes: List[int], pages: int, report_rows: int) -> Dict[str, Any]:
+    results = {'timestamp': datetime.now().isoformat(timespec='seconds'),
+               'python': platform.python_version(),
+               'pandas': pd.__version__,
+               'stages': {}}
+    results['stages']['pages'] = run_parse_stages(pages)
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in sizes:
+            results['stages'][str(rows)] = run_size_stages(rows, report_rows, Path(directory))
+    return results
+
+
+def compare_with_baseline(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    # A stage regresses when its throughput drops or its peak memory grows by more than tolerance
+    regressions = []
+    for size, stages in results['stages'].items():
+        for name, result in stages.items():
+            base = baseline['stages'].get(size, {}).get(name)
+            if base is None:
+                continue
+            speed = result['rows_per_second'] / base['rows_per_second']
+            memory = result['peak_memory_mb'] / base['peak_memory_mb'] if base['peak_memory_mb'] else 1.0
+            print(f'{name:<24} {size:>9}: throughput x{speed:.2f}, peak memory x{memory:.2f}')
+            if speed < 1 - tolerance or memory > 1 + tolerance:
+                regressions.append(f'{name} ({size})')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--report-rows', type=int, default=100_000)
+    parser.add_argument('--suite', action='store_true',
+                        help='Measure every stage instead of comparing with the previous implementations')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='Apartments rows per suite run')
+    parser.add_argument('--pages', type=int, default=1000, help='Listing pages parsed by the suite')
+    parser.add_argument('--output', type=Path, help='Suite results JSON, default - benchmarks/<timestamp>.json')
+    parser.add_argument('--baseline', type=Path, help='Suite results JSON to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed relative regression')
+    args = parser.parse_args()
+
+    if args.suite:
+        suite_results = run_suite(args.sizes, args.pages, args.report_rows)
+        output = args.output or RESULTS_PATH.joinpath(f'{datetime.now():%Y%m%d_%H%M%S}.json')
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(suite_results, indent=2))
+        print(f'Results: {output}')
+        if args.baseline:
+            regressed_stages = compare_with_baseline(suite_results, json.loads(args.baseline.read_text()),
+                                                     args.tolerance)
+            if regressed_stages:
+                print(f'Regressions: {", ".join(regressed_stages)}')
+                sys.exit(1)
+    else:
+        benchmark_handle_dataframe(args.rows)
+        benchmark_filters(args.rows)
+        benchmark_top_n_per_day(args.rows)
+        benchmark_make_excel(args.report_rows)
@@ -0,0 +1,154 @@
+import json
+import sqlite3
+from datetime import (
+    datetime,
+    timedelta,
+)
+from pathlib import Path
+from threading import Lock
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+BASE_PATH = Path(__file__).parent.parent
+STATE_PATH = BASE_PATH.joinpath('cache').joinpath('crawl_state.sqlite')
+
+
+class CrawlState:
+    # Listing queue and page progress of the crawl, kept on disk so an interrupted run resumes where it stopped.
+    # A listing is pending until it is parsed, parsed until its row is written (then it is removed),
+    # failed until its next attempt and dead after max_attempts failures
+    def __init__(self,
+                 path: Path = STATE_PATH,
+                 max_attempts: int = 5,
+                 backoff: timedelta = timedelta(minutes=1),
+                 max_backoff: timedelta = timedelta(hours=1)) -> None:
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.run_id: Optional[int] = None
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(
+            """CREATE TABLE IF NOT EXISTS Runs (Run_Id INTEGER PRIMARY KEY,
+                                                Started_At TEXT NOT NULL,
+                                                Finished_At TEXT);
+               CREATE TABLE IF NOT EXISTS Pages (Run_Id INTEGER NOT NULL,
+                                                 Url TEXT NOT NULL,
+                                                 Done_At TEXT NOT NULL,
+                                                 PRIMARY KEY (Run_Id, Url));
+               CREATE TABLE IF NOT EXISTS Listings (Url TEXT PRIMARY KEY,
+                                                    Status TEXT NOT NULL,
+                                                    Attempts INTEGER NOT NULL DEFAULT 0,
+                                                    Next_Attempt_At TEXT,
+                                                    Last_Error TEXT,
+                                                    Items TEXT);
+               CREATE INDEX IF NOT EXISTS Listings_Status ON Listings (Status, Next_Attempt_At);""")
+
+    def start_run(self, resume: bool = True, max_age: timedelta = timedelta(hours=3)) -> int:
+        # The last unfinished run is continued if it started within max_age, so its done pages are not read again.
+        # Older runs are closed: the index has shifted since then and their pages hold other listings now
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                'SELECT Run_Id, Started_At FROM Runs WHERE Finished_At IS NULL ORDER BY Run_Id DESC LIMIT 1').fetchone()
+            if row is not None and resume and datetime.fromisoformat(row[1]) >= datetime.now() - max_age:
+                self.run_id = row[0]
+            else:
+                self.connection.execute('UPDATE Runs SET Finished_At = ? WHERE Finished_At IS NULL',
+                                        (datetime.now().isoformat(sep=' '),))
+                self.run_id = self.connection.execute('INSERT INTO Runs (Started_At) VALUES (?)',
+                                                      (datetime.now().isoformat(sep=' '),)).lastrowid
+        return self.run_id
+
+    def finish_run(self) -> None:
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE Runs SET Finished_At = ? WHERE Run_Id = ?',
+                                    (datetime.now().isoformat(sep=' '), self.run_id))
+            self.connection.execute('DELETE FROM Pages WHERE Run_Id = ?', (self.run_id,))
+
+    def is_page_done(self, url: str) -> bool:
+        with self.lock:
+            return self.connection.execute('SELECT 1 FROM Pages WHERE Run_Id = ? AND Url = ?',
+                                           (self.run_id, url)).fetchone() is not None
+
+    def mark_page_done(self, url: str) -> None:
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR IGNORE INTO Pages VALUES (?, ?, ?)',
+                                    (self.run_id, url, datetime.now().isoformat(sep=' ')))
+
+    def add_listings(self, urls: Iterable[str]) -> None:
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO Listings (Url, Status) VALUES (?, 'pending')",
+                                        ((i,) for i in urls))
+
+    def get_blocked(self, urls: Iterable[str]) -> Set[str]:
+        # Listings that are not parsed from a page again: waiting to be written, in the retry queue or dead
+        urls = list(urls)
+        blocked = set()
+        with self.lock:
+            for start in range(0, len(urls), 500):
+                chunk = urls[start:start + 500]
+                rows = self.connection.execute(
+                    f"""SELECT Url FROM Listings
+                        WHERE Url IN ({', '.join('?' * len(chunk))}) AND Status <> 'pending'""",
+                    chunk).fetchall()
+                blocked.update(i for i, in rows)
+        return blocked
+
+    def save_parsed(self, url: str, items: Dict[str, Any]) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                """INSERT INTO Listings (Url, Status, Items) VALUES (?, 'parsed', ?)
+                   ON CONFLICT (Url) DO UPDATE SET Status = 'parsed', Items = excluded.Items""",
+                (url, json.dumps(items, ensure_ascii=False, default=str)))
+
+    def mark_written(self, urls: Iterable[str]) -> None:
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM Listings WHERE Url = ?', ((i,) for i in urls))
+
+    def mark_failed(self, url: str, error: Exception) -> None:
+        # Exponential backoff: backoff, 2 * backoff, 4 * backoff ... up to max_backoff
+        with self.lock, self.connection:
+            row = self.connection.execute('SELECT Attempts FROM Listings WHERE Url = ?', (url,)).fetchone()
+            attempts = (row[0] if row else 0) + 1
+            status = 'dead' if attempts >= self.max_attempts else 'failed'
+            delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+            next_attempt_at = (datetime.now() + delay).isoformat(sep=' ')
+            self.connection.execute(
+                """INSERT INTO Listings (Url, Status, Attempts, Next_Attempt_At, Last_Error) VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT (Url) DO UPDATE SET Status = excluded.Status,
+                                                   Attempts = excluded.Attempts,
+                                                   Next_Attempt_At = excluded.Next_Attempt_At,
+                                                   Last_Error = excluded.Last_Error""",
+                (url, status, attempts, next_attempt_at, repr(error)))
+
+    def get_parsed(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            rows = self.connection.execute("SELECT Items FROM Listings WHERE Status = 'parsed'").fetchall()
+        return [json.loads(i) for i, in rows]
+
+    def get_queued(self, max_retries: int = None) -> List[Tuple[str, int]]:
+        # Pending listings of an interrupted run, then at most max_retries failed listings whose next attempt
+        # is due, the longest waiting first, with attempts made
+        with self.lock:
+            pending = self.connection.execute("SELECT Url, Attempts FROM Listings WHERE Status = 'pending'").fetchall()
+            failed = self.connection.execute(
+                """SELECT Url, Attempts FROM Listings
+                   WHERE Status = 'failed' AND Next_Attempt_At <= ?
+                   ORDER BY Next_Attempt_At
+                   LIMIT ?""",
+                (datetime.now().isoformat(sep=' '), -1 if max_retries is None else max_retries)).fetchall()
+        return pending + failed
+
+    def get_next_attempt_at(self) -> Optional[datetime]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT MIN(Next_Attempt_At) FROM Listings WHERE Status = 'failed'").fetchone()
+        return datetime.fromisoformat(row[0]) if row[0] else None
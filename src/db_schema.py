@@ -0,0 +1,83 @@
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Float,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    UniqueConstraint,
+)
+from sqlalchemy.engine import Engine
+
+# Tables used by downloader, recrawl, predictor, rescore and make_excel. On SQL Server they already exist,
+# local backends get them created by create_schema
+METADATA = MetaData()
+
+APARTMENTS = Table(
+    'Apartments', METADATA,
+    Column('Apartment_Key', Integer, primary_key=True, autoincrement=True),
+    Column('District', String(100)),
+    Column('Address', String(200)),
+    Column('Sales_Type', String(50)),
+    Column('Year_Building', String(10)),
+    Column('Material', String(50)),
+    Column('Floor_Numbers_Of_Floors', String(10)),
+    Column('Floors_In_Building', String(10)),
+    Column('Apartment_Type', String(50)),
+    Column('Price', Integer),
+    Column('Square_Total', String(20)),
+    Column('Square_Living', String(20)),
+    Column('Square_Kitchen', String(20)),
+    Column('Rooms_Number', String(10)),
+    Column('Apartment_Condition', String(50)),
+    Column('Bathroom_Type', String(50)),
+    Column('Balcony_Loggia', String(50)),
+    # Dates are kept as they are on the site: '%d.%m.%Y %H:%M:%S' and '%d.%m.%Y'
+    Column('Date_Add', String(20)),
+    Column('Date_Expiration', String(20)),
+    Column('Id', Integer, unique=True),
+    Column('Url_Link', String(200)),
+    Column('Download_timestamp', DateTime),
+)
+
+PREDICTIONS = Table(
+    'Predictions', METADATA,
+    Column('Apartment_Key', Integer, primary_key=True, autoincrement=False),
+    Column('Predict', Float),
+    Column('Error', Float),
+)
+
+PREDICTIONS_VERSIONS = Table(
+    'Predictions_Versions', METADATA,
+    Column('Model_Key', Integer, primary_key=True, autoincrement=False),
+    Column('Apartment_Key', Integer, primary_key=True, autoincrement=False),
+    Column('Predict', Float),
+    Column('Error', Float),
+)
+
+# Written by recrawl only when a known listing changed or was removed, Apartments keeps the first version
+PRICE_HISTORY = Table(
+    'Price_History', METADATA,
+    Column('Apartment_Key', Integer, primary_key=True, autoincrement=False),
+    Column('Observed_At', DateTime, primary_key=True),
+    Column('Price', Integer),
+    Column('Date_Expiration', String(20)),
+    Column('Is_Removed', Integer, default=0),
+)
+
+MODELS = Table(
+    'Models', METADATA,
+    Column('Model_Key', Integer, primary_key=True, autoincrement=True),
+    Column('Model_name', String(200)),
+    Column('Model_path', String(500)),
+    Column('Mean_absolute_error', Float),
+    Column('Rooms_Number', Integer),
+    Column('Model_features', String(4000)),
+    Column('Is_main', Integer, default=0),
+    UniqueConstraint('Model_name'),
+)
+
+
+def create_schema(engine: Engine) -> None:
+    METADATA.create_all(engine, checkfirst=True)
@@ -1,147 +1,771 @@
+import argparse
+import asyncio
 import logging
+import queue
+import threading
 import time
-from datetime import datetime
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+)
+from datetime import (
+    datetime,
+    timedelta,
+)
+from functools import (
+    lru_cache,
+    partial,
+)
 from pathlib import Path
 from random import randint
 from typing import (
     Any,
     Dict,
+    Iterable,
+    Iterator,
     List,
+    Optional,
     Set,
+    Tuple,
 )
+from urllib.parse import urlsplit
 
+import aiohttp
 import pandas as pd
 import requests
 from bs4 import BeautifulSoup
 from tqdm import tqdm
+from tqdm.asyncio import tqdm_asyncio
 
-from sql_connector import get_sqlalchemy_engine
+from crawl_state import CrawlState
+from html_cache import HtmlCache
+from id_index import (
+    IdIndex,
+    get_id_from_url,
+)
+from metrics import (
+    METRICS,
+    timed_call,
+)
+from parsers import (
+    PARSERS,
+    get_parser,
+)
+from sql_connector import (
+    bulk_insert,
+    cast_date,
+    get_sqlalchemy_engine,
+    read_sql_query,
+)
 
 SESSION = requests.Session()
 
-ENGINE = get_sqlalchemy_engine()
+URL_BASE = 'https://www.tomsk.ru09.ru'
+URL_PAGES = '/realty?type=1&otype=1&district[1]=on&district[2]=on&district[3]=on&district[4]=on&perpage=50&page='
+URL_APARTMENT_MARKER = 'subaction=detail'
+
+# Listing pages fetched recently (e.g. before a failed parse) are taken from the cache
+APARTMENT_CACHE_MAX_AGE = timedelta(days=1)
+
+# Parser backend from parsers.PARSERS, set by APARTMENT_PARSER or --parser
+PARSE_APARTMENT_HTML = get_parser()
+
+# Saved rows are collected here when main is asked to hand them over to the next stage
+KEPT_APARTMENTS: Optional[List[pd.DataFrame]] = None
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        # Takes a token, borrowing it from the future if the bucket is empty,
+        # and returns how long the caller must wait before using it
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+
+class IncrementalStop:
+    def __init__(self, watermark: Optional[datetime], max_pages_without_new: int) -> None:
+        self.watermark = watermark
+        self.max_pages_without_new = max_pages_without_new
+        self.pages_without_new = 0
+
+    def is_past_watermark(self, apartments: List[Dict[str, Any]]) -> bool:
+        if self.watermark is None or not apartments:
+            return False
+        dates_add = pd.to_datetime([i['Date_Add'] for i in apartments], format='%d.%m.%Y %H:%M:%S', errors='coerce')
+        return dates_add.max() < self.watermark
+
+    def update(self,
+               urls_apartments: Set[str],
+               urls_apartments_to_parse: Set[str],
+               apartments: List[Dict[str, Any]]) -> bool:
+        # Pages are sorted newest first, so the crawl stops after the last page with unseen listings
+        if not urls_apartments:
+            return True
+        if not urls_apartments_to_parse:
+            self.pages_without_new += 1
+            return self.pages_without_new >= self.max_pages_without_new
+        self.pages_without_new = 0
+        return self.is_past_watermark(apartments)
+
+
+class HostRateLimiter:
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.buckets: Dict[str, TokenBucket] = {}
+
+    def reserve(self, url: str) -> float:
+        host = urlsplit(url).netloc
+        if host not in self.buckets:
+            self.buckets.setdefault(host, TokenBucket(self.rate, self.capacity))
+        return self.buckets[host].reserve()
+
+    async def acquire(self, url: str) -> None:
+        await asyncio.sleep(self.reserve(url))
+
+    def wait(self, url: str) -> None:
+        time.sleep(self.reserve(url))
+
+
+def get_html_by_url(url: str, max_age: Optional[timedelta] = None) -> str:
+    html = get_cache().get(url, max_age) if max_age is not None else None
+    if html is None:
+        with METRICS.timer('fetch_seconds'):
+            response = SESSION.get(url)
+        METRICS.inc('http_responses_total', status=str(response.status_code))
+        # Error responses are not cached, the listing goes to the retry queue instead
+        response.raise_for_status()
+        html = response.text
+        get_cache().put(url, html)
+    else:
+        METRICS.inc('cache_hits_total')
+    return html
+
+
+def parse_apartment_html(html: str, url: str) -> Dict[str, Any]:
+    items, seconds = timed_call(PARSE_APARTMENT_HTML, html, url)
+    METRICS.observe('parse_seconds', seconds)
+    return items
 
 
-def get_soup_by_url(url: str) -> BeautifulSoup:
-    html = SESSION.get(url).text
+def get_soup_by_url(url: str, max_age: Optional[timedelta] = None) -> BeautifulSoup:
+    html = get_html_by_url(url, max_age)
     soup = BeautifulSoup(html, 'lxml')
     return soup
 
 
-def get_number_last_page() -> int:
-    soup = get_soup_by_url(
-        'https://www.tomsk.ru09.ru/'
-        'realty?type=1&otype=1&district[1]=on&district[2]=on&district[3]'
-        '=on&district[4]=on&perpage=50&page=1')
+def get_number_last_page(url_base: str = URL_BASE) -> int:
+    soup = get_soup_by_url(url_base + URL_PAGES + '1')
     return int(soup.find('td', {'class': 'pager_pages'}).find_all('a')[4].text)
 
 
-def find_district_field(keys: List[str]) -> int:
-    for i, j in enumerate(keys):
-        if ' район' in j:
-            return i
-
-
-def rename_keys_of_list(list_with_keys: List[str]) -> List[str]:
-    rename_map = {'адрес': 'Address',
-                  'вид': 'Sales_Type',
-                  'год постройки': 'Year_Building',
-                  'материал': 'Material',
-                  'этаж/этажность': 'Floor_Numbers_Of_Floors',
-                  'этажность': 'Floors_In_Building',
-                  'тип квартиры': 'Apartment_Type',
-                  'общая площадь': 'Square_Total',
-                  'жилая': 'Square_Living',
-                  'кухня': 'Square_Kitchen',
-                  'количество комнат': 'Rooms_Number',
-                  'отделка': 'Apartment_Condition',
-                  'санузел': 'Bathroom_Type',
-                  'балкон/лоджия': 'Balcony_Loggia'}
-    ranamed_list = []
-    for key in list_with_keys:
-        ranamed_list.append(key.replace(key, rename_map[key]))
-    return ranamed_list
-
-
-def parse_apartment(url: str) -> Dict[str, Any]:
-    soup = get_soup_by_url(url)
-
-    keys = [i.find('span').text.replace('\xa0', '').lower() for i in
-            soup.find_all('tr', {'class': 'realty_detail_attr'})]
-    district_idx = find_district_field(keys)
-    items = {'District': keys[district_idx]}
-    keys = [j for i, j in enumerate(keys) if i not in (district_idx - 1, district_idx)]
-    keys = rename_keys_of_list(keys)
-    values = [i.text.replace('\xa0', ' ') for i in soup.find_all(class_='nowrap')]
-
-    items.update(dict(zip(keys, values)))
-
-    items['Address'] = soup.find(class_='table_map_link').text.replace('\xa0', ' ')
-    items['Price'] = int(
-        soup.find('div', {'class': 'realty_detail_price inline'}).text.replace('\xa0', '').replace('руб.', ''))
-    items['Id'] = int(soup.find('strong').text)
-    items['Date_Add'] = soup.find(class_='realty_detail_date nobr').get('title')
-    items['Date_Expiration'] = soup.find_all(class_='realty_detail_date')[4].get('title')
-    items['Url_Link'] = url
-    return items
+def parse_apartment(url: str, max_age: Optional[timedelta] = APARTMENT_CACHE_MAX_AGE) -> Dict[str, Any]:
+    return parse_apartment_html(get_html_by_url(url, max_age), url)
 
 
-def get_urls_pages(start_page: int = 1, end_page: int = None) -> List[str]:
-    url_base = 'https://www.tomsk.ru09.ru/' \
-               'realty?type=1&otype=1&district[1]=on&district[2]=on&district[3]=on&district[4]=on&perpage=50&page='
+def parse_listing(url: str, max_age: Optional[timedelta] = APARTMENT_CACHE_MAX_AGE) -> Optional[Dict[str, Any]]:
+    # Parsed rows are kept in the crawl state until they are written, failed listings go to the retry queue
+    try:
+        items = parse_apartment(url, max_age)
+    except Exception as e:
+        get_state().mark_failed(url, e)
+        log_bad_link(url, e)
+        return None
+    get_state().save_parsed(url, items)
+    return items
 
-    end_page = end_page or get_number_last_page()
+
+def get_urls_pages(start_page: int = 1, end_page: int = None, url_base: str = URL_BASE) -> List[str]:
+    end_page = end_page or get_number_last_page(url_base)
     pages_to_parse = range(start_page, end_page + 1)
-    urls_pages = [url_base + str(i) for i in pages_to_parse]
+    urls_pages = [url_base + URL_PAGES + str(i) for i in pages_to_parse]
     return urls_pages
 
 
-def get_urls_apartments_by_page(url_page: str) -> Set[str]:
-    url_base = 'https://www.tomsk.ru09.ru'
+def iter_urls_pages(start_page: int = 1, end_page: int = None, url_base: str = URL_BASE) -> Iterator[str]:
+    # Without end_page pages are yielded until the caller stops, the pager is never fetched
+    page = start_page
+    while end_page is None or page <= end_page:
+        yield url_base + URL_PAGES + str(page)
+        page += 1
+
+
+def get_urls_apartments_by_soup(soup: BeautifulSoup, url_page: str) -> Set[str]:
+    url_page = urlsplit(url_page)
+    url_base = f'{url_page.scheme}://{url_page.netloc}'
 
-    soup = get_soup_by_url(url_page)
     soup = soup.find_all('a', {'class': 'visited_ads'})
 
     urls_apartments = {url_base + i.get('href') for i in soup}
     return urls_apartments
 
 
-def main(start_page: int = 1, end_page: int = None) -> None:
+def get_urls_apartments_by_page(url_page: str) -> Set[str]:
+    return get_urls_apartments_by_soup(get_soup_by_url(url_page), url_page)
+
+
+@lru_cache()
+def get_cache() -> HtmlCache:
+    # Opened on first use, importing the module does not touch the disk
+    return HtmlCache()
+
+
+@lru_cache()
+def get_state() -> CrawlState:
+    return CrawlState()
+
+
+def get_id_index() -> IdIndex:
+    # The persisted index is topped up with rows inserted since the last run instead of a full Url_Link scan
+    id_index = IdIndex()
+    id_index.sync(get_sqlalchemy_engine())
+    return id_index
+
+
+def get_urls_to_parse(urls_apartments: Set[str], id_index: IdIndex) -> Set[str]:
+    return {i for i in urls_apartments if get_id_from_url(i) not in id_index}
+
+
+def queue_page(url_page: str, urls_apartments: Set[str], id_index: IdIndex) -> Set[str]:
+    # Listings of the page are queued in the crawl state before they are parsed,
+    # so after a restart the page is skipped and its unparsed listings are taken from the queue
+    urls_apartments_to_parse = get_urls_to_parse(urls_apartments, id_index)
+    urls_apartments_to_parse -= get_state().get_blocked(urls_apartments_to_parse)
+    get_state().add_listings(urls_apartments_to_parse)
+    get_state().mark_page_done(url_page)
+    return urls_apartments_to_parse
+
+
+def skip_done_pages(urls_pages: Iterable[str]) -> Iterator[str]:
+    # New listings push older ones down the index, so the first page is read again even if it is done
+    for i, url_page in enumerate(urls_pages):
+        if i == 0 or not get_state().is_page_done(url_page):
+            yield url_page
+
+
+def get_date_add_watermark() -> Optional[datetime]:
+    # Date_Add is site text '%d.%m.%Y %H:%M:%S', a text MAX would pick the largest day of the month.
+    # The latest day is found on the cast date, the latest time within it after parsing
+    engine = get_sqlalchemy_engine()
+    date_add = cast_date(engine, 'Date_Add')
+    query = f"""SELECT Date_Add
+                FROM Apartments
+                WHERE {date_add} = (SELECT MAX({date_add}) FROM Apartments)"""
+    dates_add = pd.to_datetime(read_sql_query(query, engine)['Date_Add'], format='%d.%m.%Y %H:%M:%S', errors='coerce')
+    return None if dates_add.isna().all() else dates_add.max()
+
+
+def log_bad_link(url: str, e: Exception) -> None:
+    METRICS.inc('bad_links_total')
+    with open(Path(__file__).parent.parent.joinpath('logs').joinpath('bad_links.txt'), 'a') as f:
+        f.write(f'{url} -- {e}\n')
+        logging.exception(e)
+
+
+def save_apartments(list_to_dataframe: List[Dict[str, Any]], id_index: IdIndex) -> None:
+    df = pd.DataFrame(list_to_dataframe)
+    df['Download_timestamp'] = datetime.now()
+    with METRICS.stage('save_apartments', len(df)):
+        bulk_insert(df, 'Apartments', get_sqlalchemy_engine(), key_columns=['Id'], schema='dbo')
+    id_index.add(i['Id'] for i in list_to_dataframe)
+    get_state().mark_written(i['Url_Link'] for i in list_to_dataframe)
+    if KEPT_APARTMENTS is not None:
+        KEPT_APARTMENTS.append(df)
+
+
+def get_kept_apartments(last_apartment_key: int) -> pd.DataFrame:
+    # Only the keys the database gave to the rows of this run are read, the rows themselves are already here
+    kept = pd.concat(KEPT_APARTMENTS, ignore_index=True).drop_duplicates('Id', keep='last')
+    keys = read_sql_query(f'SELECT Apartment_Key, Id FROM Apartments WHERE Apartment_Key > {int(last_apartment_key)}',
+                          get_sqlalchemy_engine())
+    return kept.merge(keys, on='Id').set_index('Apartment_Key')
+
+
+def reparse_from_cache(date_from: datetime, date_to: datetime) -> pd.DataFrame:
+    list_to_dataframe = []
+    for url, fetched_at, html in get_cache().iter_responses(date_from, date_to, f'%{URL_APARTMENT_MARKER}%'):
+        try:
+            items = parse_apartment_html(html, url)
+        except Exception as e:
+            log_bad_link(url, e)
+            continue
+        items['Download_timestamp'] = fetched_at
+        list_to_dataframe.append(items)
+    return pd.DataFrame(list_to_dataframe)
+
+
+def main_reparse(date_from: datetime, date_to: datetime) -> None:
+    # Backfill listings that are cached but missing in the database, no requests are made
+    with METRICS.stage('reparse') as stage:
+        df = reparse_from_cache(date_from, date_to)
+        stage.rows = len(df)
+    if not df.empty:
+        id_index = get_id_index()
+        df = df[~id_index.isin(df['Id'])]
+        bulk_insert(df, 'Apartments', get_sqlalchemy_engine(), key_columns=['Id'], schema='dbo')
+        id_index.add(df['Id'])
+        id_index.save()
+    print(f'Reparsed Apartments: {len(df)}')
+    logging.info(f'Reparsed Apartments: {len(df)}')
+
+
+async def fetch_html(session: aiohttp.ClientSession,
+                     url: str,
+                     limiter: HostRateLimiter,
+                     semaphore: asyncio.Semaphore,
+                     max_age: Optional[timedelta] = None) -> str:
+    html = get_cache().get(url, max_age) if max_age is not None else None
+    if html is not None:
+        METRICS.inc('cache_hits_total')
+        return html
+    async with semaphore:
+        await limiter.acquire(url)
+        with METRICS.timer('fetch_seconds'):
+            async with session.get(url) as response:
+                html = await response.text()
+        METRICS.inc('http_responses_total', status=str(response.status))
+        response.raise_for_status()
+    get_cache().put(url, html)
+    return html
+
+
+async def parse_apartments_async(session: aiohttp.ClientSession,
+                                 urls_apartments: Set[str],
+                                 limiter: HostRateLimiter,
+                                 semaphore: asyncio.Semaphore) -> List[Dict[str, Any]]:
+    async def parse_one(url_apartment: str) -> Optional[Dict[str, Any]]:
+        try:
+            html = await fetch_html(session, url_apartment, limiter, semaphore, APARTMENT_CACHE_MAX_AGE)
+            items = parse_apartment_html(html, url_apartment)
+        except Exception as e:
+            get_state().mark_failed(url_apartment, e)
+            log_bad_link(url_apartment, e)
+            return None
+        get_state().save_parsed(url_apartment, items)
+        return items
+
+    apartments = await tqdm_asyncio.gather(*(parse_one(i) for i in urls_apartments),
+                                           desc='Apartments', leave=False, ascii=True)
+    return [i for i in apartments if i is not None]
+
+
+async def crawl_async(urls_pages: Iterable[str],
+                      id_index: IdIndex,
+                      concurrency: int,
+                      rate: float,
+                      burst: float,
+                      stop: IncrementalStop = None) -> int:
+    limiter = HostRateLimiter(rate, burst)
+    semaphore = asyncio.Semaphore(concurrency)
+    new_apartments = 0
+    async with aiohttp.ClientSession() as session:
+        for url_page in tqdm(urls_pages, desc='Pages', leave=False, ascii=True):
+            html = await fetch_html(session, url_page, limiter, semaphore)
+            urls_apartments = get_urls_apartments_by_soup(BeautifulSoup(html, 'lxml'), url_page)
+            urls_apartments_to_parse = queue_page(url_page, urls_apartments, id_index)
+            list_to_dataframe = []
+            if urls_apartments_to_parse:
+                list_to_dataframe = await parse_apartments_async(session, urls_apartments_to_parse, limiter, semaphore)
+                new_apartments += len(list_to_dataframe)
+                await asyncio.to_thread(save_apartments, list_to_dataframe, id_index)
+            if stop is not None and stop.update(urls_apartments, urls_apartments_to_parse, list_to_dataframe):
+                break
+    return new_apartments
 
-    urls_in_database = pd.read_sql('SELECT DISTINCT Url_Link FROM Apartment_Tomsk.dbo.Apartments', ENGINE)
-    urls_in_database = set(urls_in_database['Url_Link'])
 
-    len_storage = len(urls_in_database)
-    print('Apartments in storage:', len_storage, '\n')
-    logging.info(f'Apartments in storage: {len_storage}')
+def crawl(urls_pages: Iterable[str], id_index: IdIndex, stop: IncrementalStop = None) -> int:
     new_apartments = 0
-    urls_pages = get_urls_pages(start_page, end_page)
     for url_page in tqdm(urls_pages, desc='Pages', leave=False, ascii=True):
         urls_apartments = get_urls_apartments_by_page(url_page)
-        urls_apartments_to_parse = urls_apartments.difference(urls_in_database)
+        urls_apartments_to_parse = queue_page(url_page, urls_apartments, id_index)
+        list_to_dataframe = []
         if urls_apartments_to_parse:
-            list_to_dataframe = []
             for url_apartment in tqdm(urls_apartments_to_parse, desc='Apartments', leave=False, ascii=True):
-                try:
-                    list_to_dataframe.append(parse_apartment(url_apartment))
-                except Exception as e:
-                    with open(Path(__file__).parent.parent.joinpath('logs').joinpath('bad_links.txt'), 'a') as f:
-                        f.write(f'{url_apartment} -- {e}\n')
-                        logging.exception(e)
-                finally:
-                    time.sleep(randint(1, 4))
+                items = parse_listing(url_apartment)
+                if items is not None:
+                    list_to_dataframe.append(items)
+                time.sleep(randint(1, 4))
             new_apartments += len(list_to_dataframe)
-            df = pd.DataFrame(list_to_dataframe)
-            df['Download_timestamp'] = datetime.now()
-            df.to_sql(name='Apartments', con=ENGINE, schema='dbo', if_exists='append', index=False)
+            save_apartments(list_to_dataframe, id_index)
             SESSION.close()
+        if stop is not None and stop.update(urls_apartments, urls_apartments_to_parse, list_to_dataframe):
+            break
         time.sleep(randint(1, 4))
+    return new_apartments
+
+
+def write_parsed(id_index: IdIndex) -> int:
+    # Rows parsed before an interruption but not written yet, rows that reached the database are only dequeued
+    parsed = get_state().get_parsed()
+    list_to_dataframe = [i for i in parsed if i['Id'] not in id_index]
+    get_state().mark_written(i['Url_Link'] for i in parsed if i['Id'] in id_index)
+    if list_to_dataframe:
+        save_apartments(list_to_dataframe, id_index)
+    return len(list_to_dataframe)
+
+
+def crawl_queue(id_index: IdIndex,
+                limiter: HostRateLimiter,
+                max_retries: int = None,
+                batch_size: int = 50) -> Tuple[int, int]:
+    # Pending listings of an interrupted run and at most max_retries failed listings due for another attempt.
+    # A retry fetches the page again instead of reading it from the cache. Returns new apartments and retries made
+    new_apartments = 0
+    retries = 0
+    list_to_dataframe = []
+    queued = get_state().get_queued(max_retries)
+    for url_apartment, attempts in tqdm(queued, desc='Queued apartments', leave=False, ascii=True):
+        if get_id_from_url(url_apartment) in id_index:
+            get_state().mark_written([url_apartment])
+            continue
+        retries += attempts > 0
+        limiter.wait(url_apartment)
+        items = parse_listing(url_apartment, APARTMENT_CACHE_MAX_AGE if attempts == 0 else None)
+        if items is not None:
+            list_to_dataframe.append(items)
+        if len(list_to_dataframe) >= batch_size:
+            save_apartments(list_to_dataframe, id_index)
+            new_apartments += len(list_to_dataframe)
+            list_to_dataframe = []
+    if list_to_dataframe:
+        save_apartments(list_to_dataframe, id_index)
+        new_apartments += len(list_to_dataframe)
+    return new_apartments, retries
+
 
+def crawl_retries(id_index: IdIndex, limiter: HostRateLimiter, retry_wait: timedelta, max_retries: int) -> int:
+    # Retries due within retry_wait are waited for until max_retries are made, the rest are left to the next run,
+    # so listings that keep failing add at most max_retries requests to every run until they are dead
+    new_apartments = 0
+    while max_retries > 0:
+        apartments, retries = crawl_queue(id_index, limiter, max_retries)
+        new_apartments += apartments
+        max_retries -= retries
+        next_attempt_at = get_state().get_next_attempt_at()
+        if max_retries <= 0 or next_attempt_at is None or next_attempt_at - datetime.now() > retry_wait:
+            break
+        time.sleep(max(0.0, (next_attempt_at - datetime.now()).total_seconds()))
+    return new_apartments
+
+
+class Pipeline:
+    # Fetcher threads -> process pool of parsers -> single batching writer, connected by bounded queues
+    def __init__(self,
+                 id_index: IdIndex,
+                 fetchers: int = 8,
+                 parsers: int = None,
+                 queue_size: int = 100,
+                 batch_size: int = 50,
+                 flush_interval: float = 30.0,
+                 rate: float = 1.0,
+                 burst: float = 2.0,
+                 report_interval: float = 10.0) -> None:
+        self.id_index = id_index
+        self.fetchers = fetchers
+        self.parsers = parsers
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.report_interval = report_interval
+        self.limiter = HostRateLimiter(rate, burst)
+
+        self.urls_queue = queue.Queue(queue_size)
+        self.html_queue = queue.Queue(queue_size)
+        self.rows_queue = queue.Queue(queue_size)
+        self.parse_slots = threading.BoundedSemaphore(queue_size)
+        self.parsing = 0
+        self.parsing_lock = threading.Lock()
+        self.finished = threading.Event()
+        # Set when dispatch fails, upstream stages then only drain their queues
+        self.stopped = threading.Event()
+        self.new_apartments = 0
+        self.error: Optional[Exception] = None
+
+    def get_queue_depth(self) -> Dict[str, int]:
+        return {'urls': self.urls_queue.qsize(),
+                'html': self.html_queue.qsize(),
+                'parsing': self.parsing,
+                'rows': self.rows_queue.qsize()}
+
+    def get_html(self, session: requests.Session, url: str, max_age: Optional[timedelta] = None) -> str:
+        html = get_cache().get(url, max_age) if max_age is not None else None
+        if html is None:
+            self.limiter.wait(url)
+            with METRICS.timer('fetch_seconds'):
+                response = session.get(url)
+            METRICS.inc('http_responses_total', status=str(response.status_code))
+            response.raise_for_status()
+            html = response.text
+            get_cache().put(url, html)
+        else:
+            METRICS.inc('cache_hits_total')
+        return html
+
+    def produce(self, urls_pages: Iterable[str], stop: IncrementalStop = None) -> None:
+        session = requests.Session()
+        queued = set()
+        try:
+            for url_page in tqdm(urls_pages, desc='Pages', leave=False, ascii=True):
+                if self.stopped.is_set():
+                    break
+                html = self.get_html(session, url_page)
+                urls_apartments = get_urls_apartments_by_soup(BeautifulSoup(html, 'lxml'), url_page)
+                urls_apartments_to_parse = queue_page(url_page, urls_apartments, self.id_index).difference(queued)
+                for url_apartment in urls_apartments_to_parse:
+                    self.urls_queue.put(url_apartment)
+                queued.update(urls_apartments_to_parse)
+                # Parsed rows are not available here, so only the "no unseen listings" rule applies
+                if stop is not None and stop.update(urls_apartments, urls_apartments_to_parse, []):
+                    break
+        except Exception as e:
+            logging.exception(e)
+            self.error = e
+        finally:
+            for _ in range(self.fetchers):
+                self.urls_queue.put(None)
+
+    def fetch(self) -> None:
+        session = requests.Session()
+        while True:
+            url_apartment = self.urls_queue.get()
+            if url_apartment is None:
+                self.html_queue.put(None)
+                return
+            if self.stopped.is_set():
+                continue
+            try:
+                self.html_queue.put((url_apartment, self.get_html(session, url_apartment, APARTMENT_CACHE_MAX_AGE)))
+            except Exception as e:
+                get_state().mark_failed(url_apartment, e)
+                log_bad_link(url_apartment, e)
+
+    def on_parsed(self, url_apartment: str, future: Future) -> None:
+        try:
+            items, seconds = future.result()
+            METRICS.observe('parse_seconds', seconds)
+            get_state().save_parsed(url_apartment, items)
+            self.rows_queue.put(items)
+        except Exception as e:
+            get_state().mark_failed(url_apartment, e)
+            log_bad_link(url_apartment, e)
+        finally:
+            with self.parsing_lock:
+                self.parsing -= 1
+            self.parse_slots.release()
+
+    def dispatch(self, executor: ProcessPoolExecutor) -> None:
+        # Runs until every fetcher has sent its sentinel, after a failure the remaining pages are drained
+        # without parsing, so the fetchers and the producer are never left blocked on full queues.
+        # Listings that are not parsed stay pending in the crawl state
+        finished_fetchers = 0
+        while finished_fetchers < self.fetchers:
+            item = self.html_queue.get()
+            if item is None:
+                finished_fetchers += 1
+                continue
+            if self.stopped.is_set():
+                continue
+            url_apartment, html = item
+            self.parse_slots.acquire()
+            with self.parsing_lock:
+                self.parsing += 1
+            try:
+                # Parse time is measured in the worker, queueing for a free process is not counted
+                future = executor.submit(timed_call, PARSE_APARTMENT_HTML, html, url_apartment)
+            except Exception as e:
+                # E.g. BrokenProcessPool after a parser process died
+                with self.parsing_lock:
+                    self.parsing -= 1
+                self.parse_slots.release()
+                logging.exception(e)
+                self.error = e
+                self.stopped.set()
+                continue
+            future.add_done_callback(partial(self.on_parsed, url_apartment))
+        # All slots are free again only when every submitted page is parsed
+        for _ in range(self.queue_size):
+            self.parse_slots.acquire()
+        self.rows_queue.put(None)
+
+    def flush(self, batch: List[Dict[str, Any]]) -> None:
+        try:
+            save_apartments(batch, self.id_index)
+            self.new_apartments += len(batch)
+        except Exception as e:
+            # Keep draining the queue, otherwise the upstream stages block forever
+            logging.exception(e)
+            self.error = e
+
+    def write(self) -> None:
+        batch = []
+        flushed_at = time.monotonic()
+        finished = False
+        while not finished:
+            try:
+                row = self.rows_queue.get(timeout=self.flush_interval)
+                if row is None:
+                    finished = True
+                else:
+                    batch.append(row)
+            except queue.Empty:
+                pass
+            is_flush_time = time.monotonic() - flushed_at >= self.flush_interval
+            if batch and (finished or len(batch) >= self.batch_size or is_flush_time):
+                self.flush(batch)
+                batch = []
+                flushed_at = time.monotonic()
+
+    def report(self) -> None:
+        while not self.finished.wait(self.report_interval):
+            logging.info(f'Queue depth: {self.get_queue_depth()}, new apartments: {self.new_apartments}')
+
+    def run(self, urls_pages: Iterable[str], stop: IncrementalStop = None) -> int:
+        with ProcessPoolExecutor(self.parsers) as executor:
+            threads = [threading.Thread(target=self.produce, args=(urls_pages, stop))]
+            threads += [threading.Thread(target=self.fetch) for _ in range(self.fetchers)]
+            threads += [threading.Thread(target=self.dispatch, args=(executor,)),
+                        threading.Thread(target=self.write)]
+            threading.Thread(target=self.report, daemon=True).start()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.finished.set()
+        if self.error is not None:
+            raise self.error
+        return self.new_apartments
+
+
+def main(start_page: int = 1,
+         end_page: int = None,
+         mode: str = 'sequential',
+         concurrency: int = 8,
+         rate: float = 1.0,
+         burst: float = 2.0,
+         url_base: str = URL_BASE,
+         incremental: bool = False,
+         max_pages_without_new: int = 2,
+         parsers: int = None,
+         batch_size: int = 50,
+         flush_interval: float = 30.0,
+         keep_new_rows: bool = False,
+         resume: bool = True,
+         resume_max_age: float = 3.0,
+         max_attempts: int = 5,
+         retry_backoff: float = 60.0,
+         retry_wait: float = 120.0,
+         max_retries: int = 50) -> Optional[pd.DataFrame]:
+    # mode: sequential - one request at a time with random sleeps,
+    #       async - asyncio crawler with concurrency in-flight requests,
+    #       pipeline - concurrency fetcher threads, a process pool of parsers and a batching writer.
+    # async and pipeline are limited by a per-host token bucket.
+    # incremental walks pages from start_page until nothing new is found or Date_Add watermark is passed.
+    # keep_new_rows returns the saved rows indexed by Apartment_Key.
+    # Parsed rows and queued listings left by an interrupted run are always written and parsed first.
+    # The run itself is resumed, skipping its done pages except the first, if it started within
+    # resume_max_age hours and resume is not False. Failed listings are retried after retry_backoff seconds,
+    # doubled on every attempt, up to max_attempts; retries due within retry_wait seconds are waited for.
+    # At most max_retries failed listings are retried per run
+    global KEPT_APARTMENTS
+    id_index = get_id_index()
+    KEPT_APARTMENTS = [] if keep_new_rows else None
+
+    len_storage = len(id_index)
+    print('Apartments in storage:', len_storage, '\n')
+    logging.info(f'Apartments in storage: {len_storage}')
+    if incremental:
+        watermark = get_date_add_watermark()
+        logging.info(f'Date_Add watermark: {watermark}')
+        stop = IncrementalStop(watermark, max_pages_without_new)
+        urls_pages = iter_urls_pages(start_page, end_page, url_base)
+    else:
+        stop = None
+        urls_pages = get_urls_pages(start_page, end_page, url_base)
+
+    # Both are opened here, before any fetcher thread asks for them
+    state, cache = get_state(), get_cache()
+    state.max_attempts = max_attempts
+    state.backoff = timedelta(seconds=retry_backoff)
+    run_id = state.start_run(resume, timedelta(hours=resume_max_age))
+    logging.info(f'Crawl run: {run_id}')
+    urls_pages = skip_done_pages(urls_pages)
+    limiter = HostRateLimiter(rate, burst)
+    with METRICS.stage('download') as stage:
+        recovered_apartments = write_parsed(id_index)
+        queued_apartments, retries = crawl_queue(id_index, limiter, max_retries)
+        recovered_apartments += queued_apartments
+        logging.info(f'Recovered apartments: {recovered_apartments}')
+        if mode == 'async':
+            new_apartments = asyncio.run(crawl_async(urls_pages, id_index, concurrency, rate, burst, stop))
+        elif mode == 'pipeline':
+            pipeline = Pipeline(id_index, concurrency, parsers, batch_size=batch_size, flush_interval=flush_interval,
+                                rate=rate, burst=burst)
+            new_apartments = pipeline.run(urls_pages, stop)
+        else:
+            new_apartments = crawl(urls_pages, id_index, stop)
+        new_apartments += recovered_apartments + crawl_retries(id_index, limiter, timedelta(seconds=retry_wait),
+                                                               max_retries - retries)
+        stage.rows = new_apartments
+    state.finish_run()
+
+    id_index.save()
     print(f'New Apartments: {new_apartments}')
     logging.info(f'New Apartments: {new_apartments}')
+    logging.info(f'Evicted cached responses: {cache.evict()}')
+    if keep_new_rows:
+        new_rows = get_kept_apartments(id_index.last_apartment_key) if KEPT_APARTMENTS else pd.DataFrame()
+        KEPT_APARTMENTS = None
+        return new_rows
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--start-page', type=int, default=1)
+    parser.add_argument('--end-page', type=int, default=40, help='Last page, an upper bound in incremental mode')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Stop at the first pages without unseen listings or past the Date_Add watermark')
+    parser.add_argument('--max-pages-without-new', type=int, default=2)
+    parser.add_argument('--mode', choices=['sequential', 'async', 'pipeline'], default='sequential')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Number of in-flight requests (async) or fetcher threads (pipeline)')
+    parser.add_argument('--parsers', type=int, help='Parser processes in pipeline mode, default - CPU count')
+    parser.add_argument('--batch-size', type=int, default=50, help='Rows per write in pipeline mode')
+    parser.add_argument('--flush-interval', type=float, default=30.0,
+                        help='Seconds between writes in pipeline mode')
+    parser.add_argument('--rate', type=float, default=1.0, help='Requests per second per host')
+    parser.add_argument('--burst', type=float, default=2.0, help='Token bucket capacity per host')
+    parser.add_argument('--url-base', default=URL_BASE, help='Site root, e.g. a local fixture server')
+    parser.add_argument('--parser', choices=list(PARSERS), help='Listing parser backend')
+    parser.add_argument('--reparse-from', type=datetime.fromisoformat,
+                        help='Rebuild rows from cached pages fetched since this date instead of crawling')
+    parser.add_argument('--reparse-to', type=datetime.fromisoformat, default=datetime.now())
+    parser.add_argument('--no-resume', action='store_true',
+                        help='Start a new crawl run even if the last one was interrupted')
+    parser.add_argument('--resume-max-age', type=float, default=3.0,
+                        help='Hours since its start within which an interrupted run is resumed')
+    parser.add_argument('--max-attempts', type=int, default=5, help='Attempts before a failed listing is given up')
+    parser.add_argument('--retry-backoff', type=float, default=60.0,
+                        help='Seconds before the first retry of a failed listing, doubled on every attempt')
+    parser.add_argument('--retry-wait', type=float, default=120.0,
+                        help='Seconds to wait at the end of the run for retries that become due')
+    parser.add_argument('--max-retries', type=int, default=50,
+                        help='Failed listings retried per run, the rest are retried by the next runs')
+    parser.add_argument('--profile-stage', help='Run this stage under cProfile, e.g. download or save_apartments')
+    args = parser.parse_args()
+    PARSE_APARTMENT_HTML = get_parser(args.parser)
+    METRICS.profile_stage = args.profile_stage or METRICS.profile_stage
+
     log_file = Path(__file__).parent.parent.joinpath('logs').joinpath('downloader.txt')
     logging.basicConfig(
         format='[%(asctime)s] -- %(levelname).3s -- %(message)s',
@@ -151,6 +775,14 @@ if __name__ == '__main__':
 
     logging.info('Download start')
     try:
-        main(end_page=40)
+        if args.reparse_from:
+            main_reparse(args.reparse_from, args.reparse_to)
+        else:
+            main(args.start_page, args.end_page, args.mode, args.concurrency, args.rate, args.burst, args.url_base,
+                 args.incremental, args.max_pages_without_new, args.parsers, args.batch_size, args.flush_interval,
+                 resume=not args.no_resume, resume_max_age=args.resume_max_age, max_attempts=args.max_attempts,
+                 retry_backoff=args.retry_backoff, retry_wait=args.retry_wait, max_retries=args.max_retries)
     except Exception as E:
         logging.exception(E)
+    finally:
+        METRICS.write('downloader')
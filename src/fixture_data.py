@@ -0,0 +1,96 @@
+from typing import (
+    Any,
+    Dict,
+)
+
+import numpy as np
+import pandas as pd
+
+from parsers import rename_keys_of_list
+
+# Listing attribute labels as they are shown on the site, in the order of the page
+SITE_KEYS = ['адрес', 'вид', 'год постройки', 'материал', 'этаж/этажность', 'этажность', 'тип квартиры',
+             'общая площадь', 'жилая', 'кухня', 'количество комнат', 'отделка', 'санузел', 'балкон/лоджия']
+
+DISTRICTS = ['кировский район', 'ленинский район', 'советский район', 'октябрьский район']
+MATERIALS = ['кирпич', 'панель', 'монолит', 'дерево', None]
+CONDITIONS = ['в отличном состоянии', 'в хорошем состоянии', 'требуется ремонт', 'черновая отделка', None]
+BATHROOMS = ['совмещенный', 'раздельный', None]
+BALCONIES = ['балкон', 'лоджия', 'балкон, остекление', 'лоджия, остекление', '2 лоджии', None]
+
+
+def make_apartments(rows: int, seed: int = 0) -> pd.DataFrame:
+    # Synthetic Apartments rows in the raw form returned by predictor.main query
+    rng = np.random.default_rng(seed)
+    floors_in_building = rng.choice([2, 3, 4, 5, 9, 10, 12, 16, 19], rows)
+    floor = rng.integers(1, floors_in_building + 1)
+    square_total = rng.uniform(12, 120, rows).round(1)
+    square_living = np.char.add((square_total * 0.6).round(1).astype(str), ' кв.м')
+    square_living[rng.random(rows) < 0.1] = ''
+    date_add = pd.Timestamp('2019-01-01') + pd.to_timedelta(rng.integers(0, 3 * 365 * 86400, rows), unit='s')
+
+    df = pd.DataFrame({
+        'District': rng.choice(DISTRICTS, rows),
+        'Address': rng.choice(['Ленина пр-т, 1', 'Мира пр-т, 20', 'Иркутский тракт, 35'], rows),
+        'Sales_Type': rng.choice(['вторичное', 'новостройка'], rows, p=[0.9, 0.1]),
+        'Year_Building': rng.integers(1950, 2022, rows).astype(str),
+        'Material': rng.choice(MATERIALS, rows),
+        'Floor_Numbers_Of_Floors': np.char.add(np.char.add(floor.astype(str), '/'), floors_in_building.astype(str)),
+        'Floors_In_Building': floors_in_building.astype(str),
+        'Apartment_Type': rng.choice(['квартира', 'студия'], rows),
+        'Price': rng.integers(500, 10000, rows) * 1000,
+        'Square_Total': np.char.add(square_total.astype(str), ' кв.м'),
+        'Square_Living': square_living,
+        'Square_Kitchen': np.char.add((square_total * 0.2).round(1).astype(str), ' кв.м'),
+        'Rooms_Number': rng.integers(1, 6, rows).astype(str),
+        'Apartment_Condition': rng.choice(CONDITIONS, rows),
+        'Bathroom_Type': rng.choice(BATHROOMS, rows),
+        'Balcony_Loggia': rng.choice(BALCONIES, rows),
+        'Date_Add': date_add.strftime('%d.%m.%Y %H:%M:%S'),
+        'Date_Expiration': (date_add + pd.Timedelta(days=30)).strftime('%d.%m.%Y'),
+        'Id': np.arange(rows) + 4000000,
+    })
+    df.index = pd.RangeIndex(1, rows + 1, name='Apartment_Key')
+    return df
+
+
+def make_report_rows(rows: int, seed: int = 0) -> pd.DataFrame:
+    # Synthetic output of make_excel.get_data_for_make_excel, 10 rows per day
+    rng = np.random.default_rng(seed)
+    date_add = pd.Timestamp('2021-12-31') - pd.to_timedelta(np.arange(rows) // 10, unit='D')
+    error = -rng.uniform(0, 1500, rows).round(2)
+    price = rng.uniform(1000, 5000, rows).round(0)
+    return pd.DataFrame({
+        'Дата добавления': date_add.strftime('%Y-%m-%d'),
+        'Ссылка': [f'https://www.tomsk.ru09.ru/realty?subaction=detail&id={i}' for i in range(4000000, 4000000 + rows)],
+        'Дата истечения': (date_add + pd.Timedelta(days=30)).strftime('%Y-%m-%d'),
+        'Район': rng.choice(DISTRICTS, rows),
+        'Адрес': 'Томск, Ленина пр-т, 1',
+        'Год постройки': rng.integers(1960, 2022, rows).astype(float),
+        'Материал': rng.choice(MATERIALS[:3], rows),
+        'Этаж/этажность': '3/9',
+        'Площадь': rng.uniform(12, 50, rows).round(1),
+        'Состояние': rng.choice(CONDITIONS[:4], rows),
+        'Цена': price,
+        'Прогноз': price - error,
+        'Ошибка': error,
+    })
+
+
+def make_listing_html(apartment: Dict[str, Any]) -> str:
+    # Listing page with the markup parse_apartment relies on, missing attributes are left out as on the site
+    nbsp = '\xa0'
+    rows = ['<tr class="realty_detail_attr"><th><span>Расположение</span></th></tr>',
+            f'<tr class="realty_detail_attr"><th><span>{apartment["District"].title()}</span></th></tr>']
+    for key, column in zip(SITE_KEYS, rename_keys_of_list(SITE_KEYS)):
+        if apartment[column]:
+            rows.append(f'<tr class="realty_detail_attr"><th><span>{key.capitalize()}</span></th>'
+                        f'<td><span class="nowrap">{apartment[column]}</span></td></tr>')
+    dates = [f'<span class="realty_detail_date nobr" title="{apartment["Date_Add"]}">1 день назад</span>']
+    dates += [f'<span class="realty_detail_date" title="{apartment["Date_Add"]}"></span>'] * 3
+    dates.append(f'<span class="realty_detail_date" title="{apartment["Date_Expiration"]}"></span>')
+    price = f'{apartment["Price"]:,}'.replace(',', nbsp)
+    return (f'<html><body><h1>Объявление <strong>{apartment["Id"]}</strong></h1>'
+            f'<div class="realty_detail_price inline">{price}{nbsp}руб.</div>'
+            f'<a class="table_map_link" href="#">{apartment["Address"]}</a>'
+            f'<table>{"".join(rows)}</table>{"".join(dates)}</body></html>')
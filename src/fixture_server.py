@@ -0,0 +1,73 @@
+import argparse
+from functools import partial
+from http.server import (
+    BaseHTTPRequestHandler,
+    ThreadingHTTPServer,
+)
+from pathlib import Path
+from threading import Thread
+from urllib.parse import (
+    quote,
+    unquote,
+    urlsplit,
+)
+
+import requests
+
+BASE_PATH = Path(__file__).parent.parent
+FIXTURES_PATH = BASE_PATH.joinpath('fixtures')
+
+
+def get_fixture_name(url: str) -> str:
+    # Page and listing urls differ only by query string, so it is kept in the file name.
+    # Clients escape brackets in the query differently, unquote makes the name stable
+    url = urlsplit(url)
+    path = url.path + ('?' + url.query if url.query else '')
+    return quote(unquote(path), safe='') + '.html'
+
+
+def save_fixture(url: str, fixtures_path: Path = FIXTURES_PATH) -> Path:
+    fixtures_path.mkdir(parents=True, exist_ok=True)
+    response = requests.get(url)
+    path = fixtures_path.joinpath(get_fixture_name(url))
+    path.write_text(response.text, encoding='utf-8')
+    return path
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    def __init__(self, *args, fixtures_path: Path, **kwargs) -> None:
+        self.fixtures_path = fixtures_path
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self) -> None:
+        path = self.fixtures_path.joinpath(get_fixture_name(self.path))
+        if not path.exists():
+            self.send_error(404)
+            return
+        body = path.read_bytes()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def start_fixture_server(fixtures_path: Path = FIXTURES_PATH, port: int = 0) -> ThreadingHTTPServer:
+    # port=0 picks a free port, the crawler is pointed at f'http://127.0.0.1:{server.server_port}'
+    server = ThreadingHTTPServer(('127.0.0.1', port), partial(FixtureHandler, fixtures_path=fixtures_path))
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fixtures', type=Path, default=FIXTURES_PATH)
+    parser.add_argument('--port', type=int, default=8009)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), partial(FixtureHandler, fixtures_path=args.fixtures))
+    print(f'Serving {args.fixtures} on http://127.0.0.1:{args.port}')
+    server.serve_forever()
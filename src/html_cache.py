@@ -0,0 +1,122 @@
+import gzip
+import sqlite3
+from datetime import (
+    datetime,
+    timedelta,
+)
+from hashlib import sha256
+from pathlib import Path
+from threading import Lock
+from typing import (
+    Iterator,
+    Optional,
+    Tuple,
+)
+
+BASE_PATH = Path(__file__).parent.parent
+CACHE_PATH = BASE_PATH.joinpath('cache').joinpath('html')
+
+
+class HtmlCache:
+    def __init__(self,
+                 path: Path = CACHE_PATH,
+                 ttl: timedelta = timedelta(days=90),
+                 max_size: int = 2 * 1024 ** 3) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.blobs_path = path.joinpath('blobs')
+        self.blobs_path.mkdir(parents=True, exist_ok=True)
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path.joinpath('index.sqlite'), check_same_thread=False)
+        self.connection.executescript(
+            """CREATE TABLE IF NOT EXISTS Responses (Url TEXT NOT NULL,
+                                                     Fetched_At TEXT NOT NULL,
+                                                     Digest TEXT NOT NULL,
+                                                     PRIMARY KEY (Url, Fetched_At));
+               CREATE INDEX IF NOT EXISTS Responses_Fetched_At ON Responses (Fetched_At);
+               CREATE INDEX IF NOT EXISTS Responses_Digest ON Responses (Digest);
+               CREATE TABLE IF NOT EXISTS Blobs (Digest TEXT PRIMARY KEY,
+                                                 Size INTEGER NOT NULL);""")
+
+    def get_blob_path(self, digest: str) -> Path:
+        return self.blobs_path.joinpath(digest[:2]).joinpath(digest + '.gz')
+
+    def put(self, url: str, html: str, fetched_at: datetime = None) -> str:
+        # Blobs are addressed by content, so an unchanged page costs only an index row
+        data = html.encode('utf-8')
+        digest = sha256(data).hexdigest()
+        fetched_at = (fetched_at or datetime.now()).isoformat(sep=' ')
+        blob_path = self.get_blob_path(digest)
+        with self.lock:
+            if not blob_path.exists():
+                blob_path.parent.mkdir(exist_ok=True)
+                blob_path.write_bytes(gzip.compress(data))
+            with self.connection:
+                self.connection.execute('INSERT OR IGNORE INTO Blobs VALUES (?, ?)',
+                                        (digest, blob_path.stat().st_size))
+                self.connection.execute('INSERT OR REPLACE INTO Responses VALUES (?, ?, ?)', (url, fetched_at, digest))
+        return digest
+
+    def read_blob(self, digest: str) -> str:
+        return gzip.decompress(self.get_blob_path(digest).read_bytes()).decode('utf-8')
+
+    def get(self, url: str, max_age: Optional[timedelta] = None) -> Optional[str]:
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT Fetched_At, Digest FROM Responses WHERE Url = ? ORDER BY Fetched_At DESC LIMIT 1',
+                (url,)).fetchone()
+        if row is None:
+            return None
+        if max_age is not None and datetime.fromisoformat(row[0]) < datetime.now() - max_age:
+            return None
+        return self.read_blob(row[1])
+
+    def iter_responses(self,
+                       date_from: datetime,
+                       date_to: datetime,
+                       url_like: str = '%') -> Iterator[Tuple[str, datetime, str]]:
+        # Only the latest response of every url inside the range is returned
+        with self.lock:
+            rows = self.connection.execute(
+                """SELECT Url, MAX(Fetched_At), Digest
+                   FROM Responses
+                   WHERE Fetched_At >= ? AND Fetched_At < ? AND Url LIKE ?
+                   GROUP BY Url
+                   ORDER BY 2""",
+                (date_from.isoformat(sep=' '), date_to.isoformat(sep=' '), url_like)).fetchall()
+        for url, fetched_at, digest in rows:
+            yield url, datetime.fromisoformat(fetched_at), self.read_blob(digest)
+
+    def delete_blob(self, digest: str) -> None:
+        self.connection.execute('DELETE FROM Responses WHERE Digest = ?', (digest,))
+        self.connection.execute('DELETE FROM Blobs WHERE Digest = ?', (digest,))
+        self.get_blob_path(digest).unlink(missing_ok=True)
+
+    def evict(self) -> int:
+        expired_at = (datetime.now() - self.ttl).isoformat(sep=' ')
+        evicted = 0
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM Responses WHERE Fetched_At < ?', (expired_at,))
+            orphans = self.connection.execute(
+                'SELECT Digest FROM Blobs WHERE Digest NOT IN (SELECT Digest FROM Responses)').fetchall()
+            for (digest,) in orphans:
+                self.delete_blob(digest)
+                evicted += 1
+
+            # Drop least recently fetched blobs until the store fits into max_size
+            total_size = self.connection.execute('SELECT COALESCE(SUM(Size), 0) FROM Blobs').fetchone()[0]
+            if total_size > self.max_size:
+                blobs = self.connection.execute(
+                    """SELECT Blobs.Digest, Blobs.Size
+                       FROM Blobs
+                       INNER JOIN Responses ON Blobs.Digest = Responses.Digest
+                       GROUP BY Blobs.Digest, Blobs.Size
+                       ORDER BY MAX(Responses.Fetched_At)""").fetchall()
+                for digest, size in blobs:
+                    if total_size <= self.max_size:
+                        break
+                    self.delete_blob(digest)
+                    total_size -= size
+                    evicted += 1
+        return evicted
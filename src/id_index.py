@@ -0,0 +1,74 @@
+import json
+import os
+from pathlib import Path
+from typing import (
+    Iterable,
+    Set,
+)
+from urllib.parse import (
+    parse_qs,
+    urlsplit,
+)
+
+import numpy as np
+from sqlalchemy.engine import Engine
+
+from sql_connector import read_sql_query
+
+BASE_PATH = Path(__file__).parent.parent
+INDEX_PATH = BASE_PATH.joinpath('cache').joinpath('id_index')
+
+
+def get_id_from_url(url: str) -> int:
+    # https://www.tomsk.ru09.ru/realty?subaction=detail&id=4417386 -> 4417386
+    return int(parse_qs(urlsplit(url).query)['id'][0])
+
+
+class IdIndex:
+    def __init__(self, path: Path = INDEX_PATH) -> None:
+        self.ids_path = path.joinpath('ids.npy')
+        self.meta_path = path.joinpath('meta.json')
+        path.mkdir(parents=True, exist_ok=True)
+
+        # Sorted int64 array of known listing ids, 8 bytes per listing
+        self.ids = np.load(self.ids_path) if self.ids_path.exists() else np.empty(0, dtype=np.int64)
+        meta = json.loads(self.meta_path.read_text()) if self.meta_path.exists() else {}
+        self.last_apartment_key = meta.get('last_apartment_key', 0)
+        self.new_ids: Set[int] = set()
+
+    def __contains__(self, id_: int) -> bool:
+        if id_ in self.new_ids:
+            return True
+        idx = np.searchsorted(self.ids, id_)
+        return idx < len(self.ids) and self.ids[idx] == id_
+
+    def isin(self, ids: Iterable[int]) -> np.ndarray:
+        ids = np.asarray(ids, dtype=np.int64)
+        return np.isin(ids, self.ids) | np.isin(ids, list(self.new_ids))
+
+    def __len__(self) -> int:
+        return len(self.ids) + len(self.new_ids)
+
+    def add(self, ids: Iterable[int]) -> None:
+        self.new_ids.update(int(i) for i in ids if i not in self)
+
+    def sync(self, engine: Engine) -> int:
+        # Only rows inserted since the last sync are read, the first sync builds the whole index
+        query = f"""SELECT Apartment_Key, Id
+                    FROM Apartments
+                    WHERE Apartment_Key > {int(self.last_apartment_key)}"""
+        data = read_sql_query(query, engine)
+        if not data.empty:
+            self.add(data['Id'].dropna().astype(np.int64))
+            self.last_apartment_key = int(data['Apartment_Key'].max())
+        return len(data)
+
+    def save(self) -> None:
+        if self.new_ids:
+            new_ids = np.fromiter(self.new_ids, dtype=np.int64, count=len(self.new_ids))
+            self.ids = np.union1d(self.ids, new_ids)
+            self.new_ids = set()
+        tmp_path = self.ids_path.with_suffix('.tmp.npy')
+        np.save(tmp_path, self.ids)
+        os.replace(tmp_path, self.ids_path)
+        self.meta_path.write_text(json.dumps({'last_apartment_key': self.last_apartment_key}))
@@ -1,44 +1,111 @@
+import argparse
 import logging
+from datetime import date
 from pathlib import Path
 
 import pandas as pd
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.formatting.rule import ColorScaleRule
 from openpyxl.utils.dataframe import dataframe_to_rows
+from sqlalchemy import (
+    Date,
+    bindparam,
+    text,
+)
 
 from excel_styles import (
     base_style,
     headers_style,
     text_wrap_style,
 )
-from sql_connector import get_sqlalchemy_engine
+from metrics import METRICS
+from snapshot import read_snapshot
+from sql_connector import (
+    cast_date,
+    get_sqlalchemy_engine,
+    read_sql_query,
+)
 
-ENGINE = get_sqlalchemy_engine()
 BASE_PATH = Path(__file__).parent.parent
 
 
-def get_data_for_make_excel() -> pd.DataFrame:
-    query = """SELECT 
-                     Apartments.Url_Link,
-                     CAST(Apartments.Date_Add as date) AS Date_Add,
-                     CAST(Apartments.Date_Expiration as date) AS Date_Expiration,
-                     Apartments.District,
-                     Apartments.Address,
-                     Apartments.Year_Building,
-                     Apartments.Material,
-                     Apartments.Floor_Numbers_Of_Floors,
-                     Apartments.Square_Total,
-                     Apartments.Apartment_Condition,
-                     Apartments.Price / 1000 AS Price,
-                     Predictions.Predict,
-                     Predictions.Error
-               FROM Apartment_Tomsk.dbo.Predictions AS Predictions
-               INNER JOIN Apartment_Tomsk.dbo.Apartments AS Apartments
-                   ON Predictions.Apartment_Key = Apartments.Apartment_Key
-               WHERE Error <=0
-               ORDER BY Date_Add DESC, Error"""
-
-    data = pd.read_sql_query(query, ENGINE)
+def get_top_n_per_day(data: pd.DataFrame, top_n: int = 10) -> pd.DataFrame:
+    # Vectorized ranker for data that is already loaded: one sort instead of a sort per day
+    data = data.sort_values(['Date_Add', 'Error'], ascending=[False, True], kind='stable')
+    return data[data.groupby('Date_Add', sort=False).cumcount() < top_n]
+
+
+def get_data_for_make_excel(date_from: date = None, date_to: date = None, top_n: int = 10) -> pd.DataFrame:
+    # Apartments are ranked by Error inside every day in the query, only top_n rows per day are transferred
+    engine = get_sqlalchemy_engine()
+    date_add = cast_date(engine, 'Apartments.Date_Add')
+    conditions = ['Predictions.Error <= 0']
+    params = {'top_n': int(top_n)}
+    if date_from is not None:
+        conditions.append(f'{date_add} >= :date_from')
+        params['date_from'] = date_from
+    if date_to is not None:
+        conditions.append(f'{date_add} <= :date_to')
+        params['date_to'] = date_to
+    query = f"""WITH Ranked AS (
+                    SELECT 
+                          Apartments.Url_Link,
+                          {date_add} AS Date_Add,
+                          {cast_date(engine, 'Apartments.Date_Expiration')} AS Date_Expiration,
+                          Apartments.District,
+                          Apartments.Address,
+                          Apartments.Year_Building,
+                          Apartments.Material,
+                          Apartments.Floor_Numbers_Of_Floors,
+                          Apartments.Square_Total,
+                          Apartments.Apartment_Condition,
+                          Apartments.Price / 1000 AS Price,
+                          Predictions.Predict,
+                          Predictions.Error,
+                          ROW_NUMBER() OVER (PARTITION BY {date_add}
+                                             ORDER BY Predictions.Error, Apartments.Apartment_Key) AS Day_Rank
+                    FROM Predictions AS Predictions
+                    INNER JOIN Apartments AS Apartments
+                        ON Predictions.Apartment_Key = Apartments.Apartment_Key
+                    WHERE {' AND '.join(conditions)})
+                SELECT Url_Link, Date_Add, Date_Expiration, District, Address, Year_Building, Material,
+                       Floor_Numbers_Of_Floors, Square_Total, Apartment_Condition, Price, Predict, Error
+                FROM Ranked
+                WHERE Day_Rank <= :top_n
+                ORDER BY Date_Add DESC, Error"""
+    # Date type renders the bounds the same way as cast_date on every dialect
+    query = text(query).bindparams(*(bindparam(i, type_=Date) for i in params if i != 'top_n'))
+
+    data = read_sql_query(query, engine, params=params)
+    return rename_for_report(data)
+
+
+def get_data_for_make_excel_from_snapshot(date_from: date = None,
+                                          date_to: date = None,
+                                          top_n: int = 10) -> pd.DataFrame:
+    # Same report data with apartments read from the Parquet snapshot, only months of the range are opened
+    predictions = read_sql_query('SELECT Apartment_Key, Predict, Error FROM Predictions WHERE Error <= 0',
+                                 get_sqlalchemy_engine())
+    columns = ['Apartment_Key', 'Url_Link', 'Date_Add', 'Date_Expiration', 'District', 'Address', 'Year_Building',
+               'Material', 'Floor_Numbers_Of_Floors', 'Square_Total', 'Apartment_Condition', 'Price']
+    data = read_snapshot(columns, date_from, date_to)
+    data['Date_Add'] = data['Date_Add'].dt.normalize()
+    data['Date_Expiration'] = data['Date_Expiration'].dt.normalize()
+    if date_from is not None:
+        data = data[data['Date_Add'] >= pd.Timestamp(date_from)]
+    if date_to is not None:
+        data = data[data['Date_Add'] <= pd.Timestamp(date_to)]
+    data = data.merge(predictions, on='Apartment_Key').sort_values('Apartment_Key')
+    data['Price'] = data['Price'] // 1000
+    # The snapshot keeps parsed numbers, the report shows them as the site does: '1976', '32 кв.м', '34.4 кв.м'
+    data['Year_Building'] = data['Year_Building'].map(lambda x: None if pd.isna(x) else f'{x:.0f}')
+    data['Square_Total'] = data['Square_Total'].map(lambda x: None if pd.isna(x) else f'{x:g} кв.м')
+    data = get_top_n_per_day(data, top_n)
+    return rename_for_report(data.drop(columns='Apartment_Key'))
+
+
+def rename_for_report(data: pd.DataFrame) -> pd.DataFrame:
     map_rename = {
         'Url_Link': 'Ссылка',
         'Date_Add': 'Дата добавления',
@@ -54,19 +121,15 @@ def get_data_for_make_excel() -> pd.DataFrame:
         'Predict': 'Прогноз',
         'Error': 'Ошибка',
     }
-    data.rename(columns=map_rename, inplace=True)
-    data.set_index('Дата добавления', inplace=True, drop=True)
-    data.index = pd.to_datetime(data.index)
-    data_out = data.groupby(pd.Grouper(freq='D')).apply(lambda x: x.sort_values('Ошибка').iloc[0:10])
-    data_out.reset_index(level=0, drop=True, inplace=True)
-    data_out.reset_index(inplace=True)
-    data_out.sort_values(['Дата добавления', 'Ошибка'], ascending=[False, True], inplace=True)
-    data_out['Дата добавления'] = data_out['Дата добавления'].astype(str)
-    data_out['Дата истечения'] = data_out['Дата истечения'].astype(str)
+    data_out = data.rename(columns=map_rename)
+    data_out = data_out[['Дата добавления'] + [i for i in data_out.columns if i != 'Дата добавления']]
+    data_out.reset_index(drop=True, inplace=True)
+    data_out['Дата добавления'] = pd.to_datetime(data_out['Дата добавления']).dt.date.astype(str)
+    data_out['Дата истечения'] = pd.to_datetime(data_out['Дата истечения']).dt.date.astype(str)
     return data_out
 
 
-def make_excel(data_out: pd.DataFrame) -> None:
+def make_excel(data_out: pd.DataFrame, path: Path = None) -> None:
     wb = Workbook()
     wb.add_named_style(headers_style)
     wb.add_named_style(base_style)
@@ -123,10 +186,82 @@ def make_excel(data_out: pd.DataFrame) -> None:
                                                      end_color='FFD6A5')
                                       )
 
-    wb.save(BASE_PATH.joinpath('report.xlsx'))
+    wb.save(path or BASE_PATH.joinpath('report.xlsx'))
+
+
+def make_excel_streaming(data_out: pd.DataFrame, path: Path = None) -> None:
+    # Same report as make_excel written by a write-only workbook, nothing is kept per row until save:
+    # links are HYPERLINK formulas instead of hyperlink objects, one color scale covers the whole Error column
+    # and days are not merged, the date is shown in the first row of the day and the day is filled instead
+    wb = Workbook(write_only=True)
+    wb.add_named_style(headers_style)
+    wb.add_named_style(base_style)
+    wb.add_named_style(text_wrap_style)
+    ws = wb.create_sheet()
+    ws.auto_filter.ref = 'A1:M1'
+
+    # Set width for columns and height for rows, must be done before the first row.
+    # One default height instead of a row dimension per row
+    ws.sheet_format.defaultRowHeight = 25.5
+    ws.sheet_format.customHeight = True
+    columns = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', 'L', 'M']
+    for column in columns:
+        ws.column_dimensions[column].width = 13
+    styles = ['base_style', 'Hyperlink', 'base_style', 'text_wrap_style', 'text_wrap_style', 'base_style',
+              'base_style', 'base_style', 'base_style', 'text_wrap_style', 'base_style', 'base_style', 'base_style']
+
+    # Add headers
+    headers = []
+    for value in data_out.columns:
+        cell = WriteOnlyCell(ws, value)
+        cell.style = 'headers_style'
+        headers.append(cell)
+    ws.append(headers)
+
+    # Add data, rows are grouped by 'Дата добавления' which is sorted
+    group_number = -1
+    previous_date = None
+    for row_number, values in enumerate(data_out.itertuples(index=False, name=None), start=2):
+        is_group_start = row_number == 2 or values[0] != previous_date
+        if is_group_start:
+            group_number += 1
+        previous_date = values[0]
+
+        row = []
+        for value, style in zip(values, styles):
+            cell = WriteOnlyCell(ws, value)
+            cell.style = style
+            row.append(cell)
+        link = str(values[1]).replace('"', '""')
+        row[1].value = f'=HYPERLINK("{link}", "{link}")'
+        if not is_group_start:
+            row[0].value = None
+        if group_number % 2 == 0:
+            row[0].fill = headers_style.fill
+        row[0].font = headers_style.font
+        row[0].alignment = headers_style.alignment
+        ws.append(row)
+    if len(data_out):
+        ws.conditional_formatting.add(f'M2:M{len(data_out) + 1}',
+                                      ColorScaleRule(start_type='max', end_type='min', start_color='CAFFBF',
+                                                     end_color='FFD6A5')
+                                      )
+
+    wb.save(path or BASE_PATH.joinpath('report.xlsx'))
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--in-memory', action='store_true', help='Build the report with a regular openpyxl workbook')
+    parser.add_argument('--date-from', type=date.fromisoformat, help='First day of the report')
+    parser.add_argument('--date-to', type=date.fromisoformat, help='Last day of the report, inclusive')
+    parser.add_argument('--top-n', type=int, default=10, help='Apartments per day')
+    parser.add_argument('--snapshot', action='store_true',
+                        help='Read apartments from the local Parquet snapshot instead of the database')
+    parser.add_argument('--profile-stage', help='Run this stage under cProfile, e.g. read_report_data or write_report')
+    args = parser.parse_args()
+    METRICS.profile_stage = args.profile_stage or METRICS.profile_stage
+
     log_file = BASE_PATH.joinpath('logs').joinpath('make_excel.txt')
     logging.basicConfig(
         format='[%(asctime)s] -- %(levelname).3s -- %(message)s',
@@ -136,6 +271,18 @@ if __name__ == '__main__':
 
     logging.info('Make excel')
     try:
-        make_excel(get_data_for_make_excel())
+        with METRICS.stage('read_report_data') as stage:
+            if args.snapshot:
+                data_out = get_data_for_make_excel_from_snapshot(args.date_from, args.date_to, args.top_n)
+            else:
+                data_out = get_data_for_make_excel(args.date_from, args.date_to, args.top_n)
+            stage.rows = len(data_out)
+        with METRICS.stage('write_report', len(data_out)):
+            if args.in_memory:
+                make_excel(data_out)
+            else:
+                make_excel_streaming(data_out)
     except Exception as e:
         logging.exception(e)
+    finally:
+        METRICS.write('make_excel')
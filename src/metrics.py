@@ -0,0 +1,233 @@
+import bisect
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Tuple,
+)
+
+BASE_PATH = Path(__file__).parent.parent
+METRICS_PATH = Path(os.environ.get('APARTMENT_METRICS_PATH', BASE_PATH.joinpath('logs').joinpath('metrics')))
+
+# Upper bounds of histogram buckets in seconds, the last bucket is +Inf
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def get_peak_rss() -> int:
+    # Peak resident set size of the process in bytes
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD),
+                        ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t),
+                        ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t),
+                        ('PeakPagefileUsage', ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(),
+                                                 ctypes.byref(counters), counters.cb)
+        return counters.PeakWorkingSetSize
+
+    import resource
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+def timed_call(function: Callable, *args) -> Tuple[Any, float]:
+    # Module level, so it can be sent to worker processes together with the function
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_quantile(self, q: float) -> float:
+        # Upper bound of the bucket the quantile falls into
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(BUCKETS + (float('inf'),), self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float('inf')
+
+
+class Stage:
+    def __init__(self, rows: int = 0) -> None:
+        self.rows = rows
+
+
+class Metrics:
+    # Process-wide run metrics: histograms, counters and stage timings, safe to update from threads
+    def __init__(self, prefix: str = 'apartments') -> None:
+        self.prefix = prefix
+        self.started_at = datetime.now()
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.profile_stage = os.environ.get('APARTMENT_PROFILE_STAGE')
+        self.profiles: Dict[str, cProfile.Profile] = {}
+        self.profile_depths: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @contextmanager
+    def stage(self, name: str, rows: int = 0) -> Iterator[Stage]:
+        # Rows and time add up over repeated calls, e.g. one call per written batch.
+        # The stage named by profile_stage runs under one cProfile for all its calls, dumped by write
+        stage = Stage(rows)
+        is_profiled = name == self.profile_stage
+        if is_profiled:
+            self.enable_profile(name)
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            elapsed = time.perf_counter() - start
+            if is_profiled:
+                self.disable_profile(name)
+            with self.lock:
+                stats = self.stages.setdefault(name, {'rows': 0, 'seconds': 0.0, 'calls': 0})
+                stats['rows'] += stage.rows
+                stats['seconds'] += elapsed
+                stats['calls'] += 1
+
+    def enable_profile(self, name: str) -> None:
+        # Nested or concurrent calls of the stage share the profiler, it runs while any of them does
+        with self.lock:
+            if name not in self.profiles:
+                self.profiles[name] = cProfile.Profile()
+            self.profile_depths[name] = self.profile_depths.get(name, 0) + 1
+            if self.profile_depths[name] == 1:
+                self.profiles[name].enable()
+
+    def disable_profile(self, name: str) -> None:
+        with self.lock:
+            self.profile_depths[name] -= 1
+            if self.profile_depths[name] == 0:
+                self.profiles[name].disable()
+
+    def get_summary(self) -> Dict[str, Any]:
+        with self.lock:
+            stages = {name: dict(stats, rows_per_second=stats['rows'] / stats['seconds'] if stats['seconds'] else 0.0)
+                      for name, stats in self.stages.items()}
+            histograms = {}
+            for (name, labels), histogram in self.histograms.items():
+                histograms.setdefault(name, []).append({
+                    'labels': dict(labels),
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'p50': histogram.get_quantile(0.5),
+                    'p95': histogram.get_quantile(0.95),
+                    'p99': histogram.get_quantile(0.99),
+                })
+            counters = {}
+            for (name, labels), value in self.counters.items():
+                counters.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+        return {'started_at': self.started_at.isoformat(timespec='seconds'),
+                'finished_at': datetime.now().isoformat(timespec='seconds'),
+                'peak_rss_bytes': get_peak_rss(),
+                'stages': stages,
+                'histograms': histograms,
+                'counters': counters}
+
+    def get_prometheus_lines(self, script: str) -> List[str]:
+        def format_labels(labels: Labels, **extra: str) -> str:
+            labels = (('script', script),) + labels + tuple(extra.items())
+            return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f'# TYPE {self.prefix}_{name} histogram')
+                for (histogram_name, labels), histogram in self.histograms.items():
+                    if histogram_name != name:
+                        continue
+                    total = 0
+                    for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                        total += count
+                        lines.append(f'{self.prefix}_{name}_bucket{format_labels(labels, le=str(bound))} {total}')
+                    lines.append(f'{self.prefix}_{name}_sum{format_labels(labels)} {histogram.sum}')
+                    lines.append(f'{self.prefix}_{name}_count{format_labels(labels)} {histogram.count}')
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f'# TYPE {self.prefix}_{name} counter')
+                lines += [f'{self.prefix}_{name}{format_labels(labels)} {value}'
+                          for (counter_name, labels), value in self.counters.items() if counter_name == name]
+            for metric in ('rows', 'seconds'):
+                lines.append(f'# TYPE {self.prefix}_stage_{metric} gauge')
+                lines += [f'{self.prefix}_stage_{metric}{format_labels((("stage", name),))} {stats[metric]}'
+                          for name, stats in self.stages.items()]
+        lines.append(f'# TYPE {self.prefix}_peak_rss_bytes gauge')
+        lines.append(f'{self.prefix}_peak_rss_bytes{format_labels(())} {get_peak_rss()}')
+        lines.append(f'# TYPE {self.prefix}_last_run_timestamp_seconds gauge')
+        lines.append(f'{self.prefix}_last_run_timestamp_seconds{format_labels(())} {time.time()}')
+        return lines
+
+    def write(self, script: str, path: Path = METRICS_PATH) -> None:
+        # <script>.prom is replaced atomically for the node_exporter textfile collector,
+        # the JSON summary is kept for every run
+        path.mkdir(parents=True, exist_ok=True)
+        prom_path = path.joinpath(f'{script}.prom')
+        tmp_path = prom_path.with_suffix('.prom.tmp')
+        tmp_path.write_text('\n'.join(self.get_prometheus_lines(script)) + '\n')
+        os.replace(tmp_path, prom_path)
+        summary_path = path.joinpath(f'{script}_{self.started_at:%Y%m%d_%H%M%S}.json')
+        summary_path.write_text(json.dumps(self.get_summary(), indent=2))
+        with self.lock:
+            for name, profile in self.profiles.items():
+                profile.dump_stats(path.joinpath(f'profile_{name}.prof'))
+
+
+METRICS = Metrics()
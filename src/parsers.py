@@ -0,0 +1,148 @@
+import argparse
+import os
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+)
+
+from bs4 import BeautifulSoup
+from lxml import etree
+
+BASE_PATH = Path(__file__).parent.parent
+FIXTURES_PATH = BASE_PATH.joinpath('fixtures')
+
+NBSP_TO_SPACE = str.maketrans({'\xa0': ' '})
+NBSP_TO_EMPTY = str.maketrans({'\xa0': None})
+
+
+def has_class(name: str) -> str:
+    # Same semantics as bs4 class_ matching on a single class name
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+XPATH_TEXT = etree.XPath('string()')
+XPATH_KEYS = etree.XPath(f"//tr[{has_class('realty_detail_attr')}]/descendant::span[1]")
+XPATH_VALUES = etree.XPath(f"//*[{has_class('nowrap')}]")
+XPATH_ADDRESS = etree.XPath(f"(//*[{has_class('table_map_link')}])[1]")
+XPATH_PRICE = etree.XPath("(//div[normalize-space(@class) = 'realty_detail_price inline'])[1]")
+XPATH_ID = etree.XPath('(//strong)[1]')
+XPATH_DATE_ADD = etree.XPath("(//*[normalize-space(@class) = 'realty_detail_date nobr'])[1]")
+XPATH_DATE_EXPIRATION = etree.XPath(f"(//*[{has_class('realty_detail_date')}])[5]")
+
+
+def find_district_field(keys: List[str]) -> int:
+    for i, j in enumerate(keys):
+        if ' район' in j:
+            return i
+
+
+def rename_keys_of_list(list_with_keys: List[str]) -> List[str]:
+    rename_map = {'адрес': 'Address',
+                  'вид': 'Sales_Type',
+                  'год постройки': 'Year_Building',
+                  'материал': 'Material',
+                  'этаж/этажность': 'Floor_Numbers_Of_Floors',
+                  'этажность': 'Floors_In_Building',
+                  'тип квартиры': 'Apartment_Type',
+                  'общая площадь': 'Square_Total',
+                  'жилая': 'Square_Living',
+                  'кухня': 'Square_Kitchen',
+                  'количество комнат': 'Rooms_Number',
+                  'отделка': 'Apartment_Condition',
+                  'санузел': 'Bathroom_Type',
+                  'балкон/лоджия': 'Balcony_Loggia'}
+    ranamed_list = []
+    for key in list_with_keys:
+        ranamed_list.append(key.replace(key, rename_map[key]))
+    return ranamed_list
+
+
+def parse_apartment_soup(soup: BeautifulSoup, url: str) -> Dict[str, Any]:
+    keys = [i.find('span').text.replace('\xa0', '').lower() for i in
+            soup.find_all('tr', {'class': 'realty_detail_attr'})]
+    district_idx = find_district_field(keys)
+    items = {'District': keys[district_idx]}
+    keys = [j for i, j in enumerate(keys) if i not in (district_idx - 1, district_idx)]
+    keys = rename_keys_of_list(keys)
+    values = [i.text.replace('\xa0', ' ') for i in soup.find_all(class_='nowrap')]
+
+    items.update(dict(zip(keys, values)))
+
+    items['Address'] = soup.find(class_='table_map_link').text.replace('\xa0', ' ')
+    items['Price'] = int(
+        soup.find('div', {'class': 'realty_detail_price inline'}).text.replace('\xa0', '').replace('руб.', ''))
+    items['Id'] = int(soup.find('strong').text)
+    items['Date_Add'] = soup.find(class_='realty_detail_date nobr').get('title')
+    items['Date_Expiration'] = soup.find_all(class_='realty_detail_date')[4].get('title')
+    items['Url_Link'] = url
+    return items
+
+
+def parse_apartment_bs4(html: str, url: str) -> Dict[str, Any]:
+    return parse_apartment_soup(BeautifulSoup(html, 'lxml'), url)
+
+
+def parse_apartment_lxml(html: str, url: str) -> Dict[str, Any]:
+    tree = etree.HTML(html)
+
+    keys = [XPATH_TEXT(i).translate(NBSP_TO_EMPTY).lower() for i in XPATH_KEYS(tree)]
+    district_idx = find_district_field(keys)
+    items = {'District': keys[district_idx]}
+    keys = [j for i, j in enumerate(keys) if i not in (district_idx - 1, district_idx)]
+    keys = rename_keys_of_list(keys)
+    values = [XPATH_TEXT(i).translate(NBSP_TO_SPACE) for i in XPATH_VALUES(tree)]
+
+    items.update(dict(zip(keys, values)))
+
+    items['Address'] = XPATH_TEXT(XPATH_ADDRESS(tree)[0]).translate(NBSP_TO_SPACE)
+    items['Price'] = int(XPATH_TEXT(XPATH_PRICE(tree)[0]).translate(NBSP_TO_EMPTY).replace('руб.', ''))
+    items['Id'] = int(XPATH_TEXT(XPATH_ID(tree)[0]))
+    items['Date_Add'] = XPATH_DATE_ADD(tree)[0].get('title')
+    items['Date_Expiration'] = XPATH_DATE_EXPIRATION(tree)[0].get('title')
+    items['Url_Link'] = url
+    return items
+
+
+PARSERS = {
+    'bs4': parse_apartment_bs4,
+    'lxml': parse_apartment_lxml,
+}
+
+
+def get_parser(name: str = None) -> Callable[[str, str], Dict[str, Any]]:
+    name = name or os.environ.get('APARTMENT_PARSER', 'bs4')
+    if name not in PARSERS:
+        raise ValueError(f"Parser '{name}' does not exist, use one of {list(PARSERS)}")
+    return PARSERS[name]
+
+
+def check_parity(paths: List[Path], parser: str = 'lxml') -> List[str]:
+    # Pages where the backend differs from bs4, a failure counts as equal only if both backends fail
+    mismatches = []
+    for path in paths:
+        html = path.read_text(encoding='utf-8')
+        results = []
+        for parse in (parse_apartment_bs4, PARSERS[parser]):
+            try:
+                results.append(parse(html, path.name))
+            except Exception:
+                results.append(None)
+        if results[0] != results[1]:
+            mismatches.append(path.name)
+    return mismatches
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--fixtures', type=Path, default=FIXTURES_PATH)
+    arg_parser.add_argument('--parser', default='lxml', choices=list(PARSERS))
+    args = arg_parser.parse_args()
+
+    pages = sorted(args.fixtures.glob('*subaction%3Ddetail*.html'))
+    mismatched_pages = check_parity(pages, args.parser)
+    print(f'Pages checked: {len(pages)}, mismatches: {len(mismatched_pages)}')
+    for page in mismatched_pages:
+        print(page)
@@ -1,18 +1,68 @@
+import argparse
+import json
 import logging
+import os
 import pickle
+from collections import OrderedDict
 from pathlib import Path
+from typing import (
+    Any,
+    Tuple,
+)
 
+import numpy as np
 import pandas as pd
 
+from metrics import METRICS
 from processor import (
-    convert_to_dummies,
+    ENCODER,
     filter_df_main,
-    filter_df_room_1,
+    filter_df_rooms,
     handle_dataframe,
 )
-from sql_connector import get_sqlalchemy_engine
+from snapshot import (
+    read_snapshot,
+    sync,
+)
+from sql_connector import (
+    bulk_insert,
+    get_sqlalchemy_engine,
+    read_sql_query,
+    select_top,
+)
+
+BASE_PATH = Path(__file__).parent.parent
+STATE_PATH = BASE_PATH.joinpath('cache').joinpath('predictor_state.json')
+
+# Columns a model is chosen by, one main model per segment in Models
+SEGMENT_COLUMNS = ['Rooms_Number']
 
-ENGINE = get_sqlalchemy_engine()
+# Columns in the order handle_dataframe expects them
+APARTMENT_COLUMNS = [
+    'District',
+    'Address',
+    'Sales_Type',
+    'Year_Building',
+    'Material',
+    'Floor_Numbers_Of_Floors',
+    'Floors_In_Building',
+    'Apartment_Type',
+    'Price',
+    'Square_Total',
+    'Square_Living',
+    'Square_Kitchen',
+    'Rooms_Number',
+    'Apartment_Condition',
+    'Bathroom_Type',
+    'Balcony_Loggia',
+    'Date_Add',
+    'Date_Expiration',
+    'Id',
+]
+
+QUERY_APARTMENTS = f"""SELECT {', '.join(APARTMENT_COLUMNS)},
+                              Apartment_Key
+                       FROM Apartments AS Apartments"""
 
 
 def get_model_from_path(path: Path):
@@ -21,78 +71,195 @@ def get_model_from_path(path: Path):
     return model
 
 
-def predict_main(data_to_predict: pd.DataFrame) -> pd.DataFrame:
-    # Get model info
-    sql_expression = f"""SELECT Model_path,
-                                Model_features 
-                         FROM Models 
-                         WHERE Is_main = 1"""
-    model_info = ENGINE.execute(sql_expression).fetchone()
+class ModelRegistry:
+    # Loaded models are cached by path and modification time, least recently used are evicted
+    def __init__(self, max_models: int = 8) -> None:
+        self.max_models = max_models
+        self.models: OrderedDict[Tuple[str, float], Any] = OrderedDict()
+
+    def get_model(self, path: str) -> Any:
+        key = (str(path), os.path.getmtime(path))
+        if key in self.models:
+            self.models.move_to_end(key)
+            return self.models[key]
+        model = get_model_from_path(path)
+        self.models[key] = model
+        if len(self.models) > self.max_models:
+            self.models.popitem(last=False)
+        return model
+
+    def get_main_models_info(self) -> pd.DataFrame:
+        sql_expression = f"""SELECT {', '.join(SEGMENT_COLUMNS)},
+                                    Model_path,
+                                    Model_features
+                             FROM Models
+                             WHERE Is_main = 1"""
+        return pd.read_sql_query(sql_expression, get_sqlalchemy_engine())
+
+
+REGISTRY = ModelRegistry()
 
-    #     if model_info is None:
-    #         raise ValueError(f"Model '{model_name}' does not exist")
 
-    model_path = model_info[0]
-    model_columns = model_info[1].split('; ')
-    difference_between_columns = set(model_columns).difference(set(data_to_predict.columns))
+def predict_main(data_to_predict: pd.DataFrame, registry: ModelRegistry = REGISTRY) -> pd.Series:
+    # Every segment is scored by its main model with one vectorized predict call
+    models_info = registry.get_main_models_info()
+    if models_info.empty:
+        raise ValueError('There is no main model in Models')
 
-    if difference_between_columns:
-        raise ValueError(f'Columns {difference_between_columns} not found in put data')
+    predictions = pd.Series(np.nan, index=data_to_predict.index, name='Predict')
+    segments = data_to_predict.groupby(SEGMENT_COLUMNS, sort=False).indices
+    for model_info in models_info.itertuples(index=False):
+        segment = tuple(getattr(model_info, i) for i in SEGMENT_COLUMNS)
+        idx = segments.get(segment if len(segment) > 1 else segment[0])
+        if idx is None:
+            continue
+        model_columns = model_info.Model_features.split('; ')
 
-    # Load model
-    model = get_model_from_path(model_path)
+        # Encode categorical columns into exactly the model features, raises if some are missing
+        features = ENCODER.transform(data_to_predict.iloc[idx], model_columns)
 
-    # Make predict
-    predictions = model.predict(data_to_predict[model_columns]).round(2)
+        # Make predict
+        model = registry.get_model(model_info.Model_path)
+        predictions.iloc[idx] = model.predict(features).round(2)
     return predictions
 
 
+def get_segments_condition() -> str:
+    # Only apartments of segments that have a main model are read
+    join_condition = ' AND '.join(f'Models.{i} = Apartments.{i}' for i in SEGMENT_COLUMNS)
+    return f'EXISTS (SELECT 1 FROM Models WHERE Models.Is_main = 1 AND {join_condition})'
+
+
+def is_in_segments(data: pd.DataFrame, models_info: pd.DataFrame) -> np.ndarray:
+    # Raw rows keep segment columns as text, they are compared as numbers like in Models
+    values = data[SEGMENT_COLUMNS].apply(pd.to_numeric, errors='coerce')
+    return pd.MultiIndex.from_frame(values).isin(pd.MultiIndex.from_frame(models_info[SEGMENT_COLUMNS]))
+
+
+def prepare_data(data: pd.DataFrame) -> pd.DataFrame:
+    with METRICS.stage('prepare_data', len(data)):
+        data = handle_dataframe(data)
+        data = filter_df_main(data)
+        data = filter_df_rooms(data)
+    return data
+
+
+def score(data: pd.DataFrame, registry: ModelRegistry = REGISTRY) -> pd.DataFrame:
+    with METRICS.stage('predict', len(data)):
+        data['Predict'] = predict_main(data, registry)
+    data = data[data['Predict'].notna()]
+    data['Error'] = (data['Price'] - data['Predict']).round(2)
+    return data.reset_index()[['Apartment_Key', 'Predict', 'Error']]
+
+
 def main() -> None:
-    query = """SELECT District,
-                      Address,
-                      Sales_Type,
-                      Year_Building,
-                      Material,
-                      Floor_Numbers_Of_Floors,
-                      Floors_In_Building,
-                      Apartment_Type,
-                      Price,
-                      Square_Total,
-                      Square_Living,
-                      Square_Kitchen,
-                      Rooms_Number,
-                      Apartment_Condition,
-                      Bathroom_Type,
-                      Balcony_Loggia,
-                      Date_Add,
-                      Date_Expiration,
-                      Id,
-                      Apartment_Key
-               FROM Apartment_Tomsk.dbo.Apartments
-               WHERE Apartment_Key NOT IN (SELECT Apartment_Key FROM Apartment_Tomsk.dbo.Predictions)
-               AND Rooms_Number = 1"""
-    data = pd.read_sql_query(query, ENGINE, index_col='Apartment_Key')
-    data = handle_dataframe(data)
-    data = filter_df_main(data)
-    data = filter_df_room_1(data)
-    data_to_predict = data.drop(
-        ['Date_Add', 'Date_Expiration', 'Address', 'Price', 'Not_Used', 'Not_Used_Description'],
-        axis=1
-    )
-    data_dummies = convert_to_dummies(data_to_predict)
-    input_data_message = f'Input data shape: {data_to_predict.shape}'
+    engine = get_sqlalchemy_engine()
+    query = f"""{QUERY_APARTMENTS}
+                WHERE Apartment_Key NOT IN (SELECT Apartment_Key FROM Predictions)
+                AND {get_segments_condition()}"""
+    data = read_sql_query(query, engine, index_col='Apartment_Key')
+    data = prepare_data(data)
+    input_data_message = f'Input data shape: {data.shape}'
     print(input_data_message)
     logging.info(input_data_message)
     if not data.empty:
-        data['Predict'] = predict_main(data_dummies)
-        data['Error'] = (data['Price'] - data['Predict']).round(2)
-        data.reset_index(inplace=True)
-        data[['Apartment_Key', 'Predict', 'Error']].to_sql('Predictions', ENGINE, if_exists='append', index=False)
+        predictions = score(data)
+        bulk_insert(predictions, 'Predictions', engine, key_columns=['Apartment_Key'], schema='dbo')
     else:
         logging.info('There are no new apartments to predictions')
 
 
+def read_high_water_mark() -> int:
+    return json.loads(STATE_PATH.read_text())['last_apartment_key'] if STATE_PATH.exists() else 0
+
+
+def write_high_water_mark(last_apartment_key: int) -> None:
+    STATE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    STATE_PATH.write_text(json.dumps({'last_apartment_key': last_apartment_key}))
+
+
+def main_streaming(chunksize: int = 50000) -> None:
+    # Apartments are read in Apartment_Key order, chunksize rows at a time. The last key of every
+    # written chunk is saved, so memory is bounded by chunksize and an interrupted run resumes after it
+    engine = get_sqlalchemy_engine()
+    last_apartment_key = read_high_water_mark()
+    logging.info(f'Streaming from Apartment_Key > {last_apartment_key}')
+    predicted = 0
+    while True:
+        query = f"""{QUERY_APARTMENTS}
+                    WHERE Apartment_Key > {int(last_apartment_key)}
+                    AND NOT EXISTS (SELECT 1
+                                    FROM Predictions AS Predictions
+                                    WHERE Predictions.Apartment_Key = Apartments.Apartment_Key)
+                    AND {get_segments_condition()}"""
+        data = read_sql_query(select_top(engine, query, chunksize, 'Apartment_Key'), engine,
+                              index_col='Apartment_Key')
+        if data.empty:
+            break
+        chunk_last_key = int(data.index.max())
+        data = prepare_data(data)
+        if not data.empty:
+            predictions = score(data)
+            predicted += bulk_insert(predictions, 'Predictions', engine, key_columns=['Apartment_Key'], schema='dbo')
+        last_apartment_key = chunk_last_key
+        write_high_water_mark(last_apartment_key)
+        logging.info(f'Chunk up to Apartment_Key {last_apartment_key}, predicted: {predicted}')
+
+    print(f'Predicted apartments: {predicted}')
+    logging.info(f'Predicted apartments: {predicted}')
+
+
+def main_snapshot() -> None:
+    # Apartments come from the local Parquet snapshot, the database is only asked for new rows
+    # and for the keys that already have predictions
+    engine = get_sqlalchemy_engine()
+    synced = sync(engine)
+    logging.info(f'Snapshot synced apartments: {synced}')
+    predicted_keys = read_sql_query('SELECT Apartment_Key FROM Predictions', engine)['Apartment_Key']
+    models_info = REGISTRY.get_main_models_info()
+
+    with METRICS.stage('read_snapshot') as stage:
+        data = read_snapshot(APARTMENT_COLUMNS + ['Apartment_Key'])
+        stage.rows = len(data)
+    data = data[~data['Apartment_Key'].isin(predicted_keys) & is_in_segments(data, models_info)]
+    data = prepare_data(data.set_index('Apartment_Key'))
+    input_data_message = f'Input data shape: {data.shape}'
+    print(input_data_message)
+    logging.info(input_data_message)
+    if not data.empty:
+        predictions = score(data)
+        bulk_insert(predictions, 'Predictions', engine, key_columns=['Apartment_Key'], schema='dbo')
+    else:
+        logging.info('There are no new apartments to predictions')
+
+
+def main_new_apartments(data: pd.DataFrame) -> int:
+    # Rows handed over by downloader in the same run, indexed by Apartment_Key, are scored without reading them back
+    models_info = REGISTRY.get_main_models_info()
+    data = data.reindex(columns=APARTMENT_COLUMNS)
+    data = prepare_data(data[is_in_segments(data, models_info)])
+    input_data_message = f'Input data shape: {data.shape}'
+    print(input_data_message)
+    logging.info(input_data_message)
+    if data.empty:
+        logging.info('There are no new apartments to predictions')
+        return 0
+    predictions = score(data)
+    return bulk_insert(predictions, 'Predictions', get_sqlalchemy_engine(), key_columns=['Apartment_Key'], schema='dbo')
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunksize', type=int,
+                        help='Stream apartments in chunks of this size, resuming from the saved Apartment_Key')
+    parser.add_argument('--snapshot', action='store_true',
+                        help='Read apartments from the local Parquet snapshot instead of the database')
+    parser.add_argument('--reset', action='store_true',
+                        help='Start streaming from the first apartment, e.g. after adding a model for a new segment')
+    parser.add_argument('--profile-stage', help='Run this stage under cProfile, e.g. prepare_data or predict')
+    args = parser.parse_args()
+    METRICS.profile_stage = args.profile_stage or METRICS.profile_stage
+
     log_file = Path(__file__).parent.parent.joinpath('logs').joinpath('predictor.txt')
     logging.basicConfig(
         format='[%(asctime)s] -- %(levelname).3s -- %(message)s',
@@ -102,6 +269,15 @@ if __name__ == '__main__':
 
     logging.info('Predictor start')
     try:
-        main()
+        if args.snapshot:
+            main_snapshot()
+        elif args.chunksize:
+            if args.reset:
+                write_high_water_mark(0)
+            main_streaming(args.chunksize)
+        else:
+            main()
     except Exception as e:
         logging.exception(e)
+    finally:
+        METRICS.write('predictor')
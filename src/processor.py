@@ -1,6 +1,108 @@
+import operator
+from typing import (
+    Any,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+import numpy as np
 import pandas as pd
 
 
+class FilterRule(NamedTuple):
+    # Fires when all (column, operator, value) conditions hold, or when any fails if negate is set.
+    # rooms restricts the rule to apartments with this Rooms_Number
+    name: str
+    conditions: Tuple[Tuple[str, str, Any], ...]
+    rooms: Optional[int] = None
+    negate: bool = False
+
+
+OPERATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '==': operator.eq,
+    '!=': operator.ne,
+    'in': lambda column, values: column.isin(values),
+}
+
+# Dummy column -> category value for every categorical column, the order is the order of the dummies
+CATEGORY_SCHEMA = {
+    'District': {
+        'District_Kir': 'кировский район',
+        'District_Len': 'ленинский район',
+        'District_Sov': 'советский район',
+        'District_Oct': 'октябрьский район',
+    },
+    'Material': {
+        'Material_Brick': 'кирпич',
+        'Material_Monolith': 'монолит',
+        'Material_Panel': 'панель',
+        'Material_Not_Info': 'Нет значения',
+    },
+    'Apartment_Condition': {
+        'Apartment_Condition_Excellent': 'в отличном состоянии',
+        'Apartment_Condition_Good': 'в хорошем состоянии',
+        'Apartment_Condition_Need_Repair': 'требуется ремонт',
+        'Apartment_Condition_Raw_Finish': 'черновая отделка',
+        'Apartment_Condition_Not_Info': 'Нет значения',
+    },
+    'Bathroom_Type': {
+        'Bathroom_Type_Combined': 'совмещенный',
+        'Bathroom_Type_Separate': 'раздельный',
+        'Bathroom_Type_Not_Info': 'Нет значения',
+    },
+    'Balcony_Loggia': {
+        'Balcony_Loggia_Balcony': 'балкон',
+        'Balcony_Loggia_Loggia': 'лоджия',
+        'Balcony_Loggia_Balcony_Glazing': 'балкон, остекление',
+        'Balcony_Loggia_Loggia_Glazing': 'лоджия, остекление',
+        'Balcony_Loggia_Not_Info': 'Нет значения',
+    },
+}
+
+# Rows matching any of these rules are dropped, the rules are written as conditions to keep
+MAIN_RULES = [
+    FilterRule('Rooms_Number > 4', (('Rooms_Number', '<=', 4),), negate=True),
+    FilterRule('Material', (('Material', 'in', ('кирпич', 'панель', 'монолит', 'Нет значения')),), negate=True),
+    FilterRule('Year_Building < 1960', (('Year_Building', '>=', 1960),), negate=True),
+    FilterRule('Floors_In_Building == 1', (('Floors_In_Building', '!=', 1),), negate=True),
+    FilterRule('Floor == 0', (('Floor', '!=', 0),), negate=True),
+]
+
+# Rows matching any of these rules are marked Not_Used with the rule names in Not_Used_Description
+ROOMS_RULES = [
+    FilterRule('Price < 500', (('Price', '<', 500),), rooms=1),
+    FilterRule('Price > 3000', (('Price', '>', 3000),), rooms=1),
+    FilterRule('Square_Total < 12', (('Square_Total', '<', 12),), rooms=1),
+    FilterRule('Square_Total > 50', (('Square_Total', '>', 50),), rooms=1),
+    FilterRule('Floors_In_Building == 3, Price > 2000',
+               (('Floors_In_Building', '==', 3), ('Price', '>', 2000)), rooms=1),
+    FilterRule('Floors_In_Building == 4, Price > 2500',
+               (('Floors_In_Building', '==', 4), ('Price', '>', 2500)), rooms=1),
+    FilterRule('Floors_In_Building == 12, Price > 2800',
+               (('Floors_In_Building', '==', 12), ('Price', '>', 2800)), rooms=1),
+    FilterRule('Floors_In_Building == 19, Price < 1500',
+               (('Floors_In_Building', '==', 19), ('Price', '<', 1500)), rooms=1),
+    FilterRule('Raw finish, Price < 1400',
+               (('Apartment_Condition', '==', 'черновая отделка'), ('Price', '<', 1400)), rooms=1),
+    FilterRule('Raw finish, Price > 2500',
+               (('Apartment_Condition', '==', 'черновая отделка'), ('Price', '>', 2500)), rooms=1),
+    FilterRule('Balcony_Loggia',
+               (('Balcony_Loggia', 'in', ('2 лоджии',
+                                          'балкон и лоджия, остекление',
+                                          '2 балкона',
+                                          '2 лоджии, остекление',
+                                          '2 балкона, остекление',
+                                          'балкон и лоджия')),), rooms=1),
+]
+
+
 def clean(df: pd.DataFrame) -> pd.DataFrame:
     return df[df['Not_Used'] == 0]
 
@@ -14,23 +116,45 @@ def parse_square(x: str) -> float:
     return float(x.replace(' кв.м', '')) if x else None
 
 
+def parse_floor_series(s: pd.Series) -> pd.Series:
+    # Vectorized parse_floor: leading number before '/', 0 if it is not a number
+    return s.str.extract(r'^(\d+)(?:/|$)', expand=False).fillna('0').astype('int64')
+
+
+def parse_square_series(s: pd.Series) -> pd.Series:
+    # Vectorized parse_square: empty values become NaN, already parsed squares are kept
+    if pd.api.types.is_numeric_dtype(s):
+        return s.astype(float)
+    square = s.str.replace(' кв.м', '', regex=False)
+    return square.mask(square == '').astype(float)
+
+
+def convert_types(df: pd.DataFrame) -> pd.DataFrame:
+    # Raw site values to typed columns, typed columns (e.g. from the Parquet snapshot) are kept as they are
+    if not pd.api.types.is_datetime64_any_dtype(df['Date_Add']):
+        df['Date_Add'] = pd.to_datetime(df['Date_Add'], format='%d.%m.%Y %H:%M:%S')
+    if not pd.api.types.is_datetime64_any_dtype(df['Date_Expiration']):
+        df['Date_Expiration'] = pd.to_datetime(df['Date_Expiration'], format='%d.%m.%Y')
+    df['Year_Building'] = df['Year_Building'].astype(float)
+    for column in ['Rooms_Number', 'Floors_In_Building']:
+        if not pd.api.types.is_integer_dtype(df[column]):
+            df[column] = df[column].astype(int)
+    df['Square_Total'] = parse_square_series(df['Square_Total'])
+    df['Square_Kitchen'] = parse_square_series(df['Square_Kitchen'])
+    df['Square_Living'] = parse_square_series(df['Square_Living'])
+    return df
+
+
 def handle_dataframe(df: pd.DataFrame) -> pd.DataFrame:
     # Change columns type
-    df['Date_Add'] = df['Date_Add'].apply(lambda x: pd.to_datetime(x, format='%d.%m.%Y %H:%M:%S'))
-    df['Date_Expiration'] = df['Date_Expiration'].apply(lambda x: pd.to_datetime(x, format='%d.%m.%Y'))
-    df['Year_Building'] = df['Year_Building'].astype(float)
-    df['Rooms_Number'] = df['Rooms_Number'].astype(int)
-    df['Floors_In_Building'] = df['Floors_In_Building'].astype(int)
+    df = convert_types(df)
 
     # Change columns values
-    df['Square_Total'] = df['Square_Total'].apply(parse_square)
-    df['Square_Kitchen'] = df['Square_Kitchen'].apply(parse_square)
-    df['Square_Living'] = df['Square_Living'].apply(parse_square)
     df['Address'] = 'Томск, ' + df['Address']
     df['Price'] = df['Price'] / 1000
 
     # Insert new columns
-    df.insert(7, 'Floor', df['Floor_Numbers_Of_Floors'].apply(parse_floor))
+    df.insert(7, 'Floor', parse_floor_series(df['Floor_Numbers_Of_Floors']))
     df.insert(19, 'Not_Used', 0)
     df.insert(20, 'Not_Used_Description', None)
 
@@ -42,91 +166,89 @@ def handle_dataframe(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
+def evaluate_rules(df: pd.DataFrame, rules: List[FilterRule]) -> np.ndarray:
+    # Bit i of the result is set for rows where rules[i] fired, shared conditions are computed once
+    if len(rules) > 64:
+        raise ValueError(f'At most 64 rules are supported, got {len(rules)}')
+    conditions = {}
+    bitmask = np.zeros(len(df), dtype=np.uint64)
+    for bit, rule in enumerate(rules):
+        fired = np.ones(len(df), dtype=bool)
+        for condition in rule.conditions:
+            if condition not in conditions:
+                column, operator_name, value = condition
+                conditions[condition] = OPERATORS[operator_name](df[column], value).to_numpy(dtype=bool)
+            fired &= conditions[condition]
+        if rule.negate:
+            fired = ~fired
+        if rule.rooms is not None:
+            fired &= (df['Rooms_Number'] == rule.rooms).to_numpy(dtype=bool)
+        bitmask |= fired.astype(np.uint64) << np.uint64(bit)
+    return bitmask
+
+
+def describe_rules(bitmask: np.ndarray, rules: List[FilterRule]) -> pd.Series:
+    descriptions = {i: '; '.join(rule.name for bit, rule in enumerate(rules) if int(i) >> bit & 1)
+                    for i in np.unique(bitmask)}
+    return pd.Series(bitmask).map(descriptions)
+
+
+def flag_df(df: pd.DataFrame, rules: List[FilterRule]) -> pd.DataFrame:
+    bitmask = evaluate_rules(df, rules)
+    fired = bitmask != 0
+    df.loc[fired, 'Not_Used'] = 1
+    df.loc[fired, 'Not_Used_Description'] = describe_rules(bitmask[fired], rules).values
+    return df
+
+
 def filter_df_main(df: pd.DataFrame) -> pd.DataFrame:
     df.drop(['Square_Kitchen', 'Square_Living', 'Apartment_Type'], axis=1, inplace=True)
     columns_to_fill_na = ['Material', 'Apartment_Condition', 'Bathroom_Type', 'Balcony_Loggia']
-    df.loc[:, columns_to_fill_na].fillna('Нет значения', inplace=True)
-    df = df[df['Rooms_Number'] <= 4]
-    df = df[[i in ['кирпич', 'панель', 'монолит', 'Нет значения'] for i in df['Material']]]
-    df = df[df['Year_Building'] >= 1960]
-    df = df[df['Floors_In_Building'] != 1]
-    df = df[df['Floor'] != 0]
-    return df
+    df[columns_to_fill_na] = df[columns_to_fill_na].fillna('Нет значения')
+    return df[evaluate_rules(df, MAIN_RULES) == 0]
+
+
+def filter_df_rooms(df: pd.DataFrame, rules: List[FilterRule] = None) -> pd.DataFrame:
+    return clean(flag_df(df, ROOMS_RULES if rules is None else rules))
 
 
 def filter_df_room_1(df: pd.DataFrame) -> pd.DataFrame:
-    # Price
-    idx_lower_price = df['Price'] < 500
-    idx_higher_price = df['Price'] > 3000
-    df.loc[idx_lower_price, 'Not_Used'] = 1
-    df.loc[idx_higher_price, 'Not_Used'] = 1
-
-    # Square_Total
-    idx_lower_square = df['Square_Total'] < 12
-    idx_higher_square = df['Square_Total'] > 50
-    df.loc[idx_lower_square, 'Not_Used'] = 1
-    df.loc[idx_higher_square, 'Not_Used'] = 1
-
-    # Floors_In_Building
-    # Floors_In_Building == 3
-    idx_higher_price_3_floor = (df['Floors_In_Building'] == 3) & (df['Price'] > 2000)
-    df.loc[idx_higher_price_3_floor, 'Not_Used'] = 1
-
-    # Floors_In_Building == 4
-    idx_higher_price_4_floor = (df['Floors_In_Building'] == 4) & (df['Price'] > 2500)
-    df.loc[idx_higher_price_4_floor, 'Not_Used'] = 1
-
-    # Floors_In_Building == 12
-    idx_higher_price_12_floor = (df['Floors_In_Building'] == 12) & (df['Price'] > 2800)
-    df.loc[idx_higher_price_12_floor, 'Not_Used'] = 1
-
-    # Floors_In_Building == 19
-    idx_lower_price_19_floor = (df['Floors_In_Building'] == 19) & (df['Price'] < 1500)
-    df.loc[idx_lower_price_19_floor, 'Not_Used'] = 1
-
-    # Apartment_Condition
-    idx_lower_price_apartment_condition = (df['Apartment_Condition'] == 'черновая отделка') & (df['Price'] < 1400)
-    idx_higher_price_apartment_condition = (df['Apartment_Condition'] == 'черновая отделка') & (df['Price'] > 2500)
-    df.loc[idx_lower_price_apartment_condition, 'Not_Used'] = 1
-    df.loc[idx_higher_price_apartment_condition, 'Not_Used'] = 1
-
-    # Balcony_Loggia
-    balcony_loggia_to_delete = ['2 лоджии',
-                                'балкон и лоджия, остекление',
-                                '2 балкона',
-                                '2 лоджии, остекление',
-                                '2 балкона, остекление',
-                                'балкон и лоджия']
-    idx_to_delete = [i in balcony_loggia_to_delete for i in df['Balcony_Loggia']]
-    df.loc[idx_to_delete, 'Not_Used'] = 1
-    return clean(df)
+    return filter_df_rooms(df, [i for i in ROOMS_RULES if i.rooms == 1])
+
+
+class CategoricalEncoder:
+    # One-hot encoder fitted from a fixed category schema instead of the data,
+    # values missing from the schema (including NaN) get all dummy columns False
+    def __init__(self, schema: Dict[str, Dict[str, str]] = None) -> None:
+        self.schema = CATEGORY_SCHEMA if schema is None else schema
+        self.categories = {column: pd.Index(list(features.values())) for column, features in self.schema.items()}
+        self.features = [feature for features in self.schema.values() for feature in features]
+
+    def encode_column(self, df: pd.DataFrame, column: str) -> Dict[str, np.ndarray]:
+        categories = self.categories[column]
+        codes = categories.get_indexer(df[column])
+        # Code -1 selects the extra last row of the identity matrix, which is dropped with the last column
+        one_hot = np.eye(len(categories) + 1, dtype=bool)[codes, :-1]
+        return dict(zip(self.schema[column], one_hot.T))
+
+    def transform(self, df: pd.DataFrame, features: List[str] = None) -> pd.DataFrame:
+        # Returns exactly the requested features in the requested order, dummies by default
+        features = self.features if features is None else features
+        difference_between_columns = set(features).difference(self.features).difference(df.columns)
+        if difference_between_columns:
+            raise ValueError(f'Columns {difference_between_columns} not found in put data')
+
+        columns = {}
+        for column in self.schema:
+            if any(feature in self.schema[column] for feature in features):
+                columns.update(self.encode_column(df, column))
+        data = {feature: columns[feature] if feature in columns else df[feature].to_numpy() for feature in features}
+        return pd.DataFrame(data, index=df.index, columns=features)
+
+
+ENCODER = CategoricalEncoder()
 
 
 def convert_to_dummies(df: pd.DataFrame) -> pd.DataFrame:
-    df['District_Kir'] = df['District'] == 'кировский район'
-    df['District_Len'] = df['District'] == 'ленинский район'
-    df['District_Sov'] = df['District'] == 'советский район'
-    df['District_Oct'] = df['District'] == 'октябрьский район'
-
-    df['Material_Brick'] = df['Material'] == 'кирпич'
-    df['Material_Monolith'] = df['Material'] == 'монолит'
-    df['Material_Panel'] = df['Material'] == 'панель'
-    df['Material_Not_Info'] = df['Material'] == 'Нет значения'
-
-    df['Apartment_Condition_Excellent'] = df['Apartment_Condition'] == 'в отличном состоянии'
-    df['Apartment_Condition_Good'] = df['Apartment_Condition'] == 'в хорошем состоянии'
-    df['Apartment_Condition_Need_Repair'] = df['Apartment_Condition'] == 'требуется ремонт'
-    df['Apartment_Condition_Raw_Finish'] = df['Apartment_Condition'] == 'черновая отделка'
-    df['Apartment_Condition_Not_Info'] = df['Apartment_Condition'] == 'Нет значения'
-
-    df['Bathroom_Type_Combined'] = df['Bathroom_Type'] == 'совмещенный'
-    df['Bathroom_Type_Separate'] = df['Bathroom_Type'] == 'раздельный'
-    df['Bathroom_Type_Not_Info'] = df['Bathroom_Type'] == 'Нет значения'
-
-    df['Balcony_Loggia_Balcony'] = df['Balcony_Loggia'] == 'балкон'
-    df['Balcony_Loggia_Loggia'] = df['Balcony_Loggia'] == 'лоджия'
-    df['Balcony_Loggia_Balcony_Glazing'] = df['Balcony_Loggia'] == 'балкон, остекление'
-    df['Balcony_Loggia_Loggia_Glazing'] = df['Balcony_Loggia'] == 'лоджия, остекление'
-    df['Balcony_Loggia_Not_Info'] = df['Balcony_Loggia'] == 'Нет значения'
-    df.drop(['District', 'Material', 'Apartment_Condition', 'Bathroom_Type', 'Balcony_Loggia'], axis=1, inplace=True)
-    return df
+    dummies = ENCODER.transform(df)
+    return pd.concat([df.drop(list(ENCODER.schema), axis=1), dummies], axis=1)
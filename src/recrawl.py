@@ -0,0 +1,265 @@
+import argparse
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import (
+    date,
+    datetime,
+    timedelta,
+)
+from pathlib import Path
+from threading import Lock
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+import pandas as pd
+import requests
+from sqlalchemy.engine import Engine
+from tqdm import tqdm
+
+from downloader import (
+    HostRateLimiter,
+    log_bad_link,
+    parse_apartment_html,
+)
+from metrics import METRICS
+from sql_connector import (
+    bulk_insert,
+    get_sqlalchemy_engine,
+    read_sql_query,
+    select_top,
+)
+
+BASE_PATH = Path(__file__).parent.parent
+RECRAWL_STATE_PATH = BASE_PATH.joinpath('cache').joinpath('recrawl_state.sqlite')
+
+# One session per fetcher thread, requests.Session is not shared between threads
+SESSIONS = threading.local()
+
+# Apartment_Key, Url, Price, Date_Expiration, Etag, Last_Modified, Fingerprint
+Listing = Tuple[int, str, int, str, Optional[str], Optional[str], Optional[str]]
+
+
+class RecrawlState:
+    # Last seen state of every listing in Apartments: validators for conditional requests,
+    # fingerprint of the parsed detail block, price and expiration date. Dates are ISO strings
+    def __init__(self, path: Path = RECRAWL_STATE_PATH) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(
+            """CREATE TABLE IF NOT EXISTS Listings (Apartment_Key INTEGER PRIMARY KEY,
+                                                    Url TEXT NOT NULL,
+                                                    Date_Add TEXT,
+                                                    Price INTEGER,
+                                                    Date_Expiration TEXT,
+                                                    Etag TEXT,
+                                                    Last_Modified TEXT,
+                                                    Fingerprint TEXT,
+                                                    Checked_At TEXT,
+                                                    Removed_At TEXT);
+               CREATE INDEX IF NOT EXISTS Listings_Due ON Listings (Removed_At, Date_Expiration, Checked_At);""")
+
+    def get_last_apartment_key(self) -> int:
+        with self.lock:
+            return self.connection.execute('SELECT COALESCE(MAX(Apartment_Key), 0) FROM Listings').fetchone()[0]
+
+    def add_listings(self, data: pd.DataFrame) -> None:
+        records = data[['Apartment_Key', 'Url_Link', 'Date_Add', 'Price', 'Date_Expiration']]
+        records = records.astype(object).where(records.notna(), None).itertuples(index=False, name=None)
+        with self.lock, self.connection:
+            self.connection.executemany(
+                """INSERT OR IGNORE INTO Listings (Apartment_Key, Url, Date_Add, Price, Date_Expiration)
+                   VALUES (?, ?, ?, ?, ?)""", records)
+
+    def get_due(self, today: date, checked_before: datetime, limit: int = None) -> List[Listing]:
+        # Active listings not checked since checked_before: never checked first, then the longest unchecked,
+        # older listings first among equals. Listings without an expiration date are active
+        with self.lock:
+            return self.connection.execute(
+                """SELECT Apartment_Key, Url, Price, Date_Expiration, Etag, Last_Modified, Fingerprint
+                   FROM Listings
+                   WHERE Removed_At IS NULL AND (Date_Expiration IS NULL OR Date_Expiration >= ?)
+                   AND (Checked_At IS NULL OR Checked_At < ?)
+                   ORDER BY Checked_At IS NOT NULL, Checked_At, Date_Add
+                   LIMIT ?""",
+                (today.isoformat(), checked_before.isoformat(sep=' '), -1 if limit is None else limit)).fetchall()
+
+    def update(self, checks: List[Dict[str, Any]]) -> None:
+        with self.lock, self.connection:
+            self.connection.executemany(
+                """UPDATE Listings SET Price = :Price, Date_Expiration = :Date_Expiration, Etag = :Etag,
+                                       Last_Modified = :Last_Modified, Fingerprint = :Fingerprint,
+                                       Checked_At = :Checked_At, Removed_At = :Removed_At
+                   WHERE Apartment_Key = :Apartment_Key""", checks)
+
+
+def sync(engine: Engine, state: RecrawlState, chunksize: int = 100000) -> int:
+    # Listings inserted since the last sync are added to the state, in Apartment_Key order
+    last_apartment_key = state.get_last_apartment_key()
+    synced = 0
+    while True:
+        query = f"""SELECT Apartment_Key, Url_Link, Date_Add, Price, Date_Expiration
+                    FROM Apartments
+                    WHERE Apartment_Key > {int(last_apartment_key)}"""
+        data = read_sql_query(select_top(engine, query, chunksize, 'Apartment_Key'), engine)
+        if data.empty:
+            return synced
+        data['Date_Add'] = pd.to_datetime(data['Date_Add'], format='%d.%m.%Y %H:%M:%S', errors='coerce')
+        data['Date_Add'] = data['Date_Add'].dt.strftime('%Y-%m-%d %H:%M:%S')
+        data['Date_Expiration'] = get_iso_dates(data['Date_Expiration'])
+        state.add_listings(data)
+        last_apartment_key = int(data['Apartment_Key'].max())
+        synced += len(data)
+
+
+def get_iso_dates(dates: pd.Series) -> pd.Series:
+    return pd.to_datetime(dates, format='%d.%m.%Y', errors='coerce').dt.strftime('%Y-%m-%d')
+
+
+def get_fingerprint(items: Dict[str, Any]) -> str:
+    # Everything parsed from the detail block except the link itself
+    block = {key: value for key, value in items.items() if key != 'Url_Link'}
+    return hashlib.sha1(json.dumps(block, sort_keys=True, ensure_ascii=False, default=str).encode()).hexdigest()
+
+
+def get_session() -> requests.Session:
+    if not hasattr(SESSIONS, 'session'):
+        SESSIONS.session = requests.Session()
+    return SESSIONS.session
+
+
+def check_listing(listing: Listing, limiter: HostRateLimiter) -> Tuple[str, Dict[str, Any]]:
+    # Returns the result and the new state of the listing. A 304 answer to a conditional request
+    # and an unchanged fingerprint cost no parsing or write respectively
+    apartment_key, url, price, date_expiration, etag, last_modified, fingerprint = listing
+    check = {'Apartment_Key': apartment_key, 'Price': price, 'Date_Expiration': date_expiration, 'Etag': etag,
+             'Last_Modified': last_modified, 'Fingerprint': fingerprint,
+             'Checked_At': datetime.now().isoformat(sep=' '), 'Removed_At': None}
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    try:
+        limiter.wait(url)
+        with METRICS.timer('fetch_seconds'):
+            response = get_session().get(url, headers=headers)
+        METRICS.inc('http_responses_total', status=str(response.status_code))
+        if response.status_code == 304:
+            return 'not_modified', check
+        if response.status_code in (404, 410):
+            check['Removed_At'] = check['Checked_At']
+            return 'removed', check
+        response.raise_for_status()
+        items = parse_apartment_html(response.text, url)
+    except Exception as e:
+        log_bad_link(url, e)
+        return 'failed', check
+
+    check['Etag'] = response.headers.get('ETag')
+    check['Last_Modified'] = response.headers.get('Last-Modified')
+    check['Fingerprint'] = get_fingerprint(items)
+    if check['Fingerprint'] == fingerprint:
+        return 'unchanged', check
+    check['Price'] = items['Price']
+    check['Date_Expiration'] = get_iso_dates(pd.Series([items['Date_Expiration']])).iloc[0]
+    # The first fingerprint of a listing is compared with the row in Apartments instead
+    if fingerprint is None and (check['Price'], check['Date_Expiration']) == (price, date_expiration):
+        return 'unchanged', check
+    return 'changed', check
+
+
+def get_price_history(checks: List[Tuple[str, Dict[str, Any]]]) -> pd.DataFrame:
+    rows = [{'Apartment_Key': check['Apartment_Key'],
+             'Observed_At': datetime.fromisoformat(check['Checked_At']),
+             'Price': check['Price'],
+             'Date_Expiration': pd.to_datetime(check['Date_Expiration']).strftime('%d.%m.%Y')
+             if check['Date_Expiration'] else None,
+             'Is_Removed': int(result == 'removed')}
+            for result, check in checks if result in ('changed', 'removed')]
+    return pd.DataFrame(rows)
+
+
+def iter_checks(listings: List[Listing],
+                concurrency: int,
+                rate: float,
+                burst: float) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    limiter = HostRateLimiter(rate, burst)
+    with ThreadPoolExecutor(concurrency) as executor:
+        yield from executor.map(lambda listing: check_listing(listing, limiter), listings)
+
+
+def write_checks(checks: List[Tuple[str, Dict[str, Any]]], engine: Engine, state: RecrawlState) -> None:
+    # History is written before the state, so a crash in between only repeats the check
+    bulk_insert(get_price_history(checks), 'Price_History', engine, key_columns=['Apartment_Key', 'Observed_At'],
+                schema='dbo')
+    state.update([check for _, check in checks])
+
+
+def main(limit: int = None,
+         min_interval: timedelta = timedelta(days=1),
+         concurrency: int = 8,
+         rate: float = 1.0,
+         burst: float = 2.0,
+         batch_size: int = 500) -> Dict[str, int]:
+    # Revisits active listings (Date_Expiration not passed) and writes a Price_History row only for
+    # listings that changed or were removed
+    engine = get_sqlalchemy_engine()
+    state = RecrawlState()
+    logging.info(f'Listings added to the recrawl state: {sync(engine, state)}')
+    listings = state.get_due(date.today(), datetime.now() - min_interval, limit)
+    logging.info(f'Listings to recrawl: {len(listings)}')
+
+    results = {'not_modified': 0, 'unchanged': 0, 'changed': 0, 'removed': 0, 'failed': 0}
+    batch = []
+    with METRICS.stage('recrawl', len(listings)):
+        for result, check in tqdm(iter_checks(listings, concurrency, rate, burst), total=len(listings),
+                                  desc='Listings', leave=False, ascii=True):
+            results[result] += 1
+            METRICS.inc('recrawl_listings_total', result=result)
+            batch.append((result, check))
+            if len(batch) >= batch_size:
+                write_checks(batch, engine, state)
+                batch = []
+        write_checks(batch, engine, state)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Revisit active listings and record price changes and removals')
+    parser.add_argument('--limit', type=int, help='Listings checked in this run, the longest unchecked first')
+    parser.add_argument('--min-interval', type=float, default=24.0,
+                        help='Hours before a checked listing is checked again')
+    parser.add_argument('--concurrency', type=int, default=8, help='Number of fetcher threads')
+    parser.add_argument('--rate', type=float, default=1.0, help='Requests per second per host')
+    parser.add_argument('--burst', type=float, default=2.0, help='Token bucket capacity per host')
+    parser.add_argument('--batch-size', type=int, default=500, help='Checked listings per write')
+    args = parser.parse_args()
+
+    log_file = BASE_PATH.joinpath('logs').joinpath('recrawl.txt')
+    logging.basicConfig(
+        format='[%(asctime)s] -- %(levelname).3s -- %(message)s',
+        datefmt='%Y.%m.%d %H:%M:%S',
+        level=logging.DEBUG,
+        filename=log_file)
+
+    logging.info('Recrawl start')
+    try:
+        recrawl_results = main(args.limit, timedelta(hours=args.min_interval), args.concurrency, args.rate,
+                               args.burst, args.batch_size)
+        print(f'Recrawled listings: {recrawl_results}')
+        logging.info(f'Recrawled listings: {recrawl_results}')
+    except Exception as e:
+        logging.exception(e)
+    finally:
+        METRICS.write('recrawl')
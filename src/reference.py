@@ -0,0 +1,72 @@
+import pandas as pd
+
+from processor import (
+    clean,
+    parse_floor,
+    parse_square,
+)
+
+
+def handle_dataframe_apply(df: pd.DataFrame) -> pd.DataFrame:
+    # Previous per-element implementation of processor.handle_dataframe, kept as the reference
+    df['Date_Add'] = df['Date_Add'].apply(lambda x: pd.to_datetime(x, format='%d.%m.%Y %H:%M:%S'))
+    df['Date_Expiration'] = df['Date_Expiration'].apply(lambda x: pd.to_datetime(x, format='%d.%m.%Y'))
+    df['Year_Building'] = df['Year_Building'].astype(float)
+    df['Rooms_Number'] = df['Rooms_Number'].astype(int)
+    df['Floors_In_Building'] = df['Floors_In_Building'].astype(int)
+    df['Square_Total'] = df['Square_Total'].apply(parse_square)
+    df['Square_Kitchen'] = df['Square_Kitchen'].apply(parse_square)
+    df['Square_Living'] = df['Square_Living'].apply(parse_square)
+    df['Address'] = 'Томск, ' + df['Address']
+    df['Price'] = df['Price'] / 1000
+    df.insert(7, 'Floor', df['Floor_Numbers_Of_Floors'].apply(parse_floor))
+    df.insert(19, 'Not_Used', 0)
+    df.insert(20, 'Not_Used_Description', None)
+    df = df[df['Sales_Type'] == 'вторичное']
+    df.drop(['Floor_Numbers_Of_Floors', 'Id', 'Sales_Type'], axis=1, inplace=True)
+    return df
+
+
+def filter_df_main_masks(df: pd.DataFrame) -> pd.DataFrame:
+    # Previous mask chain implementation of processor.filter_df_main, kept as the reference
+    df.drop(['Square_Kitchen', 'Square_Living', 'Apartment_Type'], axis=1, inplace=True)
+    columns_to_fill_na = ['Material', 'Apartment_Condition', 'Bathroom_Type', 'Balcony_Loggia']
+    df[columns_to_fill_na] = df[columns_to_fill_na].fillna('Нет значения')
+    df = df[df['Rooms_Number'] <= 4]
+    df = df[[i in ['кирпич', 'панель', 'монолит', 'Нет значения'] for i in df['Material']]]
+    df = df[df['Year_Building'] >= 1960]
+    df = df[df['Floors_In_Building'] != 1]
+    df = df[df['Floor'] != 0]
+    return df
+
+
+def filter_df_room_1_masks(df: pd.DataFrame) -> pd.DataFrame:
+    # Same masks as the previous processor.filter_df_room_1, kept as the reference
+    price = df['Price']
+    idx_to_delete = (price < 500) | (price > 3000)
+    idx_to_delete |= (df['Square_Total'] < 12) | (df['Square_Total'] > 50)
+    idx_to_delete |= (df['Floors_In_Building'] == 3) & (price > 2000)
+    idx_to_delete |= (df['Floors_In_Building'] == 4) & (price > 2500)
+    idx_to_delete |= (df['Floors_In_Building'] == 12) & (price > 2800)
+    idx_to_delete |= (df['Floors_In_Building'] == 19) & (price < 1500)
+    raw_finish = df['Apartment_Condition'] == 'черновая отделка'
+    idx_to_delete |= raw_finish & ((price < 1400) | (price > 2500))
+    balcony_loggia_to_delete = ['2 лоджии',
+                                'балкон и лоджия, остекление',
+                                '2 балкона',
+                                '2 лоджии, остекление',
+                                '2 балкона, остекление',
+                                'балкон и лоджия']
+    idx_to_delete |= pd.Series([i in balcony_loggia_to_delete for i in df['Balcony_Loggia']], index=df.index)
+    df.loc[idx_to_delete, 'Not_Used'] = 1
+    return clean(df)
+
+
+def get_top_n_per_day_apply(data: pd.DataFrame, top_n: int = 10) -> pd.DataFrame:
+    # Previous per-day sort of make_excel.get_data_for_make_excel, kept as the reference.
+    # The sort is stable, so tied errors keep the input order
+    data = data.set_index('Date_Add')
+    data = data.groupby(pd.Grouper(freq='D')).apply(lambda x: x.sort_values('Error', kind='stable').iloc[0:top_n])
+    data.reset_index(level=0, drop=True, inplace=True)
+    data.reset_index(inplace=True)
+    return data.sort_values(['Date_Add', 'Error'], ascending=[False, True])
@@ -0,0 +1,131 @@
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    as_completed,
+)
+from pathlib import Path
+from typing import (
+    Dict,
+    List,
+    Tuple,
+)
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+import predictor
+from db_schema import PREDICTIONS_VERSIONS
+from sql_connector import (
+    bulk_insert,
+    get_sqlalchemy_engine,
+)
+
+# Predictions of every model are kept side by side, keyed by Model_Key and Apartment_Key
+VERSIONED_TABLE = 'Predictions_Versions'
+
+REGISTRIES: Dict[int, predictor.ModelRegistry] = {}
+
+
+class FixedModelRegistry(predictor.ModelRegistry):
+    # Scores with the given model instead of the main models from Models
+    def __init__(self, model_info: pd.DataFrame) -> None:
+        super().__init__(max_models=1)
+        self.model_info = model_info
+
+    def get_main_models_info(self) -> pd.DataFrame:
+        return self.model_info
+
+
+def get_models_info(model_keys: List[int] = None) -> pd.DataFrame:
+    condition = f"Model_Key IN ({', '.join(str(int(i)) for i in model_keys)})" if model_keys else 'Is_main = 1'
+    sql_expression = f"""SELECT Model_Key,
+                                {', '.join(predictor.SEGMENT_COLUMNS)},
+                                Model_path,
+                                Model_features
+                         FROM Models
+                         WHERE {condition}"""
+    return pd.read_sql_query(sql_expression, get_sqlalchemy_engine())
+
+
+def get_key_ranges(partitions: int) -> List[Tuple[int, int]]:
+    keys = pd.read_sql_query('SELECT MIN(Apartment_Key) AS Min_Key, MAX(Apartment_Key) AS Max_Key '
+                             'FROM Apartments', get_sqlalchemy_engine())
+    min_key, max_key = keys.iloc[0]
+    if pd.isna(min_key):
+        return []
+    bounds = np.linspace(int(min_key), int(max_key) + 1, partitions + 1).astype(np.int64)
+    return [(int(i), int(j)) for i, j in zip(bounds[:-1], bounds[1:]) if i < j]
+
+
+def init_worker(models_info: pd.DataFrame) -> None:
+    # Connections inherited from the parent process must not be reused, every model is unpickled once per worker
+    get_sqlalchemy_engine().dispose(close=False)
+    for model_info in models_info.itertuples(index=False):
+        registry = FixedModelRegistry(models_info[models_info['Model_Key'] == model_info.Model_Key])
+        registry.get_model(model_info.Model_path)
+        REGISTRIES[model_info.Model_Key] = registry
+
+
+def rescore_range(start_key: int, end_key: int) -> int:
+    query = f"""{predictor.QUERY_APARTMENTS}
+                WHERE Apartment_Key >= {start_key} AND Apartment_Key < {end_key}"""
+    data = pd.read_sql_query(query, get_sqlalchemy_engine(), index_col='Apartment_Key')
+    data = predictor.prepare_data(data)
+    if data.empty:
+        return 0
+
+    predicted = 0
+    for model_key, registry in REGISTRIES.items():
+        predictions = predictor.score(data.copy(), registry)
+        predictions.insert(0, 'Model_Key', model_key)
+        predicted += bulk_insert(predictions, VERSIONED_TABLE, get_sqlalchemy_engine(),
+                                 key_columns=['Model_Key', 'Apartment_Key'], schema='dbo')
+    return predicted
+
+
+def main(model_keys: List[int] = None, workers: int = None, partitions: int = None) -> None:
+    workers = workers or os.cpu_count()
+    models_info = get_models_info(model_keys)
+    if models_info.empty:
+        raise ValueError(f'Models {model_keys or "with Is_main = 1"} do not exist')
+    key_ranges = get_key_ranges(partitions or workers * 4)
+    # Created here once, workers creating a missing table at the same time would fail on each other
+    PREDICTIONS_VERSIONS.create(get_sqlalchemy_engine(), checkfirst=True)
+
+    start = time.perf_counter()
+    predicted = 0
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(models_info,)) as executor:
+        futures = [executor.submit(rescore_range, *key_range) for key_range in key_ranges]
+        for future in tqdm(as_completed(futures), total=len(futures), desc='Partitions', ascii=True):
+            predicted += future.result()
+
+    message = (f'Rescored models {list(models_info["Model_Key"])}: {predicted} predictions '
+               f'in {time.perf_counter() - start:.1f} s with {workers} workers')
+    print(message)
+    logging.info(message)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-key', type=int, action='append', dest='model_keys',
+                        help='Model_Key to rescore with, can be repeated. Default - main models')
+    parser.add_argument('--workers', type=int, help='Worker processes, default - CPU count')
+    parser.add_argument('--partitions', type=int, help='Apartment_Key ranges, default - 4 per worker')
+    args = parser.parse_args()
+
+    log_file = Path(__file__).parent.parent.joinpath('logs').joinpath('rescore.txt')
+    logging.basicConfig(
+        format='[%(asctime)s] -- %(levelname).3s -- %(message)s',
+        datefmt='%Y.%m.%d %H:%M:%S',
+        level=logging.DEBUG,
+        filename=log_file)
+
+    logging.info('Rescore start')
+    try:
+        main(args.model_keys, args.workers, args.partitions)
+    except Exception as e:
+        logging.exception(e)
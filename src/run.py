@@ -0,0 +1,125 @@
+import argparse
+import logging
+from datetime import date
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    List,
+    Optional,
+)
+
+from metrics import METRICS
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+BASE_PATH = Path(__file__).parent.parent
+STAGES = ['download', 'predict', 'report']
+
+
+# Stage modules import pandas, bs4, sklearn models and openpyxl and are imported only when the stage runs.
+# All of them share the engine of sql_connector.get_sqlalchemy_engine, created on the first query
+def run_download(download_kwargs: Dict[str, Any],
+                 keep_new_rows: bool,
+                 parser: str = None) -> Optional['pd.DataFrame']:
+    import downloader
+    from parsers import get_parser
+
+    if parser:
+        downloader.PARSE_APARTMENT_HTML = get_parser(parser)
+    return downloader.main(**download_kwargs, keep_new_rows=keep_new_rows)
+
+
+def run_predict(new_apartments: 'pd.DataFrame' = None) -> None:
+    import predictor
+
+    if new_apartments is not None and not new_apartments.empty:
+        predicted = predictor.main_new_apartments(new_apartments)
+        logging.info(f'Predicted new apartments: {predicted}')
+    # Rows the handoff does not carry (written by an interrupted run, or when predict failed) are scored from the
+    # database, in chunks after the high-water mark; handed over rows already have predictions and are skipped
+    predictor.main_streaming()
+
+
+def run_report(date_from: date = None, date_to: date = None, top_n: int = 10) -> None:
+    import make_excel
+
+    with METRICS.stage('read_report_data') as stage:
+        data_out = make_excel.get_data_for_make_excel(date_from, date_to, top_n)
+        stage.rows = len(data_out)
+    with METRICS.stage('write_report', len(data_out)):
+        make_excel.make_excel_streaming(data_out)
+
+
+def main(stages: List[str],
+         download_kwargs: Dict[str, Any] = None,
+         parser: str = None,
+         date_from: date = None,
+         date_to: date = None,
+         top_n: int = 10,
+         force_report: bool = False) -> None:
+    # Rows saved by download are handed over to predict in memory, predict then scores only what was left unscored.
+    # When download finds nothing new, report is skipped unless force_report is set
+    new_apartments = None
+    if 'download' in stages:
+        new_apartments = run_download(download_kwargs or {}, 'predict' in stages, parser)
+    nothing_new = new_apartments is not None and new_apartments.empty
+
+    if 'predict' in stages:
+        run_predict(new_apartments)
+    if 'report' in stages:
+        if nothing_new and not force_report:
+            logging.info('There are no new apartments, report is skipped')
+        else:
+            run_report(date_from, date_to, top_n)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Download, predict and report in one process')
+    arg_parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    arg_parser.add_argument('--start-page', type=int, default=1)
+    arg_parser.add_argument('--end-page', type=int, default=40, help='Last page, an upper bound in incremental mode')
+    arg_parser.add_argument('--incremental', action='store_true',
+                            help='Stop at the first pages without unseen listings or past the Date_Add watermark')
+    arg_parser.add_argument('--mode', choices=['sequential', 'async', 'pipeline'], default='sequential')
+    arg_parser.add_argument('--concurrency', type=int, default=8,
+                            help='Number of in-flight requests (async) or fetcher threads (pipeline)')
+    arg_parser.add_argument('--rate', type=float, default=1.0, help='Requests per second per host')
+    arg_parser.add_argument('--burst', type=float, default=2.0, help='Token bucket capacity per host')
+    arg_parser.add_argument('--parser', help='Listing parser backend, bs4 or lxml')
+    arg_parser.add_argument('--date-from', type=date.fromisoformat, help='First day of the report')
+    arg_parser.add_argument('--date-to', type=date.fromisoformat, help='Last day of the report, inclusive')
+    arg_parser.add_argument('--top-n', type=int, default=10, help='Apartments per day in the report')
+    arg_parser.add_argument('--force-report', action='store_true', help='Make the report even if nothing is new')
+    arg_parser.add_argument('--profile-stage', help='Run this stage under cProfile, e.g. download or predict')
+    args = arg_parser.parse_args()
+    METRICS.profile_stage = args.profile_stage or METRICS.profile_stage
+
+    log_file = BASE_PATH.joinpath('logs').joinpath('run.txt')
+    logging.basicConfig(
+        format='[%(asctime)s] -- %(levelname).3s -- %(message)s',
+        datefmt='%Y.%m.%d %H:%M:%S',
+        level=logging.DEBUG,
+        filename=log_file)
+
+    logging.info(f'Run start: {args.stages}')
+    try:
+        main(args.stages,
+             {'start_page': args.start_page,
+              'end_page': args.end_page,
+              'mode': args.mode,
+              'concurrency': args.concurrency,
+              'rate': args.rate,
+              'burst': args.burst,
+              'incremental': args.incremental},
+             args.parser,
+             args.date_from,
+             args.date_to,
+             args.top_n,
+             args.force_report)
+    except Exception as e:
+        logging.exception(e)
+    finally:
+        METRICS.write('run')
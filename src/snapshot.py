@@ -0,0 +1,141 @@
+import argparse
+import json
+import logging
+import shutil
+from pathlib import Path
+from typing import (
+    List,
+    Tuple,
+)
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy.engine import Engine
+
+from processor import convert_types
+from sql_connector import (
+    get_sqlalchemy_engine,
+    read_sql_query,
+    select_top,
+)
+
+BASE_PATH = Path(__file__).parent.parent
+SNAPSHOT_PATH = BASE_PATH.joinpath('cache').joinpath('apartments')
+
+# Typed copy of Apartments: squares parsed, dates as timestamps, partitioned by Date_Add month
+SNAPSHOT_SCHEMA = pa.schema([
+    ('Apartment_Key', pa.int64()),
+    ('District', pa.string()),
+    ('Address', pa.string()),
+    ('Sales_Type', pa.string()),
+    ('Year_Building', pa.float64()),
+    ('Material', pa.string()),
+    ('Floor_Numbers_Of_Floors', pa.string()),
+    ('Floors_In_Building', pa.int64()),
+    ('Apartment_Type', pa.string()),
+    ('Price', pa.int64()),
+    ('Square_Total', pa.float64()),
+    ('Square_Living', pa.float64()),
+    ('Square_Kitchen', pa.float64()),
+    ('Rooms_Number', pa.int64()),
+    ('Apartment_Condition', pa.string()),
+    ('Bathroom_Type', pa.string()),
+    ('Balcony_Loggia', pa.string()),
+    ('Date_Add', pa.timestamp('ns')),
+    ('Date_Expiration', pa.timestamp('ns')),
+    ('Id', pa.int64()),
+    ('Url_Link', pa.string()),
+    ('Date_Month', pa.string()),
+])
+SNAPSHOT_COLUMNS = [i for i in SNAPSHOT_SCHEMA.names if i != 'Date_Month']
+
+
+def get_meta_path(path: Path) -> Path:
+    # Files starting with '_' are skipped by the Parquet dataset reader
+    return path.joinpath('_meta.json')
+
+
+def read_last_apartment_key(path: Path = SNAPSHOT_PATH) -> int:
+    meta_path = get_meta_path(path)
+    return json.loads(meta_path.read_text())['last_apartment_key'] if meta_path.exists() else 0
+
+
+def write_chunk(data: pd.DataFrame, path: Path) -> None:
+    # Older rows may have no rooms or floors, nullable integers keep them instead of failing the sync
+    for column in ['Rooms_Number', 'Floors_In_Building']:
+        data[column] = pd.to_numeric(data[column]).astype('Int64')
+    data = convert_types(data)
+    data['Date_Month'] = data['Date_Add'].dt.strftime('%Y-%m')
+    table = pa.Table.from_pandas(data[SNAPSHOT_SCHEMA.names], schema=SNAPSHOT_SCHEMA, preserve_index=False)
+    # File names carry the key range, so a chunk written again after a crash replaces its own files
+    first_key, last_key = data['Apartment_Key'].min(), data['Apartment_Key'].max()
+    pq.write_to_dataset(table, path, partition_cols=['Date_Month'],
+                        basename_template=f'part-{first_key}-{last_key}-{{i}}.parquet',
+                        existing_data_behavior='overwrite_or_ignore')
+
+
+def sync(engine: Engine, path: Path = SNAPSHOT_PATH, chunksize: int = 100000) -> int:
+    # Only apartments with Apartment_Key above the last synced one are read, in key order
+    last_apartment_key = read_last_apartment_key(path)
+    path.mkdir(parents=True, exist_ok=True)
+    synced = 0
+    while True:
+        query = f"""SELECT {', '.join(SNAPSHOT_COLUMNS)}
+                    FROM Apartments
+                    WHERE Apartment_Key > {int(last_apartment_key)}"""
+        data = read_sql_query(select_top(engine, query, chunksize, 'Apartment_Key'), engine)
+        if data.empty:
+            break
+        write_chunk(data, path)
+        last_apartment_key = int(data['Apartment_Key'].max())
+        get_meta_path(path).write_text(json.dumps({'last_apartment_key': last_apartment_key}))
+        synced += len(data)
+        logging.info(f'Snapshot synced up to Apartment_Key {last_apartment_key}')
+    return synced
+
+
+def get_month_filters(date_from: pd.Timestamp = None, date_to: pd.Timestamp = None) -> List[Tuple[str, str, str]]:
+    # Partitions outside the months of the range are not opened
+    filters = []
+    if date_from is not None:
+        filters.append(('Date_Month', '>=', f'{date_from:%Y-%m}'))
+    if date_to is not None:
+        filters.append(('Date_Month', '<=', f'{date_to:%Y-%m}'))
+    return filters
+
+
+def read_snapshot(columns: List[str] = None,
+                  date_from: pd.Timestamp = None,
+                  date_to: pd.Timestamp = None,
+                  path: Path = SNAPSHOT_PATH) -> pd.DataFrame:
+    # Only the requested columns are read, files are memory mapped instead of copied into buffers
+    if not get_meta_path(path).exists():
+        raise FileNotFoundError(f'Snapshot {path} does not exist, run snapshot.py first')
+    table = pq.read_table(path, columns=columns or SNAPSHOT_COLUMNS,
+                          filters=get_month_filters(date_from, date_to) or None, memory_map=True)
+    return table.to_pandas()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunksize', type=int, default=100000, help='Apartments read from the database at a time')
+    parser.add_argument('--rebuild', action='store_true', help='Delete the snapshot and sync it from scratch')
+    args = parser.parse_args()
+
+    log_file = BASE_PATH.joinpath('logs').joinpath('snapshot.txt')
+    logging.basicConfig(
+        format='[%(asctime)s] -- %(levelname).3s -- %(message)s',
+        datefmt='%Y.%m.%d %H:%M:%S',
+        level=logging.DEBUG,
+        filename=log_file)
+
+    logging.info('Snapshot sync start')
+    try:
+        if args.rebuild and SNAPSHOT_PATH.exists():
+            shutil.rmtree(SNAPSHOT_PATH)
+        synced_apartments = sync(get_sqlalchemy_engine(), chunksize=args.chunksize)
+        print(f'Synced apartments: {synced_apartments}')
+        logging.info(f'Synced apartments: {synced_apartments}')
+    except Exception as e:
+        logging.exception(e)
@@ -1,14 +1,146 @@
+import os
+import time
 from functools import lru_cache
+from typing import List
 from urllib import parse
+from uuid import uuid4
+
 import pandas as pd
-from sqlalchemy import create_engine
+from sqlalchemy import (
+    MetaData,
+    Table,
+    create_engine,
+    inspect,
+    text,
+)
+from sqlalchemy.engine import (
+    Engine,
+    make_url,
+)
+from sqlalchemy.pool import StaticPool
 
+from db_schema import create_schema
+from metrics import METRICS
 
-@lru_cache()
-def get_sqlalchemy_engine():
+BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', 10000))
+
+# Connection settings, e.g. APARTMENT_DB_URL=sqlite:///data/apartments.db for a local run
+DATABASE_URL = os.environ.get('APARTMENT_DB_URL')
+POOL_SIZE = int(os.environ.get('APARTMENT_DB_POOL_SIZE', 5))
+MAX_OVERFLOW = int(os.environ.get('APARTMENT_DB_MAX_OVERFLOW', 10))
+POOL_PRE_PING = os.environ.get('APARTMENT_DB_POOL_PRE_PING', '1') == '1'
+FAST_EXECUTEMANY = os.environ.get('APARTMENT_DB_FAST_EXECUTEMANY', '1') == '1'
+
+
+def get_mssql_url() -> str:
     params = parse.quote_plus("DRIVER={SQL Server Native Client 11.0};"
                               r"SERVER=localhost\SQLEXPRESS;"
                               "DATABASE=Apartment_Tomsk;"
                               "Trusted_Connection=yes")
+    return f"mssql+pyodbc:///?odbc_connect={params}"
+
+
+def create_sqlalchemy_engine(url: str = None,
+                             pool_size: int = POOL_SIZE,
+                             max_overflow: int = MAX_OVERFLOW,
+                             pool_pre_ping: bool = POOL_PRE_PING,
+                             fast_executemany: bool = FAST_EXECUTEMANY) -> Engine:
+    url = make_url(url or DATABASE_URL or get_mssql_url())
+    kwargs = {'pool_pre_ping': pool_pre_ping}
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        # One connection shared by all threads, otherwise every connection gets its own empty database
+        kwargs.update(poolclass=StaticPool, connect_args={'check_same_thread': False})
+    else:
+        kwargs.update(pool_size=pool_size, max_overflow=max_overflow)
+    if url.get_backend_name() == 'sqlite':
+        kwargs.setdefault('connect_args', {})['timeout'] = 30
+    if url.get_backend_name() == 'mssql' and url.get_driver_name() == 'pyodbc':
+        kwargs['fast_executemany'] = fast_executemany
+
+    engine = create_engine(url, **kwargs)
+    if url.get_backend_name() == 'sqlite':
+        create_schema(engine)
+    return engine
+
+
+@lru_cache()
+def get_sqlalchemy_engine() -> Engine:
+    # Shared by every module of the process
+    return create_sqlalchemy_engine()
+
+
+def get_sqlite_engine(path: str = ':memory:') -> Engine:
+    # Local backend with the schema created, for load tests of the whole pipeline without SQL Server
+    return create_sqlalchemy_engine(f'sqlite:///{path}')
+
+
+def cast_date(engine: Engine, column: str) -> str:
+    # SQLite has no date type, site dates '%d.%m.%Y ...' are rearranged to ISO 'YYYY-MM-DD'
+    if engine.dialect.name == 'sqlite':
+        return f"(substr({column}, 7, 4) || '-' || substr({column}, 4, 2) || '-' || substr({column}, 1, 2))"
+    return f'CAST({column} as date)'
+
+
+def select_top(engine: Engine, query: str, n: int, order_by: str) -> str:
+    # TOP on SQL Server, LIMIT elsewhere
+    if engine.dialect.name == 'mssql':
+        return f'SELECT TOP ({int(n)}) * FROM ({query}) AS Query ORDER BY {order_by}'
+    return f'SELECT * FROM ({query}) AS Query ORDER BY {order_by} LIMIT {int(n)}'
+
+
+def read_sql_query(query, engine: Engine, **kwargs) -> pd.DataFrame:
+    # pd.read_sql_query with the time of the query and of fetching its rows recorded
+    with METRICS.timer('db_read_seconds'):
+        data = pd.read_sql_query(query, engine, **kwargs)
+    METRICS.inc('db_read_rows_total', len(data))
+    return data
+
+
+def bulk_insert(df: pd.DataFrame,
+                table: str,
+                engine: Engine,
+                key_columns: List[str],
+                schema: str = None,
+                batch_size: int = BATCH_SIZE) -> int:
+    # Rows go to a staging table with batched executemany (fast_executemany on MSSQL),
+    # then a single set-based anti-join inserts the rows whose keys are not in the table yet
+    if df.empty:
+        return 0
+    # One row per key, the last one wins, like a later insert would if the first were already in the table
+    df = df.drop_duplicates(key_columns, keep='last')
+    if engine.dialect.name == 'sqlite':
+        schema = None
+    started_at = time.perf_counter()
+
+    quote = engine.dialect.identifier_preparer.quote
+    staging = f'{table}_Staging_{uuid4().hex[:8]}'
+    target_name = f'{quote(schema)}.{quote(table)}' if schema else quote(table)
+    staging_name = f'{quote(schema)}.{quote(staging)}' if schema else quote(staging)
+    columns = ', '.join(quote(i) for i in df.columns)
+
+    if not inspect(engine).has_table(table, schema=schema):
+        df.head(0).to_sql(table, engine, schema=schema, index=False)
+    df.head(0).to_sql(staging, engine, schema=schema, index=False)
+    try:
+        # Reflected column types take care of converting timestamps for every driver
+        staging_table = Table(staging, MetaData(), schema=schema, autoload_with=engine)
+        records = df.astype(object).where(df.notna(), None).to_dict('records')
+        with engine.begin() as connection:
+            for start in range(0, len(records), batch_size):
+                connection.execute(staging_table.insert(), records[start:start + batch_size])
 
-    return create_engine(f"mssql+pyodbc:///?odbc_connect={params}")
+        join_condition = ' AND '.join(f'Target.{quote(i)} = Staging.{quote(i)}' for i in key_columns)
+        # On SQL Server the key range stays locked until the insert, so overlapping runs cannot both pass the check
+        lock_hint = ' WITH (UPDLOCK, HOLDLOCK)' if engine.dialect.name == 'mssql' else ''
+        merge = text(f"""INSERT INTO {target_name} ({columns})
+                         SELECT {', '.join(f'Staging.{quote(i)}' for i in df.columns)}
+                         FROM {staging_name} AS Staging
+                         WHERE NOT EXISTS (SELECT 1 FROM {target_name} AS Target{lock_hint} WHERE {join_condition})""")
+        with engine.begin() as connection:
+            inserted = connection.execute(merge).rowcount
+    finally:
+        with engine.begin() as connection:
+            connection.execute(text(f'DROP TABLE {staging_name}'))
+    METRICS.observe('db_write_seconds', time.perf_counter() - started_at, table=table)
+    METRICS.inc('db_written_rows_total', inserted, table=table)
+    return inserted
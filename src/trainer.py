@@ -0,0 +1,324 @@
+import argparse
+import json
+import logging
+import os
+import pickle
+import time
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    as_completed,
+)
+from datetime import datetime
+from pathlib import Path
+from typing import (
+    Any,
+    Dict,
+    List,
+    Tuple,
+)
+
+import pandas as pd
+from sklearn.base import clone
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.linear_model import LinearRegression
+from sklearn.metrics import mean_absolute_error
+from sklearn.model_selection import (
+    KFold,
+    ParameterGrid,
+    cross_val_score,
+)
+from sklearn.neighbors import KNeighborsRegressor
+from sqlalchemy import text
+from tqdm import tqdm
+
+from metrics import METRICS
+from predictor import (
+    QUERY_APARTMENTS,
+    get_model_from_path,
+    prepare_data,
+)
+from processor import (
+    ENCODER,
+    convert_to_dummies,
+)
+from sql_connector import (
+    bulk_insert,
+    get_sqlalchemy_engine,
+    read_sql_query,
+)
+
+BASE_PATH = Path(__file__).parent.parent
+MODELS_PATH = Path(os.environ.get('APARTMENT_MODELS_PATH', BASE_PATH.joinpath('models')))
+
+# Columns of prepare_data output that are not model features, as in the research notebook
+NOT_FEATURE_COLUMNS = ['Date_Add', 'Date_Expiration', 'Address', 'Price', 'Not_Used', 'Not_Used_Description',
+                       'Rooms_Number']
+
+ESTIMATORS = {
+    'LinearRegression': LinearRegression,
+    'KNeighborsRegressor': KNeighborsRegressor,
+    'RandomForestRegressor': RandomForestRegressor,
+}
+
+SEARCH_SPACE = {
+    'LinearRegression': {},
+    'KNeighborsRegressor': {'n_neighbors': list(range(3, 30, 2)),
+                            'weights': ['uniform', 'distance'],
+                            'p': [1, 2]},
+    'RandomForestRegressor': {'n_estimators': [200, 400],
+                              'max_depth': [None, 10, 20],
+                              'min_samples_leaf': [1, 3, 5],
+                              'max_features': [1.0, 'sqrt']},
+}
+
+# Train and test parts of every Rooms_Number segment, set once per worker process
+Segment = Tuple[pd.DataFrame, pd.DataFrame, pd.Series, pd.Series]
+SEGMENTS: Dict[int, Segment] = {}
+
+
+def read_training_data(after_apartment_key: int = 0) -> Tuple[pd.DataFrame, int]:
+    # Returns prepared rows and the last Apartment_Key read, filtered out rows included
+    query = f"""{QUERY_APARTMENTS}
+                WHERE Apartment_Key > {int(after_apartment_key)}"""
+    with METRICS.stage('read_training_data') as stage:
+        data = read_sql_query(query, get_sqlalchemy_engine(), index_col='Apartment_Key')
+        last_apartment_key = int(data.index.max()) if not data.empty else int(after_apartment_key)
+        data = prepare_data(data)
+        stage.rows = len(data)
+    return data, last_apartment_key
+
+
+def get_features(data: pd.DataFrame, features: List[str] = None) -> Tuple[pd.DataFrame, pd.Series]:
+    # Dummies of every categorical column by default, exactly the given features for a registered model
+    if features is None:
+        x = convert_to_dummies(data.drop(NOT_FEATURE_COLUMNS, axis=1, errors='ignore'))
+    else:
+        x = ENCODER.transform(data, features)
+    x = x.astype(float)
+    is_complete = x.notna().all(axis=1)
+    return x[is_complete], data.loc[is_complete, 'Price']
+
+
+def split_segment(x: pd.DataFrame, y: pd.Series, test_size: float) -> Segment:
+    # A row goes to the test part by the hash of its Apartment_Key, so it stays there when new rows are added
+    # and a refitted model is measured on rows none of its trees was trained on
+    is_test = (pd.util.hash_pandas_object(x.index.to_series(), index=False) % 1000 < test_size * 1000).to_numpy()
+    return x[~is_test], x[is_test], y[~is_test], y[is_test]
+
+
+def init_worker(segments: Dict[int, Segment]) -> None:
+    # Segments are sent to every worker once instead of with every task
+    SEGMENTS.update(segments)
+
+
+def make_estimator(name: str, params: Dict[str, Any]) -> Any:
+    # Parallelism comes from the process pool, estimators themselves use one core
+    estimator = ESTIMATORS[name]()
+    defaults = {key: value for key, value in (('random_state', 0), ('n_jobs', 1)) if key in estimator.get_params()}
+    return estimator.set_params(**defaults, **params)
+
+
+def evaluate(rooms_number: int,
+             name: str,
+             params: Dict[str, Any],
+             folds: int) -> Tuple[int, str, Dict[str, Any], float]:
+    x_train, _, y_train, _ = SEGMENTS[rooms_number]
+    scores = cross_val_score(make_estimator(name, params), x_train, y_train,
+                             cv=KFold(folds, shuffle=True, random_state=0), scoring='neg_mean_absolute_error')
+    return rooms_number, name, params, -scores.mean()
+
+
+def fit(rooms_number: int, model: Any) -> Tuple[int, Any, float]:
+    # Fitted on the train part, Mean_absolute_error is measured on the test part like in the research notebook
+    x_train, x_test, y_train, y_test = SEGMENTS[rooms_number]
+    model.fit(x_train, y_train)
+    return rooms_number, model, round(mean_absolute_error(y_test, model.predict(x_test)), 2)
+
+
+def get_meta_path(model_path: Path) -> Path:
+    return model_path.with_suffix('.json')
+
+
+def register_model(model: Any,
+                   model_name: str,
+                   rooms_number: int,
+                   features: List[str],
+                   mae: float,
+                   last_apartment_key: int,
+                   set_main: bool = False) -> int:
+    # The pickle and the Models row are what predictor expects, the sidecar JSON records
+    # the rows the model was trained on for a later warm start refit
+    MODELS_PATH.mkdir(parents=True, exist_ok=True)
+    model_path = MODELS_PATH.joinpath(f'{model_name}.pkl')
+    with open(model_path, 'wb') as file:
+        pickle.dump(model, file)
+    get_meta_path(model_path).write_text(json.dumps({'last_apartment_key': last_apartment_key,
+                                                     'trained_at': datetime.now().isoformat(timespec='seconds')}))
+
+    engine = get_sqlalchemy_engine()
+    model_info = pd.DataFrame([{'Model_name': model_name,
+                                'Model_path': str(model_path),
+                                'Mean_absolute_error': mae,
+                                'Rooms_Number': rooms_number,
+                                'Model_features': '; '.join(features),
+                                'Is_main': 0}])
+    bulk_insert(model_info, 'Models', engine, key_columns=['Model_name'], schema='dbo')
+    model_key = int(read_sql_query(text('SELECT Model_Key FROM Models WHERE Model_name = :name'), engine,
+                                   params={'name': model_name})['Model_Key'].iloc[0])
+    if set_main:
+        with engine.begin() as connection:
+            connection.execute(text('UPDATE Models SET Is_main = CASE WHEN Model_Key = :key THEN 1 ELSE 0 END '
+                                    'WHERE Rooms_Number = :rooms_number'),
+                               {'key': model_key, 'rooms_number': rooms_number})
+    message = f'Registered model {model_key} {model_name}: Mean_absolute_error {mae}'
+    print(message)
+    logging.info(message)
+    return model_key
+
+
+def main_search(estimators: List[str] = None,
+                folds: int = 5,
+                test_size: float = 0.3,
+                min_rows: int = 50,
+                workers: int = None,
+                set_main: bool = False) -> List[int]:
+    # Every (segment, estimator, parameters) point is cross-validated as a separate task of the pool,
+    # the best point of every segment is fitted and registered
+    workers = workers or os.cpu_count()
+    data, last_apartment_key = read_training_data()
+    segments, features = {}, {}
+    for rooms_number, segment in data.groupby('Rooms_Number'):
+        x, y = get_features(segment)
+        if len(x) < min_rows:
+            logging.info(f'Rooms_Number {rooms_number} is skipped: {len(x)} rows')
+            continue
+        segments[int(rooms_number)] = split_segment(x, y, test_size)
+        features[int(rooms_number)] = list(x.columns)
+    tasks = [(rooms_number, name, params) for rooms_number in segments for name in estimators or ESTIMATORS
+             for params in ParameterGrid(SEARCH_SPACE[name])]
+
+    start = time.perf_counter()
+    best: Dict[int, Tuple[str, Dict[str, Any], float]] = {}
+    model_keys = []
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(segments,)) as executor:
+        with METRICS.stage('search', len(tasks)):
+            futures = [executor.submit(evaluate, *task, folds) for task in tasks]
+            for future in tqdm(as_completed(futures), total=len(futures), desc='Candidates', ascii=True):
+                rooms_number, name, params, mae = future.result()
+                if rooms_number not in best or mae < best[rooms_number][2]:
+                    best[rooms_number] = (name, params, mae)
+        for rooms_number, (name, params, mae) in best.items():
+            logging.info(f'Rooms_Number {rooms_number}: {name} {params}, cross-validated MAE {mae:.2f}')
+
+        with METRICS.stage('fit', len(best)):
+            futures = [executor.submit(fit, rooms_number, make_estimator(name, params))
+                       for rooms_number, (name, params, _) in best.items()]
+            for future in as_completed(futures):
+                rooms_number, model, mae = future.result()
+                model_name = f'{best[rooms_number][0]} rooms {rooms_number} {datetime.now():%Y%m%d_%H%M%S}'
+                model_keys.append(register_model(model, model_name, rooms_number, features[rooms_number], mae,
+                                                 last_apartment_key, set_main))
+
+    message = (f'Searched {len(tasks)} candidates for {len(segments)} segments '
+               f'in {time.perf_counter() - start:.1f} s with {workers} workers')
+    print(message)
+    logging.info(message)
+    return model_keys
+
+
+def get_main_models() -> pd.DataFrame:
+    sql_expression = """SELECT Model_Key,
+                               Model_name,
+                               Rooms_Number,
+                               Model_path,
+                               Model_features
+                        FROM Models
+                        WHERE Is_main = 1"""
+    return read_sql_query(sql_expression, get_sqlalchemy_engine())
+
+
+def main_refit(extra_estimators: int = 100,
+               test_size: float = 0.3,
+               min_rows: int = 50,
+               workers: int = None,
+               set_main: bool = False) -> List[int]:
+    # Main models with warm_start (random forests) get extra_estimators trees fitted on the train part of the rows
+    # added since they were trained, other models and models without a sidecar JSON are refitted with the same
+    # parameters on the train part of all rows. Mean_absolute_error is measured on the test part of all rows,
+    # the same split as in main_search. Features stay exactly the registered Model_features
+    models_info = get_main_models()
+    if models_info.empty:
+        raise ValueError('There is no main model in Models')
+    refits = []
+    for model_info in models_info.itertuples(index=False):
+        # Notebook models are pickled GridSearchCV objects
+        model = get_model_from_path(model_info.Model_path)
+        model = getattr(model, 'best_estimator_', model)
+        meta_path = get_meta_path(Path(model_info.Model_path))
+        trained_key = json.loads(meta_path.read_text())['last_apartment_key'] if meta_path.exists() else 0
+        if 'warm_start' in model.get_params() and trained_key:
+            model.set_params(warm_start=True, n_estimators=model.n_estimators + extra_estimators)
+        else:
+            model, trained_key = clone(model), 0
+        refits.append((model_info, model, trained_key))
+
+    data, last_apartment_key = read_training_data()
+    segments, models = {}, {}
+    for model_info, model, trained_key in refits:
+        rooms_number = int(model_info.Rooms_Number)
+        x, y = get_features(data[data['Rooms_Number'] == rooms_number], model_info.Model_features.split('; '))
+        x_train, x_test, y_train, y_test = split_segment(x, y, test_size)
+        is_new = x_train.index > trained_key
+        if is_new.sum() < min_rows:
+            logging.info(f'Model {model_info.Model_Key} is not refitted: {is_new.sum()} new rows')
+            continue
+        segments[rooms_number] = (x_train[is_new], x_test, y_train[is_new], y_test)
+        models[rooms_number] = (model_info, model)
+
+    model_keys = []
+    with ProcessPoolExecutor(workers or os.cpu_count(), initializer=init_worker, initargs=(segments,)) as executor:
+        with METRICS.stage('fit', len(models)):
+            futures = [executor.submit(fit, rooms_number, model) for rooms_number, (_, model) in models.items()]
+            for future in as_completed(futures):
+                rooms_number, model, mae = future.result()
+                model_info = models[rooms_number][0]
+                model_name = f'{model_info.Model_name} refit {datetime.now():%Y%m%d_%H%M%S}'
+                model_keys.append(register_model(model, model_name, rooms_number,
+                                                 model_info.Model_features.split('; '), mae, last_apartment_key,
+                                                 set_main))
+    return model_keys
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train models per Rooms_Number and register them in Models')
+    parser.add_argument('--refit', action='store_true',
+                        help='Refit the main models on new rows instead of searching for new ones')
+    parser.add_argument('--estimator', action='append', dest='estimators', choices=list(ESTIMATORS),
+                        help='Estimator to search, can be repeated. Default - all')
+    parser.add_argument('--folds', type=int, default=5, help='Cross-validation folds')
+    parser.add_argument('--test-size', type=float, default=0.3, help='Part of rows the registered MAE is measured on')
+    parser.add_argument('--min-rows', type=int, default=50, help='Segments with fewer rows are skipped')
+    parser.add_argument('--extra-estimators', type=int, default=100, help='Trees added by a warm start refit')
+    parser.add_argument('--workers', type=int, help='Worker processes, default - CPU count')
+    parser.add_argument('--set-main', action='store_true', help='Make the registered models main in their segments')
+    parser.add_argument('--profile-stage', help='Run this stage under cProfile, e.g. search or fit')
+    args = parser.parse_args()
+    METRICS.profile_stage = args.profile_stage or METRICS.profile_stage
+
+    log_file = BASE_PATH.joinpath('logs').joinpath('trainer.txt')
+    logging.basicConfig(
+        format='[%(asctime)s] -- %(levelname).3s -- %(message)s',
+        datefmt='%Y.%m.%d %H:%M:%S',
+        level=logging.DEBUG,
+        filename=log_file)
+
+    logging.info('Trainer start')
+    try:
+        if args.refit:
+            main_refit(args.extra_estimators, args.test_size, args.min_rows, args.workers, args.set_main)
+        else:
+            main_search(args.estimators, args.folds, args.test_size, args.min_rows, args.workers, args.set_main)
+    except Exception as e:
+        logging.exception(e)
+    finally:
+        METRICS.write('trainer')
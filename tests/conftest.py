@@ -0,0 +1,35 @@
+import os
+import sys
+from pathlib import Path
+from typing import (
+    Iterator,
+    List,
+)
+
+import pytest
+
+# Scripts import each other by module name, as when they are run from src.
+# Tests never reach SQL Server: every engine is an in-memory SQLite database
+sys.path.insert(0, str(Path(__file__).parent.parent.joinpath('src')))
+os.environ['APARTMENT_DB_URL'] = 'sqlite://'
+
+from crawl_fixtures import (
+    isolated_crawl,
+    write_site,
+)
+from fixture_server import start_fixture_server
+
+
+@pytest.fixture(scope='session')
+def url_base(tmp_path_factory: pytest.TempPathFactory) -> Iterator[str]:
+    fixtures_path = tmp_path_factory.mktemp('fixtures')
+    write_site(fixtures_path)
+    server = start_fixture_server(fixtures_path)
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+
+
+@pytest.fixture
+def bad_links(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Iterator[List[str]]:
+    with isolated_crawl(tmp_path, monkeypatch) as links:
+        yield links
@@ -0,0 +1,83 @@
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
+from typing import (
+    Iterator,
+    List,
+)
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import downloader
+from crawl_state import CrawlState
+from fixture_data import (
+    make_apartments,
+    make_listing_html,
+)
+from fixture_server import get_fixture_name
+from html_cache import HtmlCache
+from id_index import IdIndex
+from sql_connector import (
+    get_sqlalchemy_engine,
+    read_sql_query,
+)
+
+PAGES = 3
+LISTINGS_PER_PAGE = 5
+APARTMENTS = make_apartments(PAGES * LISTINGS_PER_PAGE).replace({np.nan: None}).to_dict('records')
+# Linked from the last page but never served, so every request for it gets 404
+MISSING_ID = max(i['Id'] for i in APARTMENTS) + 1
+
+
+def get_listing_path(id_: int) -> str:
+    return f'/realty?subaction=detail&id={id_}'
+
+
+def write_site(fixtures_path: Path) -> None:
+    # PAGES index pages of LISTINGS_PER_PAGE listings each, the last page also links MISSING_ID
+    for page in range(1, PAGES + 1):
+        ids = [i['Id'] for i in APARTMENTS[(page - 1) * LISTINGS_PER_PAGE:page * LISTINGS_PER_PAGE]]
+        if page == PAGES:
+            ids.append(MISSING_ID)
+        links = ''.join(f'<a class="visited_ads" href="{get_listing_path(i)}">{i}</a>' for i in ids)
+        fixtures_path.joinpath(get_fixture_name(downloader.URL_PAGES + str(page))).write_text(
+            f'<html><body>{links}</body></html>', encoding='utf-8')
+    for apartment in APARTMENTS:
+        fixtures_path.joinpath(get_fixture_name(get_listing_path(apartment['Id']))).write_text(
+            make_listing_html(apartment), encoding='utf-8')
+
+
+@contextmanager
+def isolated_crawl(path: Path, monkeypatch: pytest.MonkeyPatch) -> Iterator[List[str]]:
+    # An empty database, crawl state, cache and id index, no sleeps between requests.
+    # Yields the links log_bad_link was called with
+    get_sqlalchemy_engine.cache_clear()
+    state = CrawlState(path.joinpath('crawl_state.sqlite'))
+    cache = HtmlCache(path.joinpath('html_cache'))
+    monkeypatch.setattr(downloader, 'get_state', lambda: state)
+    monkeypatch.setattr(downloader, 'get_cache', lambda: cache)
+    monkeypatch.setattr(downloader, 'IdIndex', partial(IdIndex, path.joinpath('id_index')))
+    monkeypatch.setattr(downloader, 'randint', lambda a, b: 0)
+    bad_links = []
+    monkeypatch.setattr(downloader, 'log_bad_link', lambda url, e: bad_links.append(url))
+    try:
+        yield bad_links
+    finally:
+        get_sqlalchemy_engine().dispose()
+        get_sqlalchemy_engine.cache_clear()
+
+
+def run_crawl(url_base: str, mode: str, **kwargs) -> None:
+    kwargs = dict({'max_attempts': 2, 'retry_backoff': 0.01, 'retry_wait': 1.0}, **kwargs)
+    downloader.main(1, PAGES, mode, concurrency=4, rate=1000.0, burst=1000.0, url_base=url_base, parsers=2, **kwargs)
+
+
+def read_apartments() -> pd.DataFrame:
+    data = read_sql_query('SELECT * FROM Apartments', get_sqlalchemy_engine())
+    return data.drop(['Apartment_Key', 'Download_timestamp'], axis=1).sort_values('Id', ignore_index=True)
+
+
+def get_listings(state: CrawlState) -> List[tuple]:
+    return state.connection.execute('SELECT Url, Status, Attempts FROM Listings').fetchall()
@@ -0,0 +1,66 @@
+from typing import List
+
+import pytest
+
+import downloader
+from crawl_fixtures import (
+    APARTMENTS,
+    LISTINGS_PER_PAGE,
+    MISSING_ID,
+    get_listing_path,
+    get_listings,
+    read_apartments,
+    run_crawl,
+)
+
+
+@pytest.mark.parametrize('mode', ['sequential', 'async', 'pipeline'])
+def test_missing_listing_is_dead(url_base: str, mode: str, bad_links: List[str]) -> None:
+    run_crawl(url_base, mode)
+    url = url_base + get_listing_path(MISSING_ID)
+    assert get_listings(downloader.get_state()) == [(url, 'dead', 2)]
+    assert bad_links == [url, url]
+
+
+def test_retries_per_run_are_limited(url_base: str, bad_links: List[str]) -> None:
+    # One retry per run: the listing that keeps failing is left for the next run instead of retried to the end
+    url = url_base + get_listing_path(MISSING_ID)
+    run_crawl(url_base, 'sequential', max_attempts=3, max_retries=1)
+    assert get_listings(downloader.get_state()) == [(url, 'failed', 2)]
+    run_crawl(url_base, 'sequential', max_attempts=3, max_retries=1, retry_backoff=0.0)
+    assert get_listings(downloader.get_state()) == [(url, 'dead', 3)]
+    assert bad_links == [url] * 3
+
+
+def test_crash_then_resume(url_base: str, bad_links: List[str], monkeypatch: pytest.MonkeyPatch) -> None:
+    parse_listing = downloader.parse_listing
+    parsed = []
+
+    def crash_on_second_page(url: str, *args) -> dict:
+        parsed.append(url)
+        if len(parsed) == LISTINGS_PER_PAGE + 3:
+            raise KeyboardInterrupt
+        return parse_listing(url, *args)
+
+    monkeypatch.setattr(downloader, 'parse_listing', crash_on_second_page)
+    with pytest.raises(KeyboardInterrupt):
+        run_crawl(url_base, 'sequential')
+    assert len(read_apartments()) == LISTINGS_PER_PAGE
+    statuses = sorted(status for _, status, _ in get_listings(downloader.get_state()))
+    assert statuses == ['parsed'] * 2 + ['pending'] * 3
+
+    # The resumed run writes the 2 parsed rows, parses the 3 pending listings, reads the first page again
+    # and skips the second one
+    pages = []
+    get_urls_apartments_by_page = downloader.get_urls_apartments_by_page
+    monkeypatch.setattr(downloader, 'get_urls_apartments_by_page',
+                        lambda url_page: pages.append(url_page) or get_urls_apartments_by_page(url_page))
+    parsed.clear()
+    monkeypatch.setattr(downloader, 'parse_listing', lambda url, *args: parsed.append(url) or parse_listing(url, *args))
+    run_crawl(url_base, 'sequential')
+    assert pages == [url_base + downloader.URL_PAGES + str(i) for i in (1, 3)]
+    assert len(parsed) == 3 + LISTINGS_PER_PAGE + 1 + 1
+    assert sorted(read_apartments()['Id']) == sorted(i['Id'] for i in APARTMENTS)
+    assert get_listings(downloader.get_state()) == [(url_base + get_listing_path(MISSING_ID), 'dead', 2)]
+    runs = downloader.get_state().connection.execute('SELECT Run_Id, Finished_At FROM Runs').fetchall()
+    assert len(runs) == 1 and runs[0][1] is not None
@@ -0,0 +1,56 @@
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy.engine import Engine
+
+from fixture_data import make_apartments
+from make_excel import (
+    get_data_for_make_excel,
+    get_top_n_per_day,
+)
+from reference import get_top_n_per_day_apply
+from sql_connector import (
+    bulk_insert,
+    get_sqlalchemy_engine,
+)
+
+TOP_N = 5
+
+
+@pytest.fixture
+def engine() -> Iterator[Engine]:
+    get_sqlalchemy_engine.cache_clear()
+    yield get_sqlalchemy_engine()
+    get_sqlalchemy_engine().dispose()
+    get_sqlalchemy_engine.cache_clear()
+
+
+def make_predicted_apartments(rows: int, seed: int) -> pd.DataFrame:
+    # Few days with more rows than TOP_N and errors from a short list, so ties fall on the top_n boundary.
+    # Apartment_Key order differs from the order of days
+    rng = np.random.default_rng(seed)
+    df = make_apartments(rows, seed).reset_index(drop=True)
+    date_add = pd.Timestamp('2021-03-01') + pd.to_timedelta(rng.integers(0, 4 * 86400, rows), unit='s')
+    df['Date_Add'] = date_add.strftime('%d.%m.%Y %H:%M:%S')
+    df['Url_Link'] = 'https://www.tomsk.ru09.ru/realty?subaction=detail&id=' + df['Id'].astype(str)
+    df['Error'] = rng.choice([-300.0, -120.5, -120.5, -50.0, -50.0, -50.0, 0.0, 0.0, 75.0], rows)
+    df['Predict'] = df['Price'] / 1000 - df['Error']
+    return df
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_rankers_match_apply(engine: Engine, seed: int) -> None:
+    df = make_predicted_apartments(60, seed)
+    bulk_insert(df.drop(columns=['Predict', 'Error']), 'Apartments', engine, key_columns=['Id'])
+    df['Apartment_Key'] = np.arange(1, len(df) + 1)
+    bulk_insert(df[['Apartment_Key', 'Predict', 'Error']], 'Predictions', engine, key_columns=['Apartment_Key'])
+
+    # The reports rank non-positive errors, ties go to the smaller Apartment_Key
+    data = df[df['Error'] <= 0].sort_values('Apartment_Key')
+    data = data.assign(Date_Add=pd.to_datetime(data['Date_Add'], format='%d.%m.%Y %H:%M:%S').dt.normalize())
+    expected = get_top_n_per_day_apply(data, TOP_N)['Url_Link'].tolist()
+    assert (data.groupby('Date_Add').size() > TOP_N).all()
+    assert get_top_n_per_day(data, TOP_N)['Url_Link'].tolist() == expected
+    assert get_data_for_make_excel(top_n=TOP_N)['Ссылка'].tolist() == expected
@@ -0,0 +1,62 @@
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import pytest
+
+from fixture_data import (
+    make_apartments,
+    make_listing_html,
+)
+from fixture_server import get_fixture_name
+from parsers import (
+    PARSERS,
+    check_parity,
+)
+
+APARTMENTS = make_apartments(200, seed=1).replace({np.nan: None}).to_dict('records')
+
+
+def get_url(id_: int) -> str:
+    return f'https://www.tomsk.ru09.ru/realty?subaction=detail&id={id_}'
+
+
+@pytest.fixture(scope='module')
+def pages(tmp_path_factory: pytest.TempPathFactory) -> List[Path]:
+    # Generated listings, the same markup with extra classes and spacing the site also produces,
+    # and a page without a price that both backends must reject
+    fixtures_path = tmp_path_factory.mktemp('fixtures')
+    pages = {get_url(i['Id']): make_listing_html(i) for i in APARTMENTS}
+    first, second = APARTMENTS[0], APARTMENTS[1]
+    pages[get_url(first['Id'] + 1000)] = make_listing_html(first).replace(
+        'class="realty_detail_attr"', 'class="realty_detail_attr  highlighted"').replace(
+        'class="nowrap"', 'class="value nowrap"')
+    pages[get_url(second['Id'] + 1000)] = make_listing_html(second).replace(
+        '<div class="realty_detail_price inline">', '<div class="realty_detail_price inline"><!-- price -->')
+    pages[get_url(0)] = make_listing_html(first).replace('realty_detail_price', 'realty_detail_cost')
+    paths = []
+    for url, html in pages.items():
+        path = fixtures_path.joinpath(get_fixture_name(url))
+        path.write_text(html, encoding='utf-8')
+        paths.append(path)
+    return paths
+
+
+@pytest.mark.parametrize('parser', [i for i in PARSERS if i != 'bs4'])
+def test_backends_agree(pages: List[Path], parser: str) -> None:
+    assert check_parity(pages, parser) == []
+
+
+@pytest.mark.parametrize('parser', list(PARSERS))
+def test_generated_pages_are_parsed(pages: List[Path], parser: str) -> None:
+    # Parity alone would also hold if both backends failed on every page
+    for apartment in APARTMENTS:
+        url = get_url(apartment['Id'])
+        items = PARSERS[parser](make_listing_html(apartment), url)
+        assert items['Id'] == apartment['Id']
+        assert items['Price'] == apartment['Price']
+        assert items['District'] == apartment['District']
+        assert items['Date_Add'] == apartment['Date_Add']
+        assert items['Url_Link'] == url
+    with pytest.raises(Exception):
+        PARSERS[parser](pages[-1].read_text(encoding='utf-8'), pages[-1].name)
@@ -0,0 +1,22 @@
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from crawl_fixtures import (
+    APARTMENTS,
+    isolated_crawl,
+    read_apartments,
+    run_crawl,
+)
+
+
+def test_modes_write_the_same_rows(url_base: str, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    rows = {}
+    for mode in ['sequential', 'async', 'pipeline']:
+        with monkeypatch.context() as mode_monkeypatch, isolated_crawl(tmp_path.joinpath(mode), mode_monkeypatch):
+            run_crawl(url_base, mode)
+            rows[mode] = read_apartments()
+    assert sorted(rows['sequential']['Id']) == sorted(i['Id'] for i in APARTMENTS)
+    pd.testing.assert_frame_equal(rows['sequential'], rows['async'])
+    pd.testing.assert_frame_equal(rows['sequential'], rows['pipeline'])
@@ -0,0 +1,105 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from fixture_data import make_apartments
+from processor import (
+    MAIN_RULES,
+    ROOMS_RULES,
+    evaluate_rules,
+    filter_df_main,
+    filter_df_room_1,
+    filter_df_rooms,
+    handle_dataframe,
+    parse_floor_series,
+    parse_square_series,
+)
+from reference import (
+    filter_df_main_masks,
+    filter_df_room_1_masks,
+    handle_dataframe_apply,
+)
+
+MALFORMED_FLOORS = ['', '3', '12/', '/9', '03/9', ' 3/9', '3a/5', 'a/b', 'цоколь/5', '1//5']
+
+
+def make_raw_apartments(rows: int, seed: int) -> pd.DataFrame:
+    # Generated rows with the missing and malformed values older listings have
+    rng = np.random.default_rng(seed)
+    df = make_apartments(rows, seed)
+    is_malformed = rng.random(rows) < 0.2
+    df.loc[is_malformed, 'Floor_Numbers_Of_Floors'] = rng.choice(MALFORMED_FLOORS, is_malformed.sum())
+    for column in ['Square_Total', 'Square_Living', 'Square_Kitchen']:
+        df.loc[rng.random(rows) < 0.1, column] = ''
+        df.loc[rng.random(rows) < 0.1, column] = None
+        # NULL comes from the database as None, which parse_square of the reference expects
+        df[column] = df[column].astype(object).where(df[column].notna(), None)
+    df.loc[rng.random(rows) < 0.1, 'Year_Building'] = None
+    for column in ['Material', 'Apartment_Condition', 'Bathroom_Type', 'Balcony_Loggia']:
+        df.loc[rng.random(rows) < 0.1, column] = np.nan
+    return df
+
+
+def make_handled_apartments(rows: int, seed: int) -> pd.DataFrame:
+    # Rooms and prices on and around the rule boundaries, balconies the rooms rules drop
+    rng = np.random.default_rng(seed)
+    df = make_raw_apartments(rows, seed)
+    df['Rooms_Number'] = rng.choice(['0', '1', '1', '1', '2', '4', '5', '10'], rows)
+    df['Price'] = rng.choice([499, 500, 501, 1399, 1400, 1500, 2000, 2001, 2500, 2501, 2800, 2801, 3000, 3001],
+                             rows) * 1000
+    is_boundary = rng.random(rows) < 0.3
+    df.loc[is_boundary, 'Square_Total'] = rng.choice(['11.9 кв.м', '12 кв.м', '50 кв.м', '50.1 кв.м'],
+                                                     is_boundary.sum())
+    df['Floors_In_Building'] = rng.choice(['1', '3', '4', '12', '19'], rows)
+    df.loc[rng.random(rows) < 0.1, 'Balcony_Loggia'] = '2 лоджии'
+    df.loc[rng.random(rows) < 0.2, 'Apartment_Condition'] = 'черновая отделка'
+    return handle_dataframe(df)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_handle_dataframe_matches_apply(seed: int) -> None:
+    df = make_raw_apartments(2000, seed)
+    pd.testing.assert_frame_equal(handle_dataframe(df.copy()), handle_dataframe_apply(df.copy()))
+
+
+def test_parse_floor_series() -> None:
+    floors = pd.Series(MALFORMED_FLOORS + ['5/9', '10/10'])
+    assert parse_floor_series(floors).tolist() == [0, 3, 12, 0, 3, 0, 0, 0, 0, 1, 5, 10]
+
+
+def test_parse_square_series() -> None:
+    squares = parse_square_series(pd.Series(['45.5 кв.м', '', None, '12 кв.м']))
+    assert squares.iloc[[0, 3]].tolist() == [45.5, 12.0]
+    assert squares.iloc[[1, 2]].isna().all()
+    # Squares already parsed, e.g. read from the Parquet snapshot, are kept
+    assert parse_square_series(pd.Series([45.5, np.nan])).iloc[0] == 45.5
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_filter_df_main_matches_masks(seed: int) -> None:
+    df = make_handled_apartments(3000, seed)
+    pd.testing.assert_frame_equal(filter_df_main(df.copy()), filter_df_main_masks(df.copy()))
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_filter_df_rooms_matches_masks(seed: int) -> None:
+    # The reference handles one-room apartments only, the rooms rules must keep every other apartment
+    df = filter_df_main(make_handled_apartments(3000, seed))
+    room_1 = df[df['Rooms_Number'] == 1]
+    expected = filter_df_room_1_masks(room_1.copy()).drop(columns='Not_Used_Description')
+    pd.testing.assert_frame_equal(filter_df_room_1(room_1.copy()).drop(columns='Not_Used_Description'), expected)
+    result = filter_df_rooms(df.copy())
+    assert result.index.tolist() == df.index[(df['Rooms_Number'] != 1) | df.index.isin(expected.index)].tolist()
+
+
+def test_evaluate_rules_bits() -> None:
+    df = pd.DataFrame({'Rooms_Number': [1, 1, 2, 5],
+                       'Material': ['кирпич', 'дерево', 'Нет значения', 'панель'],
+                       'Year_Building': [1990.0, np.nan, 1959.0, 2000.0],
+                       'Floors_In_Building': [9, 1, 5, 9],
+                       'Floor': [3, 1, 0, 2]})
+    assert evaluate_rules(df, MAIN_RULES).tolist() == [0, 0b1110, 0b10100, 0b1]
+    rooms = pd.DataFrame({'Rooms_Number': [1, 2], 'Price': [400.0, 400.0], 'Square_Total': [30.0, 30.0],
+                          'Floors_In_Building': [9, 9], 'Apartment_Condition': ['черновая отделка'] * 2,
+                          'Balcony_Loggia': [None, None]})
+    assert evaluate_rules(rooms, ROOMS_RULES).tolist() == [1 | 1 << 8, 0]
@@ -0,0 +1,24 @@
+from datetime import (
+    date,
+    datetime,
+)
+from pathlib import Path
+
+import pandas as pd
+
+from recrawl import RecrawlState
+
+
+def test_due_listings(tmp_path: Path) -> None:
+    # Listings without an expiration date stay due, expired and removed ones do not
+    state = RecrawlState(tmp_path.joinpath('recrawl_state.sqlite'))
+    state.add_listings(pd.DataFrame({
+        'Apartment_Key': [1, 2, 3, 4],
+        'Url_Link': [f'https://www.tomsk.ru09.ru/realty?subaction=detail&id={i}' for i in range(1, 5)],
+        'Date_Add': ['2021-03-01', '2021-03-02', '2021-03-03', '2021-03-04'],
+        'Price': [1000000, 2000000, 3000000, 4000000],
+        'Date_Expiration': ['2021-04-01', None, '2021-03-10', '2021-04-04'],
+    }))
+    state.connection.execute("UPDATE Listings SET Removed_At = '2021-03-20' WHERE Apartment_Key = 4")
+    due = state.get_due(date(2021, 3, 20), datetime(2021, 3, 20))
+    assert [i[0] for i in due] == [1, 2]
@@ -0,0 +1,25 @@
+from typing import List
+
+import pandas as pd
+import pytest
+
+import predictor
+import run
+
+
+@pytest.fixture
+def calls(monkeypatch: pytest.MonkeyPatch) -> List[str]:
+    calls = []
+    monkeypatch.setattr(predictor, 'main_new_apartments', lambda data: calls.append('handoff') or len(data))
+    monkeypatch.setattr(predictor, 'main_streaming', lambda: calls.append('streaming'))
+    return calls
+
+
+@pytest.mark.parametrize('handoff, expected', [(pd.DataFrame(), ['streaming']),
+                                               (pd.DataFrame({'Price': [1]}), ['handoff', 'streaming'])])
+def test_leftover_rows_are_scored(calls: List[str], monkeypatch: pytest.MonkeyPatch,
+                                  handoff: pd.DataFrame, expected: List[str]) -> None:
+    # Nothing new downloaded still scores rows left by earlier runs, a handoff is scored first
+    monkeypatch.setattr(run, 'run_download', lambda *args: handoff)
+    run.main(['download', 'predict'])
+    assert calls == expected
@@ -0,0 +1,53 @@
+from pathlib import Path
+from typing import Iterator
+
+import pandas as pd
+import pytest
+from sqlalchemy.engine import Engine
+
+from fixture_data import make_apartments
+from snapshot import (
+    read_snapshot,
+    sync,
+)
+from sql_connector import (
+    bulk_insert,
+    get_sqlite_engine,
+)
+
+
+@pytest.fixture
+def engine() -> Iterator[Engine]:
+    engine = get_sqlite_engine()
+    yield engine
+    engine.dispose()
+
+
+def make_snapshot_apartments(rows: int) -> pd.DataFrame:
+    # Apartments over three years, the first one is an older row without rooms and floors
+    df = make_apartments(rows).reset_index(drop=True)
+    df['Url_Link'] = 'https://www.tomsk.ru09.ru/realty?subaction=detail&id=' + df['Id'].astype(str)
+    df = df.astype({'Rooms_Number': object, 'Floors_In_Building': object})
+    df.loc[0, ['Rooms_Number', 'Floors_In_Building']] = None
+    return df
+
+
+def test_sync_and_read_months(engine: Engine, tmp_path: Path) -> None:
+    df = make_snapshot_apartments(200)
+    bulk_insert(df, 'Apartments', engine, key_columns=['Id'])
+    assert sync(engine, tmp_path, chunksize=70) == len(df)
+    assert sync(engine, tmp_path) == 0
+
+    assert len(read_snapshot(path=tmp_path)) == len(df)
+    null_row = read_snapshot(['Id', 'Rooms_Number', 'Floors_In_Building'], path=tmp_path)
+    null_row = null_row[null_row['Id'] == df.loc[0, 'Id']]
+    assert len(null_row) == 1
+    assert null_row[['Rooms_Number', 'Floors_In_Building']].isna().all(axis=None)
+
+    # Whole months of the range are read, other partitions are skipped
+    date_add = pd.to_datetime(df['Date_Add'], format='%d.%m.%Y %H:%M:%S')
+    months = date_add.dt.strftime('%Y-%m')
+    expected = df.loc[(months >= '2020-03') & (months <= '2020-06'), 'Id']
+    result = read_snapshot(['Id', 'Date_Add'], pd.Timestamp('2020-03-15'), pd.Timestamp('2020-06-10'), tmp_path)
+    assert 0 < len(expected) < len(df)
+    assert sorted(result['Id']) == sorted(expected)
@@ -0,0 +1,62 @@
+from typing import (
+    Iterator,
+    List,
+)
+
+import pandas as pd
+import pytest
+from sqlalchemy import (
+    inspect,
+    text,
+)
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+
+from sql_connector import (
+    bulk_insert,
+    get_sqlite_engine,
+)
+
+
+@pytest.fixture
+def engine() -> Iterator[Engine]:
+    engine = get_sqlite_engine()
+    with engine.begin() as connection:
+        connection.execute(text('CREATE TABLE Items (Id INTEGER PRIMARY KEY, Value INTEGER CHECK (Value >= 0))'))
+    yield engine
+    engine.dispose()
+
+
+def read_items(engine: Engine) -> List[tuple]:
+    with engine.connect() as connection:
+        return connection.execute(text('SELECT Id, Value FROM Items ORDER BY Id')).fetchall()
+
+
+def get_staging_tables(engine: Engine) -> List[tuple]:
+    return [i for i in inspect(engine).get_table_names() if '_Staging_' in i]
+
+
+def test_duplicate_keys_in_one_call(engine: Engine) -> None:
+    # The last row of a key wins, as a later call would keep the first one
+    df = pd.DataFrame({'Id': [1, 2, 1, 2, 3], 'Value': [10, 20, 11, 21, 30]})
+    assert bulk_insert(df, 'Items', engine, key_columns=['Id'], batch_size=2) == 3
+    assert read_items(engine) == [(1, 11), (2, 21), (3, 30)]
+
+
+def test_existing_rows_are_skipped(engine: Engine) -> None:
+    bulk_insert(pd.DataFrame({'Id': [1, 2], 'Value': [10, 20]}), 'Items', engine, key_columns=['Id'])
+    inserted = bulk_insert(pd.DataFrame({'Id': [2, 3], 'Value': [99, 30]}), 'Items', engine, key_columns=['Id'])
+    assert inserted == 1
+    assert read_items(engine) == [(1, 10), (2, 20), (3, 30)]
+    assert bulk_insert(pd.DataFrame({'Id': [1, 3], 'Value': [1, 3]}), 'Items', engine, key_columns=['Id']) == 0
+
+
+def test_staging_table_is_dropped_when_insert_fails(engine: Engine) -> None:
+    df = pd.DataFrame({'Id': [1, 2], 'Value': [10, -1]})
+    with pytest.raises(IntegrityError):
+        bulk_insert(df, 'Items', engine, key_columns=['Id'])
+    assert read_items(engine) == []
+    assert get_staging_tables(engine) == []
+    # The table stays usable after the failure
+    assert bulk_insert(df.abs(), 'Items', engine, key_columns=['Id']) == 2
+    assert get_staging_tables(engine) == []